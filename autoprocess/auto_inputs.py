@@ -1,14 +1,13 @@
 import sys
-from autoprocess.engine.process import DataSet
-from autoprocess.utils import log, xdsio
+from autoprocess.utils import dataset, log, xdsio
 
 logger = log.get_module_logger('auto.process')
 
 
 def main(args):
-    dataset = DataSet(filename=args.image)
+    parameters = dataset.get_parameters(args.image[0])
     logger.info('Creating XDS.INP ...')
-    xdsio.write_xds_input('ALL !XYCORR INIT COLSPOT IDXREF DEFPIX INTEGRATE CORRECT', dataset.parameters)
+    xdsio.write_xds_input('ALL !XYCORR INIT COLSPOT IDXREF DEFPIX INTEGRATE CORRECT', parameters)
 
 
 def run(args):
@@ -1,15 +1,21 @@
 import os
 import sys
 
+from autoprocess.engine import batch
 from autoprocess.engine.process import Manager
 from autoprocess.utils import log
 from autoprocess.utils import misc
+from autoprocess.utils import options as cmd_options
 
 logger = log.get_module_logger('auto.process')
 
 
 def main(args):
-    if len(args.images) >= 1:
+    if args.batch:
+        flags = [flag for name, flag in batch.SHARED_FLAGS.items() if getattr(args, name)]
+        batch.run_batch(args.batch, directory=args.dir, cores=args.cores, jobs=args.jobs, flags=flags)
+
+    elif len(args.images) >= 1:
         options = {
             'images': args.images,
             'anomalous': bool(args.anom),
@@ -18,6 +24,16 @@ def main(args):
             'chiral': (not args.nonchiral),
             'solve-small': args.formula,
             'directory': args.dir,
+            'workers': max(1, args.jobs),
+            'sg_trials': max(1, args.trials),
+            'linkage': args.linkage,
+            'cluster_cutoff': args.cluster_cutoff,
+            'speculative': args.speculative,
+            'triage': args.triage,
+            'triage_limits': dict(args.triage_limit),
+            'live': args.live,
+            'live_chunk': args.chunk,
+            'live_timeout': args.timeout,
             'prefix': [] if not args.prefix else args.prefix.split(',')
         }
         if args.screen:
@@ -60,7 +76,7 @@ def main(args):
             if args.zap or args.load:
                 app.run(colonize=args.load)
             else:
-                app.run(resume_from=chkpt['run_position'])
+                app.resume()
         except IOError:
             logger.error('Either specify a dataset, or run within a data processing directory.')
             sys.exit(1)
@@ -72,3 +88,7 @@ def run(args):
         main(args)
     except KeyboardInterrupt:
         sys.exit(1)
+
+
+if __name__ == "__main__":
+    run(cmd_options.process_parser().parse_args())
@@ -14,7 +14,7 @@ def main(args):
 
     try:
         data = misc.load_chkpt()
-        reporting.save_report(data['datasets'], data['options'])
+        reporting.save_report(data['datasets'], data['options'], usage=data.get('usage'))
     except IOError:
         logger.error('Must be in, or provide a valid directory from previous session.')
 
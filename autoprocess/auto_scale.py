@@ -1,13 +1,52 @@
 import sys
 import os
 
+from prettytable import PrettyTable
+
 from autoprocess.engine.process import Manager
 from autoprocess.utils import log
-from autoprocess.utils import misc
+from autoprocess.utils import merging, misc, xtal
 
 logger = log.get_module_logger('auto.scale')
 
 
+def preview(checkpoint, resolution=None, anomalous=False):
+    """
+    Show the merging statistics of the corrected reflections of each dataset at a resolution limit,
+    calculated directly from the reflections without running XSCALE
+
+    :param checkpoint: checkpoint of the previous processing
+    :param resolution: high resolution limit, default is the full resolution of the data
+    :param anomalous: treat Friedel mates separately
+    """
+    directory = checkpoint['options']['directory']
+    for info in checkpoint['datasets']:
+        correction = info['results'].get('correction', {})
+        if not correction.get('output_file'):
+            continue
+        filename = os.path.join(directory, correction['output_file'])
+        rows = merging.merging_statistics(filename, resolution=resolution, anomalous=anomalous)
+        table = PrettyTable()
+        table.field_names = [
+            'Shell', 'Observed', 'Unique', 'Completeness', 'Multiplicity', 'R_meas', 'R_pim', 'CC½', 'I/Sigma(I)',
+            'SigAno', 'CCₐₙₒ'
+        ]
+        for row in rows:
+            table.add_row([
+                row['shell'], row['observed'], row['unique'], '{:0.1f}'.format(row['completeness']),
+                '{:0.1f}'.format(row['multiplicity']), '{:0.1f}'.format(row['r_meas']),
+                '{:0.1f}'.format(row['r_pim']), '{:0.1f}{}'.format(row['cc_half'], row['signif']),
+                '{:0.1f}'.format(row['i_sigma']), '{:0.2f}'.format(row['sig_ano']),
+                '{}{}'.format(row['cor_ano'], row['asignif']),
+            ])
+        table.align = 'r'
+        suggested, _ = xtal.select_resolution(rows)
+        logger.info('Statistics of {}:\n{}'.format(
+            log.TermColor.bold(info['parameters']['name']), table.get_string()
+        ))
+        logger.info('Resolution limit from CC½ significance: {:0.2f} Å'.format(suggested))
+
+
 def main(args):
     if args.dir:
         os.chdir(args.dir)
@@ -18,6 +57,10 @@ def main(args):
         logger.error('Must be in, or provide a valid directory from previous session.')
         sys.exit(1)
 
+    if args.preview:
+        preview(checkpoint, resolution=args.res, anomalous=args.anom)
+        return
+
     app = Manager(checkpoint=checkpoint)
 
     overwrite = {
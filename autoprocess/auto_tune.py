@@ -0,0 +1,102 @@
+import os
+import sys
+
+from prettytable import PrettyTable
+
+from autoprocess.engine import indexing, spots
+from autoprocess.engine.process import DataSet
+from autoprocess.utils import log, misc, programs, tuning, xdsio
+
+logger = log.get_module_logger('auto.tune')
+
+
+def get_settings(cores, processors=None, delphis=(2, 4, 8)):
+    """
+    Parallelization settings to benchmark. Each setting uses all cores.
+
+    :param cores: total number of cores
+    :param processors: list of processors per job, default is the number of cores and its successive halves
+    :param delphis: list of DELPHI values
+    :return: list of (jobs, processors, delphi) tuples
+    """
+    if not processors:
+        processors = []
+        count = cores
+        while count >= 1:
+            processors.append(count)
+            count //= 2
+    return [(max(1, cores // count), count, delphi) for count in processors for delphi in delphis]
+
+
+def benchmark(parameters, settings, profile=None):
+    """
+    Measure the throughput of COLSPOT and INTEGRATE for each setting and record it in the profile
+
+    :param parameters: dataset parameters including the working directory
+    :param settings: list of (jobs, processors, delphi) tuples
+    :param profile: tuning.Profile instance, default is the profile of the current user
+    :return: list of dictionaries, one per setting
+    """
+    directory = parameters['working_directory']
+    results = []
+    for jobs, processors, delphi in settings:
+        run_info = dict(parameters, parallel=(jobs, processors, delphi))
+        result = {'jobs': jobs, 'processors': processors, 'delphi': delphi}
+        for xds_jobs in ['COLSPOT', 'DEFPIX INTEGRATE']:
+            xdsio.write_xds_input(xds_jobs, run_info, directory=directory)
+            label = '{} ({} x {} processors, DELPHI={:g})'.format(xds_jobs.split()[-1], jobs, processors, delphi)
+            # run directly instead of through the cache, restored results can not be timed
+            programs.Command('xds_par', directory=directory, label=label, slots=None, check=False).start()
+            result.update(tuning.record_run(directory, profile=profile))
+        results.append(result)
+    return results
+
+
+def main(args):
+    dataset = DataSet(filename=args.image[0])
+    params = dataset.parameters
+    directory = os.path.abspath(args.dir or 'tune-{}'.format(dataset.name))
+    misc.prepare_dir(directory)
+
+    # benchmark the first frames only
+    first, last = params['data_range']
+    last = min(last, first + args.frames - 1)
+    params.update({
+        'working_directory': directory,
+        'data_range': (first, last),
+        'spot_range': [(first, last)],
+        'skip_range': [],
+    })
+    params.pop('background_range', None)
+
+    logger.info('Preparing benchmark of {} frames in {} ...'.format(last - first + 1, directory))
+    for step in [spots.initialize, spots.find_spots, indexing.auto_index]:
+        result = step(params)
+        if not result['success']:
+            logger.error('Unable to prepare benchmark: {}'.format(result.get('reason')))
+            sys.exit(1)
+
+    cores = args.cores or misc.get_cpu_count()
+    processors = [int(v) for v in args.processors.split(',')] if args.processors else None
+    delphis = [float(v) for v in args.delphi.split(',')]
+    results = benchmark(params, get_settings(cores, processors, delphis))
+
+    table = PrettyTable()
+    table.field_names = ['Jobs', 'Processors', 'DELPHI', 'COLSPOT (frames/s)', 'INTEGRATE (frames/s)']
+    for result in results:
+        table.add_row([
+            result['jobs'], result['processors'], '{:g}'.format(result['delphi']),
+            '{:0.1f}'.format(result['COLSPOT']) if result.get('COLSPOT') else '-',
+            '{:0.1f}'.format(result['INTEGRATE']) if result.get('INTEGRATE') else '-',
+        ])
+    table.align = 'r'
+    logger.info('Throughput measured on this host:\n{}'.format(table.get_string()))
+    logger.info('Profile saved in {}'.format(tuning.PROFILE.filename))
+
+
+def run(args):
+    try:
+        log.log_to_console()
+        main(args)
+    except KeyboardInterrupt:
+        sys.exit(1)
@@ -0,0 +1,250 @@
+"""
+Batch processing of many independent datasets.
+
+Each entry of a manifest is processed by a separate auto.process pipeline. A global core budget is
+shared between the pipelines which are running at the same time. Each pipeline receives its share
+through the DPS_CORES environment variable, which limits the number of XDS jobs and processors it uses.
+Cores released by finished pipelines are handed to the pipelines started after them.
+
+The manifest is a text file with one entry per line. Each entry contains the arguments of one auto.process
+run, for example::
+
+    /data/lyso/lyso_0001.cbf
+    /data/thau/thau_0001.cbf --anom
+    /data/mad/mad_{peak,infl}_0001.cbf --mad -d mad-results
+
+Empty lines and lines starting with '#' are ignored.
+
+"""
+
+import os
+import re
+import shlex
+import subprocess
+import sys
+import time
+
+from autoprocess.engine import reporting
+from autoprocess.utils import log, misc, xdsio, xtal
+from autoprocess.utils.misc import json
+
+logger = log.get_module_logger(__name__)
+
+# cores per pipeline used to choose the number of concurrent pipelines if not specified
+CORES_PER_PIPELINE = 8
+
+# flags of the batch command which are passed on to every entry
+SHARED_FLAGS = {
+    'anom': '--anom',
+    'backup': '--backup',
+    'nonchiral': '--nonchiral',
+    'screen': '--screen',
+    'mad': '--mad',
+}
+
+
+def read_manifest(filename):
+    """
+    Read a batch manifest
+
+    :param filename: manifest file name
+    :return: list of argument lists, one for each entry
+    """
+    entries = []
+    with open(filename, 'r') as handle:
+        for line in handle:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                entries.append(shlex.split(line))
+    return entries
+
+
+def entry_name(args):
+    """
+    Derive a short name for a manifest entry from its first frame
+
+    :param args: argument list of the entry
+    :return: name
+    """
+    images = [arg for arg in args if not arg.startswith('-')]
+    if not images:
+        return 'entry'
+    stem = os.path.splitext(os.path.basename(images[0]))[0]
+    return re.sub(r'[_-]?\d+$', '', stem) or stem
+
+
+def entry_directory(args):
+    """
+    Return the output directory specified in the arguments of an entry, if any
+    """
+    for i, arg in enumerate(args):
+        if arg in ('-d', '--dir') and i + 1 < len(args):
+            return args[i + 1]
+        elif arg.startswith('--dir='):
+            return arg.split('=', 1)[1]
+
+
+class BatchEntry(object):
+    """
+    A single pipeline of a batch run
+
+    :param index: position of the entry in the manifest
+    :param args: auto.process arguments of the entry
+    :param directory: batch directory
+    :param flags: flags shared by all entries
+    """
+
+    def __init__(self, index, args, directory, flags=()):
+        self.index = index
+        self.name = entry_name(args)
+        self.label = '{:03d}-{}'.format(index + 1, self.name)
+        self.args = list(args) + [flag for flag in flags if flag not in args]
+        self.directory = entry_directory(args)
+        if not self.directory:
+            self.directory = os.path.join(directory, self.label)
+            self.args += ['--dir', self.directory]
+        self.directory = os.path.abspath(self.directory)
+        self.output = os.path.join(directory, '{}.log'.format(self.label))
+        self.cores = 0
+        self.proc = None
+        self.start_time = None
+        self.end_time = None
+        self.returncode = None
+
+    def start(self, cores):
+        """
+        Launch the pipeline with the given share of the core budget
+
+        :param cores: number of cores
+        """
+        self.cores = cores
+        env = dict(os.environ, DPS_CORES=str(cores))
+        command = [sys.executable, '-m', 'autoprocess.auto_process'] + self.args
+        self.start_time = time.time()
+        with open(self.output, 'w') as output:
+            self.proc = subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT, env=env)
+        logger.info('Started {} using {} cores ...'.format(log.TermColor.italics(self.label), cores))
+
+    def finish(self, returncode):
+        self.returncode = returncode
+        self.end_time = time.time()
+        status = 'completed' if returncode == 0 else log.TermColor.error('failed')
+        logger.info('{} {} after {:0.0f} s'.format(
+            log.TermColor.italics(self.label), status, self.end_time - self.start_time
+        ))
+
+    def summary(self):
+        """
+        Summarize the results of the pipeline from its report and checkpoint files
+
+        :return: dictionary
+        """
+        info = {
+            'label': self.label,
+            'directory': self.directory,
+            'cores': self.cores,
+            'wall': (self.end_time - self.start_time) if self.end_time else None,
+            'status': 'pending' if self.returncode is None else 'success' if self.returncode == 0 else 'failed',
+            'title': '',
+            'score': None,
+            'space_group': None,
+            'resolution': None,
+        }
+        try:
+            report = misc.load_json(os.path.join(self.directory, 'report.json'))
+            info['title'] = report.get('title', '')
+            info['score'] = report.get('score')
+        except (OSError, ValueError):
+            pass
+        try:
+            checkpoint = misc.load_chkpt(os.path.join(self.directory, 'process.chkpt'))
+            results = checkpoint['datasets'][0]['results']
+            analysis = results.get('scaling', results.get('correction', {}))
+            info['space_group'] = results['correction']['symmetry']['space_group']['sg_number']
+            info['resolution'] = analysis['summary']['resolution'][0]
+        except (OSError, ValueError, KeyError, IndexError, TypeError):
+            pass
+        return info
+
+
+def batch_table(summaries):
+    """
+    Generate the summary table of a batch run
+
+    :param summaries: list of entry summaries
+    :return: dictionary of table specification
+    """
+    rows = []
+    for info in summaries:
+        rows.append([
+            info['label'],
+            info['status'],
+            '-' if info['score'] is None else '{:0.2f}'.format(info['score']),
+            '-' if info['space_group'] is None else xtal.SG_NAMES[info['space_group']],
+            '-' if info['resolution'] is None else '{:0.2f}'.format(info['resolution']),
+            info['cores'],
+            '-' if info['wall'] is None else '{:0.0f}'.format(info['wall']),
+            info['title'],
+        ])
+    return {
+        'title': 'Batch Results',
+        'kind': 'table',
+        'data': [
+            ['Entry', 'Status', 'Score', 'Space Group', 'Resolution', 'Cores', 'Wall (s)', 'Title']
+        ] + rows,
+        'header': 'row',
+        'notes': (
+            "Each entry was processed in its own directory, see the report of each entry for details. "
+            "'Cores' is the share of the core budget given to the entry when it was started."
+        )
+    }
+
+
+def run_batch(manifest, directory=None, cores=0, jobs=0, flags=()):
+    """
+    Process all entries of a manifest sharing a core budget
+
+    :param manifest: manifest file name
+    :param directory: batch directory for logs and the summary, default is the current directory
+    :param cores: total core budget, default is all cores available
+    :param jobs: maximum number of pipelines to run at the same time, determined from the budget if 0
+    :param flags: auto.process flags to add to every entry
+    :return: list of entry summaries
+    """
+    directory = os.path.abspath(directory or os.getcwd())
+    misc.prepare_dir(directory)
+    budget = cores or xdsio.get_core_budget() or sum(xdsio.HOSTS.values())
+    entries = [
+        BatchEntry(i, args, directory, flags=flags) for i, args in enumerate(read_manifest(manifest))
+    ]
+    jobs = jobs or max(1, budget // CORES_PER_PIPELINE)
+    jobs = max(1, min(jobs, len(entries), budget))
+
+    logger.info('Processing {} datasets, {} at a time using {} cores'.format(len(entries), jobs, budget))
+    pending = list(entries)
+    running = {}
+    while pending or running:
+        free = budget - sum(entry.cores for entry in running.values())
+        while pending and len(running) < jobs:
+            # split the free cores evenly between the pipelines which can be started now
+            slots = min(jobs - len(running), len(pending))
+            entry = pending.pop(0)
+            share = max(1, free // slots)
+            entry.start(share)
+            running[entry.proc.pid] = entry
+            free -= share
+
+        pid, status = os.wait()
+        if pid in running:
+            entry = running.pop(pid)
+            entry.proc.returncode = os.waitstatus_to_exitcode(status)
+            entry.finish(entry.proc.returncode)
+
+    summaries = [entry.summary() for entry in entries]
+    table = batch_table(summaries)
+    with open(os.path.join(directory, 'batch.json'), 'w') as handle:
+        json.dump(summaries, handle)
+    with open(os.path.join(directory, 'batch.txt'), 'w') as handle:
+        handle.write(reporting.text_report([{'title': 'Batch Processing', 'content': [table]}]))
+    logger.info('Batch summary saved in {}'.format(os.path.join(directory, 'batch.txt')))
+    return summaries
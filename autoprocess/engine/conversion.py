@@ -1,75 +1,53 @@
 import os
 
-import autoprocess.errors
-from autoprocess.utils import programs, misc, log, xdsio
+from autoprocess.utils import misc, log, export
 
 logger = log.get_module_logger(__name__)
 
 
 def convert_formats(dataset, options=None):
     options = options or {}
-    os.chdir(options['directory'])
+    directory = options['directory']
 
     # GENERATE MTZ and CNS output files
     infile = dataset.results['scaling'].get('output_file')
     out_file_dir = os.path.dirname(infile)
     out_file_base = os.path.basename(infile)
     out_file_root = os.path.join(out_file_dir, options.get('file_root', dataset.name))
+    anomalous = options.get('anomalous', False)
     output_files = []
 
     logger.info('Generating MTZ, SHELX & CNS files from {} ...'.format(out_file_base))
-    if not misc.file_requirements(dataset.results['scaling'].get('output_file')):
+    if not misc.file_requirements(dataset.results['scaling'].get('output_file'), directory=directory):
         return {'step': 'conversion', 'success': False, 'reason': 'Required files missing'}
 
-    # Create convertion options
-    conv_options = [
-        {
-            'resolution': 0,
-            'format': 'CNS',
-            'anomalous': options.get('anomalous', False),
-            'input_file': infile,
-            'output_file': out_file_root + ".cns",
-            'freeR_fraction': 0.05
-        }, {
-            'resolution': 0,
-            'format': 'SHELX',
-            'anomalous': options.get('anomalous', False),
-            'input_file': infile,
-            'output_file': out_file_root + "-shelx.hkl",
-            'freeR_fraction': 0,
-        }, {
-            'resolution': 0,
-            'format': 'CCP4_I',
-            'anomalous': True,
-            'input_file': infile,
-            'output_file': out_file_root + ".ccp4i",
-            'freeR_fraction': 0.05,
-        }
+    # read and merge the reflections once, all formats share the same free-R flags
+    try:
+        reflections = export.Reflections(os.path.join(directory, infile), free_r_fraction=0.05)
+    except (OSError, ValueError, KeyError) as e:
+        logger.error('Unable to read {}: {}'.format(out_file_base, e))
+        return {'step': 'conversion', 'success': False, 'reason': 'Unable to read reflections'}
+
+    writers = [
+        ('MTZ', out_file_root + ".mtz", lambda filename: export.write_mtz(
+            reflections, filename, project=dataset.name, crystal=dataset.name, dataset=dataset.name
+        )),
+        ('SHELX', out_file_root + "-shelx.hkl", lambda filename: export.write_shelx(
+            reflections, filename, anomalous=anomalous
+        )),
+        ('CNS', out_file_root + ".cns", lambda filename: export.write_cns(
+            reflections, filename, anomalous=anomalous
+        )),
     ]
-
-    for opt in conv_options:
+    for out_format, out_file, writer in writers:
+        label = f'Preparing {out_format} output file'
         try:
-            if opt['format'] == 'CCP4_I':
-                out_file = out_file_root + ".mtz"
-                out_format = 'MTZ'
-            else:
-                out_file = opt['output_file']
-                out_format = opt['format']
-
-            xdsio.write_xdsconv_input(opt)
-            label = f'Preparing {out_format} output file'
-            programs.xdsconv(label=f'{label:<27}', final=log.TermColor.bold(out_file))
-
-            # Special formatting for MTZ
-            if opt['format'] == 'CCP4_I':
-                mtz_file = out_file_root + ".mtz"
-                programs.f2mtz(mtz_file)
-                output_files.append(mtz_file)
-            else:
-                output_files.append(opt['output_file'])
-
-        except autoprocess.errors.ProcessError as e:
-            logger.warning(f'Error creating {opt["format"]} file: {e}')
+            writer(os.path.join(directory, out_file))
+        except (OSError, ValueError) as e:
+            logger.warning(f'Error creating {out_format} file: {e}')
+        else:
+            logger.info(f'{label:<27} {log.TermColor.bold(out_file)}')
+            output_files.append(out_file)
 
     if len(output_files) == 0:
         return {'step': 'conversion', 'success': False, 'reason': 'No output files generated'}
@@ -1,10 +1,15 @@
 import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy
 
 import autoprocess.errors
 from autoprocess.parsers import xds
-from autoprocess.utils import log, misc, programs, xdsio
+from autoprocess.utils import ledger, log, misc, programs, spotio, xdsio, xtal
+from autoprocess.utils.cache import STEP_CACHE, XDS_JOB_FILES
 from autoprocess.utils.choices import Choices
 from autoprocess.utils.misc import Table
 
@@ -32,6 +37,13 @@ CODES = {
     256: PROBLEMS.failed
 }
 
+# files needed to repeat spot finding and indexing in a scratch directory, and the results kept from it
+REMEDY_INPUTS = sorted(set(XDS_JOB_FILES['COLSPOT'][0] + XDS_JOB_FILES['IDXREF'][0]) - {'SPOT.XDS'})
+REMEDY_OUTPUTS = ['XDS.INP', 'SPOT.XDS', 'COLSPOT.LP', 'IDXREF.LP', 'XPARM.XDS']
+
+# run parameters which remedies may change, kept for the following steps after a successful indexing
+REMEDY_PARAMETERS = ['spot_range', 'beam_center', 'sigma', 'min_spot_size', 'refine_index']
+
 
 def diagnose_index(info):
     failure_code = info.get('failure_code', 256)
@@ -115,25 +127,179 @@ def diagnose_index(info):
     }
 
 
-def _filter_spots(sigma=0, unindexed=False, filename='SPOT.XDS'):
-    new_list = numpy.loadtxt(filename)
-    if new_list.shape[1] < 5:
-        return
-    fmt = [" %0.2f"] + ["%0.2f"] * 2 + ["%0.0f."]
-    if new_list.shape[1] > 7:
-        fmt += ["%d"] * 4
-    else:
-        fmt += ["%d"] * 3
+def triage(info, options=None):
+    """
+    Score the indexing results to decide whether a crystal is worth processing further
 
-    new_sel = (new_list[:, 3] > sigma)
-    if unindexed:
-        new_sel = new_sel & (new_list[:, -3] != 0) & (new_list[:, -3] != 0) & (new_list[:, -3] != 0)
+    :param info: indexing results
+    :param options: processing options, 'triage' is the minimum score, 'triage_limits' overrides the
+        midpoints of the scoring terms in xtal.INDEXING_LIMITS
+    :return: dictionary with the score, scoring details and whether processing should stop
+    """
+    options = options or {}
+    reflections = info.get('reflections', {})
+    subtrees = info.get('subtrees', [])
+    indexed_fraction = reflections.get('selected_spots', 0) / max(1, reflections.get('indexed_spots', 0))
+    subtree_fraction = subtrees[0]['population'] / max(1, info.get('local_indexed_spots', 0)) if subtrees else 0.0
+    problems = diagnose_index(info)['problems'] - {PROBLEMS.unindexed_spots, PROBLEMS.index_origin}
+    score, details = xtal.score_indexing(
+        indexed_fraction, subtree_fraction, info['summary']['stdev_spot'], info['summary']['stdev_spindle'],
+        info['summary']['mosaicity'], len(problems), limits=options.get('triage_limits')
+    )
+    return {
+        'score': float(score),
+        'minimum': options.get('triage', 0.0),
+        'details': [
+            {'name': name, 'quality': float(quality), 'value': float(value)} for name, quality, value in details
+        ],
+        'problems': [PROBLEMS[problem] for problem in sorted(problems)],
+        'abort': bool(score < options.get('triage', 0.0)),
+    }
 
-    numpy.savetxt(filename, new_list[new_sel, :], fmt=fmt)
+
+def _filter_spots(sigma=0, unindexed=False, filename='SPOT.XDS', directory='.'):
+    spot_list = spotio.SpotList(os.path.join(directory, filename))
+    mask = spot_list.strong(sigma)
+    if unindexed and spot_list.indexed:
+        mask &= ~spot_list.unindexed()
+    total = len(spot_list)
+    if spot_list.save(mask):
+        _logger.debug('Removed {} of {} spots'.format(total - len(spot_list), total))
+
+
+def index_remedies(diagnosis, run_info):
+    """
+    Remedies for a failed indexing which can be tried independently of each other
+
+    :param diagnosis: diagnosis of the failed indexing
+    :param run_info: run parameters of the failed indexing
+    :return: list of dictionaries with the 'label', XDS 'jobs', run 'parameters' to update, and the minimum
+        spot intensity 'sigma' and removal of 'aliens' when filtering the spot list
+    """
+    all_images = (run_info['spot_range'][0] == run_info['data_range'])
+    full_range = {} if all_images else {'spot_range': [run_info['data_range']]}
+    remedies = []
+    if not all_images:
+        remedies.append({
+            'label': 'Expanding Spot Range', 'jobs': 'COLSPOT IDXREF', 'parameters': full_range,
+            'sigma': None, 'aliens': False
+        })
+    if 'beam_center' in diagnosis['options']:
+        remedies.append({
+            'label': 'Adjusting detector origin', 'jobs': 'IDXREF',
+            'parameters': {'beam_center': diagnosis['options']['beam_center']}, 'sigma': None, 'aliens': False
+        })
+    remedies.extend([
+        {
+            'label': 'Adjusting spot size and refinement parameters', 'jobs': 'COLSPOT IDXREF',
+            'parameters': dict(full_range, sigma=6, min_spot_size=4.5, refine_index="CELL BEAM ORIENTATION AXIS"),
+            'sigma': None, 'aliens': False
+        },
+        {
+            'label': 'Removing weak spots (Sigma < 9)', 'jobs': 'IDXREF', 'parameters': {'sigma': 9},
+            'sigma': 9, 'aliens': False
+        },
+        {
+            'label': 'Removing all alien spots', 'jobs': 'IDXREF', 'parameters': {},
+            'sigma': 0, 'aliens': True
+        },
+    ])
+    return remedies
+
+
+def _run_remedy(remedy, run_info, command):
+    directory = command.directory
+    if remedy['sigma'] is not None:
+        _filter_spots(sigma=remedy['sigma'], unindexed=remedy['aliens'], directory=directory)
+    xdsio.write_xds_input(remedy['jobs'], dict(run_info, **remedy['parameters']), directory=directory)
+    command.slots = programs.input_slots(directory, 'XDS.INP')
+    try:
+        STEP_CACHE.run(command, 'XDS.INP')
+    except autoprocess.errors.ProcessError as e:
+        return {'failure_code': 256, 'failure': str(e)}
+    idxref_file = os.path.join(directory, 'IDXREF.LP')
+    if not os.path.exists(idxref_file):
+        return {'failure_code': 256, 'failure': 'IDXREF did not complete'}
+    return xds.parse_idxref(idxref_file)
+
+
+def index_remedies_concurrently(run_info, diagnosis, options=None):
+    """
+    Try all remedies for a failed indexing at the same time, each in a scratch copy of the working
+    directory with its own XDS.INP and spot list, and keep the results of the selected solution. The
+    processors available to the dataset are divided between the remedies.
+
+    :param run_info: run parameters of the failed indexing
+    :param diagnosis: diagnosis of the failed indexing
+    :param options: processing options, 'speculative' is 'first' to keep the first solution found and cancel
+        the remaining runs, or 'best' to keep the solution with the best indexing score
+    :return: tuple of the IDXREF results and the run parameters of the selected solution, or None if all
+        remedies failed
+    """
+    options = options or {}
+    directory = run_info['working_directory']
+    remedies = index_remedies(diagnosis, run_info)
+    share = run_info.get('processors') or programs.EXECUTOR.slots.size
+    processors = max(1, share // len(remedies))
+    _logger.info('Trying {:d} remedies concurrently'.format(len(remedies)))
+
+    commands = []
+    for remedy in remedies:
+        scratch = tempfile.mkdtemp(prefix='.index-', dir=directory)
+        misc.link_files(directory, scratch, REMEDY_INPUTS)
+        # IDXREF rewrites the spot list, each run needs its own copy
+        shutil.copy2(os.path.join(directory, 'SPOT.XDS'), scratch)
+        command = programs.Command(
+            'xds_par', directory=scratch, label='-> {}'.format(remedy['label']), slots=processors, check=False
+        )
+        if command.show_spinner:
+            command.spinner = programs.LineSpinner(command.spinner.message)
+        commands.append(command)
+
+    def _cleanup():
+        executor.shutdown(wait=True)
+        for command in commands:
+            programs.append_log(command.directory, directory)
+            shutil.rmtree(command.directory, ignore_errors=True)
+
+    results = [None] * len(remedies)
+    executor = ThreadPoolExecutor(max_workers=len(remedies))
+    futures = {}
+    try:
+        remedy_info = dict(run_info, processors=processors)
+        futures = {
+            executor.submit(ledger.bind(_run_remedy), remedy, remedy_info, command): i
+            for i, (remedy, command) in enumerate(zip(remedies, commands))
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            if options.get('speculative') == 'first' and results[i].get('failure_code') == 0:
+                for command in commands:
+                    command.cancel()
+                break
+
+        solutions = [i for i, info in enumerate(results) if info and info.get('failure_code') == 0]
+        if options.get('speculative') == 'first':
+            selected = next(iter(solutions), None)
+        else:
+            selected = max(solutions, key=lambda i: triage(results[i], options)['score'], default=None)
+
+        if selected is not None:
+            _logger.info(log.log_value('Selected solution:', remedies[selected]['label']))
+            misc.move_files(commands[selected].directory, directory, REMEDY_OUTPUTS)
+            return results[selected], remedies[selected]['parameters']
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if all(future.done() for future in futures):
+            _cleanup()
+        else:
+            # cancelled runs are still stopping, their scratch directories are removed once they have
+            threading.Thread(target=_cleanup, name='index-cleanup').start()
 
 
-def harvest_index():
-    info = xds.parse_idxref()
+def harvest_index(directory='.'):
+    info = xds.parse_idxref(os.path.join(directory, 'IDXREF.LP'))
     if info.get('failure_code') == 0:
         return {'step': 'indexing', 'success': True, 'data': info}
     else:
@@ -142,20 +308,34 @@ def harvest_index():
 
 def auto_index(data_info, options=None):
     options = options or {}
-    os.chdir(data_info['working_directory'])
+    directory = data_info['working_directory']
+    idxref_file = os.path.join(directory, 'IDXREF.LP')
     step_descr = 'Determining lattice orientation and parameters'
     jobs = 'IDXREF'
     run_info = {'mode': options.get('mode')}
     run_info.update(data_info)
-    if not misc.file_requirements('XDS.INP', 'SPOT.XDS'):
+    if not misc.file_requirements('XDS.INP', 'SPOT.XDS', directory=directory):
         return {'step': 'indexing', 'success': False, 'reason': "Required files not found"}
     try:
 
-        xdsio.write_xds_input(jobs, run_info)
-        programs.xds_par(step_descr)
-        info = xds.parse_idxref()
+        xdsio.write_xds_input(jobs, run_info, directory=directory)
+        programs.xds_par(step_descr, directory=directory)
+        info = xds.parse_idxref(idxref_file)
         diagnosis = diagnose_index(info)
 
+        if info.get('failure_code') > 0 and options.get('speculative'):
+            _logger.warning('Indexing failed:')
+            for prob in diagnosis['problems']:
+                _logger.warning('... {}'.format(PROBLEMS[prob]))
+            if options.get('backup', False):
+                misc.backup_files('SPOT.XDS', 'IDXREF.LP', directory=directory)
+            solution = index_remedies_concurrently(run_info, diagnosis, options)
+            if solution is not None:
+                info, parameters = solution
+                run_info.update(parameters)
+            else:
+                _logger.warning('No remedy succeeded on its own, combining them one at a time')
+
         _retries = 0
         sigma = 6
         spot_size = 3
@@ -171,7 +351,7 @@ def auto_index(data_info, options=None):
                 _logger.warning('... {}'.format(PROBLEMS[prob]))
 
             if options.get('backup', False):
-                misc.backup_files('SPOT.XDS', 'IDXREF.LP')
+                misc.backup_files('SPOT.XDS', 'IDXREF.LP', directory=directory)
 
             if diagnosis['problems'] & {PROBLEMS.index_origin}:
                 if not _all_images:
@@ -180,15 +360,15 @@ def auto_index(data_info, options=None):
                 else:
                     step_descr = '-> Adjusting detector origin'
                     run_info['beam_center'] = diagnosis['options'].get('beam_center', run_info['beam_center'])
-                xdsio.write_xds_input('COLSPOT IDXREF', run_info)
-                programs.xds_par(step_descr)
-                info = xds.parse_idxref()
+                xdsio.write_xds_input('COLSPOT IDXREF', run_info, directory=directory)
+                programs.xds_par(step_descr, directory=directory)
+                info = xds.parse_idxref(idxref_file)
                 diagnosis = diagnose_index(info)
             elif (diagnosis['problems'] & {PROBLEMS.few_spots, PROBLEMS.dimension_2d}) and not _all_images:
                 run_info.update(spot_range=[run_info['data_range']])
-                xdsio.write_xds_input('IDXREF', run_info)
-                programs.xds_par('-> Expanding Spot Range')
-                info = xds.parse_idxref()
+                xdsio.write_xds_input('IDXREF', run_info, directory=directory)
+                programs.xds_par('-> Expanding Spot Range', directory=directory)
+                info = xds.parse_idxref(idxref_file)
                 diagnosis = diagnose_index(info)
             elif (diagnosis['problems'] & {PROBLEMS.poor_solution, PROBLEMS.spot_accuracy,
                                            PROBLEMS.non_integral}) and not _spot_adjusted:
@@ -198,26 +378,26 @@ def auto_index(data_info, options=None):
                 if not _all_images:
                     new_params['spot_range'] = [run_info['data_range']]
                 run_info.update(new_params)
-                xdsio.write_xds_input('COLSPOT IDXREF', run_info)
-                programs.xds_par('-> Adjusting spot size and refinement parameters')
-                info = xds.parse_idxref()
+                xdsio.write_xds_input('COLSPOT IDXREF', run_info, directory=directory)
+                programs.xds_par('-> Adjusting spot size and refinement parameters', directory=directory)
+                info = xds.parse_idxref(idxref_file)
                 diagnosis = diagnose_index(info)
                 _spot_adjusted = spot_size > 12
             elif (diagnosis['problems'] & {PROBLEMS.unindexed_spots}) and not _weak_removed:
                 sigma += 3
-                _filter_spots(sigma=sigma)
+                _filter_spots(sigma=sigma, directory=directory)
                 run_info.update(sigma=sigma)
-                xdsio.write_xds_input('IDXREF', run_info)
-                programs.xds_par('-> Removing weak spots (Sigma < {:2.0f})'.format(sigma))
-                info = xds.parse_idxref()
+                xdsio.write_xds_input('IDXREF', run_info, directory=directory)
+                programs.xds_par('-> Removing weak spots (Sigma < {:2.0f})'.format(sigma), directory=directory)
+                info = xds.parse_idxref(idxref_file)
                 diagnosis = diagnose_index(info)
                 _weak_removed = sigma >= 12
             elif (diagnosis['problems'] & {PROBLEMS.unindexed_spots,
                                            PROBLEMS.multiple_subtrees}) and not _aliens_removed:
-                _filter_spots(unindexed=True)
-                xdsio.write_xds_input(jobs, run_info)
-                programs.xds_par('-> Removing all alien spots')
-                info = xds.parse_idxref()
+                _filter_spots(unindexed=True, directory=directory)
+                xdsio.write_xds_input(jobs, run_info, directory=directory)
+                programs.xds_par('-> Removing all alien spots', directory=directory)
+                info = xds.parse_idxref(idxref_file)
                 diagnosis = diagnose_index(info)
                 _aliens_removed = True
             else:
@@ -228,6 +408,7 @@ def auto_index(data_info, options=None):
         return {'step': 'indexing', 'success': False, 'reason': str(e)}
 
     if info.get('failure_code') == 0:
+        info['run_parameters'] = {key: run_info[key] for key in REMEDY_PARAMETERS if key in run_info}
         return {'step': 'indexing', 'success': True, 'data': info}
     else:
         return {'step': 'indexing', 'success': False, 'reason': info['failure']}
@@ -1,19 +1,34 @@
 import os
 import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import autoprocess.errors
 from autoprocess.parsers import xds
-from autoprocess.utils import log, misc, programs, xtal, xdsio
+from autoprocess.utils import dataset, ledger, log, misc, programs, xtal, xdsio
+from autoprocess.utils.cache import XDS_JOB_FILES
+from autoprocess.utils.frames import FrameSet
 
 logger = log.get_module_logger(__name__)
 
+# file names of integration results of a chunk of frames when integrating during collection
+CHUNK_NAME = 'INTEGRATE-{:05d}-{:05d}.{}'
 
-def harvest_integrate():
-    if not misc.file_requirements('INTEGRATE.LP', 'CORRECT.LP'):
+# space group trials are acceptable if their low resolution R-meas (%) is within
+# TRIAL_R_RATIO * best + TRIAL_R_MARGIN of the best trial
+TRIAL_R_RATIO = 1.5
+TRIAL_R_MARGIN = 2.0
+
+# files written by a correction trial, which are moved into the working directory if it is selected
+TRIAL_OUTPUTS = XDS_JOB_FILES['CORRECT'][1] + ['XDS.INP', 'XDSSTAT.LP', 'CORRECT.LP.first']
+
+
+def harvest_integrate(directory='.'):
+    if not misc.file_requirements('INTEGRATE.LP', 'CORRECT.LP', directory=directory):
         return {'step': 'integration', 'success': False, 'reason': 'Required files missing'}
     else:
-        info = xds.parse_integrate()
-        info['statistics'] = xds.parse_correct()
+        info = xds.parse_integrate(os.path.join(directory, 'INTEGRATE.LP'))
+        info['statistics'] = xds.parse_correct(os.path.join(directory, 'CORRECT.LP'))
 
     if info.get('failure') is None:
         info['output_file'] = 'INTEGRATE.HKL'
@@ -24,23 +39,21 @@ def harvest_integrate():
 
 def integrate(data_info, options=None):
     options = {} if options is None else options
-    os.chdir(data_info['working_directory'])
+    if options.get('live'):
+        return integrate_live(data_info, options)
+    directory = data_info['working_directory']
     run_info = {'mode': options.get('mode')}
     run_info.update(data_info)
     if options.get('backup', False):
-        misc.backup_files('INTEGRATE.LP', 'INTEGRATE.HKL')
+        misc.backup_files('INTEGRATE.LP', 'INTEGRATE.HKL', directory=directory)
 
     # if optimizing the integration, copy GXPARM
     # Calculate actual number of frames
-    full_range = list(range(run_info['data_range'][0], run_info['data_range'][1] + 1))
-    skip_ranges = []
-    for r_s, r_e in run_info['skip_range']:
-        skip_ranges.extend(list(range(r_s, r_e + 1)))
-    num_frames = len(set(full_range) - set(skip_ranges))
-
-    if options.get('optimize', False) and os.path.exists('GXPARM.XDS'):
-        misc.backup_files('XPARM.XDS')
-        shutil.copy('GXPARM.XDS', 'XPARM.XDS')
+    num_frames = len(FrameSet([run_info['data_range']]) - FrameSet(run_info['skip_range']))
+
+    if options.get('optimize', False) and os.path.exists(os.path.join(directory, 'GXPARM.XDS')):
+        misc.backup_files('XPARM.XDS', directory=directory)
+        shutil.copy(os.path.join(directory, 'GXPARM.XDS'), os.path.join(directory, 'XPARM.XDS'))
         step_descr = 'Optimizing {:d} frames of dataset {}'.format(
             num_frames, log.TermColor.italics(data_info['name'])
         )
@@ -52,14 +65,14 @@ def integrate(data_info, options=None):
     # check if we are screening
     screening = options.get('mode') == 'screen'
 
-    xdsio.write_xds_input("DEFPIX INTEGRATE", run_info)
-    if not misc.file_requirements('X-CORRECTIONS.cbf', 'Y-CORRECTIONS.cbf', 'XPARM.XDS'):
+    xdsio.write_xds_input("DEFPIX INTEGRATE", run_info, directory=directory)
+    if not misc.file_requirements('X-CORRECTIONS.cbf', 'Y-CORRECTIONS.cbf', 'XPARM.XDS', directory=directory):
         return {'step': 'integration', 'success': False, 'reason': 'Required files missing'}
 
 
     try:
-        programs.xds_par(step_descr)
-        info = xds.parse_integrate()
+        programs.xds_par(step_descr, directory=directory)
+        info = xds.parse_integrate(os.path.join(directory, 'INTEGRATE.LP'))
     except autoprocess.errors.ProcessError as e:
         return {'step': 'integration', 'success': False, 'reason': str(e)}
     except:
@@ -77,13 +90,111 @@ def integrate(data_info, options=None):
         return {'step': 'integration', 'success': False, 'reason': info['failure']}
 
 
-def harvest_correct():
-    if not misc.file_requirements('CORRECT.LP', 'GXPARM.XDS', 'XDS_ASCII.HKL'):
+def _merge_chunks(directory, chunks, data_range):
+    """
+    Combine the INTEGRATE.HKL and INTEGRATE.LP files of consecutive chunks of frames into
+    single INTEGRATE.HKL and INTEGRATE.LP files covering the full data range.
+
+    :param directory: working directory
+    :param chunks: list of (first, last) frame ranges in order
+    :param data_range: full data range
+    """
+    with open(os.path.join(directory, 'INTEGRATE.HKL'), 'w') as output:
+        for i, (first, last) in enumerate(chunks):
+            with open(os.path.join(directory, CHUNK_NAME.format(first, last, 'HKL')), 'r') as handle:
+                for line in handle:
+                    if not line.startswith('!'):
+                        output.write(line)
+                    elif i == 0 and line.startswith('!DATA_RANGE='):
+                        output.write('!DATA_RANGE={:8d}{:8d}\n'.format(*data_range))
+                    elif i == 0 and not line.startswith('!END_OF_DATA'):
+                        # header of the first chunk is used for the combined file
+                        output.write(line)
+        output.write('!END_OF_DATA\n')
+
+    with open(os.path.join(directory, 'INTEGRATE.LP'), 'w') as output:
+        for first, last in chunks:
+            with open(os.path.join(directory, CHUNK_NAME.format(first, last, 'LP')), 'r') as handle:
+                shutil.copyfileobj(handle, output)
+
+
+def integrate_live(data_info, options=None):
+    """
+    Integrate a dataset while frames are still being collected. New frames are integrated in chunks as soon
+    as enough of them are on disk, and the chunks are combined once no new frames appear within the timeout.
+
+    :param data_info: dataset parameters, the data range is that of the frames available when indexing
+    :param options: processing options, 'live_chunk' is the size of each chunk in degrees and 'live_timeout'
+        the number of seconds to wait for new frames before assuming the collection is complete.
+    """
+    options = {} if options is None else options
+    directory = data_info['working_directory']
+    chunk_size = max(1, int(round(options.get('live_chunk', 10.0) / data_info['delta_angle'])))
+    timeout = options.get('live_timeout', 60.0)
+    chunk_options = dict(options, live=False, backup=False)
+
+    first_frame = data_info['data_range'][0]
+    start = first_frame
+    chunks = []
+    sequence = []
+    collecting = True
+    while collecting:
+        frames, collecting = dataset.wait_for_frames(
+            data_info['file_template'], start, start + chunk_size - 1, timeout=timeout
+        )
+        if not frames:
+            break
+        end = frames[-1]
+        sequence.extend(frames)
+        missing = FrameSet([(start, end)]) - FrameSet.from_frames(frames)
+        chunk_info = dict(data_info, data_range=(start, end), skip_range=missing.ranges())
+        out = integrate(chunk_info, chunk_options)
+        if not out['success']:
+            return out
+        for ext in ['HKL', 'LP']:
+            os.replace(os.path.join(directory, 'INTEGRATE.{}'.format(ext)),
+                       os.path.join(directory, CHUNK_NAME.format(start, end, ext)))
+        chunks.append((start, end))
+        start = end + 1
+
+    if not chunks:
+        return {'step': 'integration', 'success': False, 'reason': 'No frames to integrate'}
+
+    frame_info = dataset.frame_parameters(data_info, sorted(sequence))
+    logger.info(log.log_value('Collection complete. Frames:', '{} - {}'.format(*frame_info['data_range'])))
+    _merge_chunks(directory, chunks, frame_info['data_range'])
+    info = xds.parse_integrate(os.path.join(directory, 'INTEGRATE.LP'))
+    if info.get('failure') is not None:
+        return {'step': 'integration', 'success': False, 'reason': info['failure']}
+
+    info['frames'] = {key: frame_info[key] for key in ['data_range', 'skip_range', 'frame_count']}
+    if data_info['working_directory'] == options.get('directory'):
+        info['output_file'] = 'INTEGRATE.HKL'
+    else:
+        info['output_file'] = os.path.join(data_info['name'], 'INTEGRATE.HKL')
+    return {'step': 'integration', 'success': True, 'data': info}
+
+
+def run_xdsstat(directory='.'):
+    """
+    Calculate extra statistics of XDS_ASCII.HKL in a scratch directory, so that other programs reading
+    the same file can run in the working directory at the same time.
+    """
+    result, = programs.run_isolated([(
+        lambda scratch: [programs.xdsstat_command('XDS_ASCII.HKL', directory=scratch)],
+        ['XDS_ASCII.HKL'], ['XDSSTAT.LP']
+    )], directory=directory)
+    if result is not None:
+        raise result
+
+
+def harvest_correct(directory='.'):
+    if not misc.file_requirements('CORRECT.LP', 'GXPARM.XDS', 'XDS_ASCII.HKL', directory=directory):
         return {'step': 'integration', 'success': False, 'reason': 'Required files missing'}
     else:
-        info = xds.parse_integrate()
-        programs.xdsstat('XDS_ASCII.HKL')
-        stat_info = xds.parse_xdsstat()
+        info = xds.parse_integrate(os.path.join(directory, 'INTEGRATE.LP'))
+        run_xdsstat(directory)
+        stat_info = xds.parse_xdsstat(os.path.join(directory, 'XDSSTAT.LP'))
         info.update(stat_info)
 
     if info.get('failure') is None:
@@ -98,7 +209,10 @@ def harvest_correct():
 
 def correct(data_info, options=None):
     options = options or {}
-    os.chdir(data_info['working_directory'])
+    if data_info.get('trials'):
+        return correct_trials(data_info, options)
+    directory = data_info['working_directory']
+    correct_file = os.path.join(directory, 'CORRECT.LP')
     message = options.get('message', "Applying corrections to")
     step_descr = '{} dataset "{}" for space-group {}'.format(
         message,
@@ -108,25 +222,25 @@ def correct(data_info, options=None):
     run_info = {'mode': options.get('mode')}
     run_info.update(data_info)
 
-    if not misc.file_requirements('INTEGRATE.HKL', 'X-CORRECTIONS.cbf', 'Y-CORRECTIONS.cbf'):
+    if not misc.file_requirements('INTEGRATE.HKL', 'X-CORRECTIONS.cbf', 'Y-CORRECTIONS.cbf', directory=directory):
         return {'step': 'correction', 'success': False, 'reason': 'Required files missing'}
 
     if options.get('backup', False):
-        misc.backup_files('XDS_ASCII.HKL', 'CORRECT.LP')
-    xdsio.write_xds_input("CORRECT", run_info)
+        misc.backup_files('XDS_ASCII.HKL', 'CORRECT.LP', directory=directory)
+    xdsio.write_xds_input("CORRECT", run_info, directory=directory)
 
     try:
-        programs.xds_par(step_descr)
-        info = xds.parse_correct()
+        programs.xds_par(step_descr, directory=directory)
+        info = xds.parse_correct(correct_file)
 
         # enable correction factors if anomalous data and repeat correction
         if info.get('correction_factors') is not None and options.get('anomalous', False):
             for f in info['correction_factors'].get('factors', []):
                 if abs(f['chi_sq_fit'] - 1.0) > 0.25:
                     run_info.update({'strict_absorption': True})
-                    xdsio.write_xds_input("CORRECT", run_info)
-                    programs.xds_par()
-                    info = xds.parse_correct()
+                    xdsio.write_xds_input("CORRECT", run_info, directory=directory)
+                    programs.xds_par(directory=directory)
+                    info = xds.parse_correct(correct_file)
                     info['strict_absorption'] = True
                     break
 
@@ -137,8 +251,8 @@ def correct(data_info, options=None):
             sub_dir = os.path.relpath(data_info['working_directory'], options.get('directory', ''))
             info['output_file'] = os.path.join(sub_dir, 'XDS_ASCII.HKL')
 
-        programs.xdsstat('XDS_ASCII.HKL')
-        stat_info = xds.parse_xdsstat()
+        run_xdsstat(directory)
+        stat_info = xds.parse_xdsstat(os.path.join(directory, 'XDSSTAT.LP'))
         info.update(stat_info)
 
     except autoprocess.errors.ProcessError as e:
@@ -151,3 +265,100 @@ def correct(data_info, options=None):
         return {'step': 'correction', 'success': True, 'data': info}
     else:
         return {'step': 'correction', 'success': False, 'reason': info['failure']}
+
+
+def select_trial(trials):
+    """
+    Select a space group from correction trials. The first trial, in order of preference, whose low-resolution
+    R-meas is not significantly worse than that of the best trial is selected.
+
+    :param trials: list of trial summaries in order of preference
+    :return: index of the selected trial or None if all trials failed
+    """
+    r_values = [trial['r_meas'] for trial in trials if trial['success']]
+    if not r_values:
+        return
+    limit = min(r_values) * TRIAL_R_RATIO + TRIAL_R_MARGIN
+    for i, trial in enumerate(trials):
+        if trial['success'] and trial['r_meas'] <= limit:
+            return i
+
+
+def correct_trials(data_info, options=None):
+    """
+    Apply corrections for several candidate space groups concurrently, each in a scratch copy of the
+    working directory, and keep the results of the best candidate.
+
+    :param data_info: dataset parameters, 'trials' is a list of dictionaries with 'space_group', 'unit_cell'
+        and 'reindex_matrix' of each candidate in order of preference
+    :param options: processing options
+    """
+    options = options or {}
+    directory = data_info['working_directory']
+    candidates = data_info['trials']
+    names = ', '.join(xtal.SG_SYMBOLS[candidate['space_group']] for candidate in candidates)
+    logger.info(f'Trying {len(candidates):d} space groups for dataset "{data_info["name"]}": {names}')
+
+    inputs = XDS_JOB_FILES['CORRECT'][0]
+    scratch_dirs = []
+    trial_infos = []
+    # the trials run side by side within the processors available to the dataset
+    share = data_info.get('processors') or programs.EXECUTOR.slots.size
+    processors = max(1, share // len(candidates))
+    for candidate in candidates:
+        scratch = tempfile.mkdtemp(prefix='sg{}-'.format(candidate['space_group']), dir=directory)
+        misc.link_files(directory, scratch, inputs)
+        trial_info = dict(data_info, working_directory=scratch, trials=None, processors=processors)
+        trial_info.update(candidate)
+        scratch_dirs.append(scratch)
+        trial_infos.append(trial_info)
+
+    trial_options = dict(options, backup=False)
+    with ThreadPoolExecutor(max_workers=len(trial_infos)) as executor:
+        outputs = list(executor.map(ledger.bind(lambda info: correct(info, trial_options)), trial_infos))
+
+    trials = []
+    for candidate, out in zip(candidates, outputs):
+        trial = {
+            'sg_number': candidate['space_group'],
+            'sg_name': xtal.SG_SYMBOLS[candidate['space_group']],
+            'unit_cell': candidate['unit_cell'],
+            'reindex_matrix': candidate['reindex_matrix'],
+            'success': out['success'],
+            'selected': False,
+        }
+        if out['success']:
+            summary = out['data']['summary']
+            trial.update({
+                'r_meas': summary['inner_shell']['r_meas'],
+                'i_sigma': summary['inner_shell']['i_sigma'],
+                'completeness': summary['completeness'],
+                'ISa': summary.get('ISa', -1),
+            })
+            logger.info(log.log_value(
+                f'Low-res R-meas in {trial["sg_name"]}:', f'{trial["r_meas"]:0.1f} %'
+            ))
+        else:
+            trial['reason'] = out['reason']
+        trials.append(trial)
+
+    selected = select_trial(trials)
+    if selected is not None:
+        # move the results of the selected trial into the working directory
+        misc.move_files(scratch_dirs[selected], directory, TRIAL_OUTPUTS)
+        trials[selected]['selected'] = True
+    for scratch in scratch_dirs:
+        programs.append_log(scratch, directory)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if selected is None:
+        return outputs[0]
+
+    out = outputs[selected]
+    if data_info['working_directory'] == options.get('directory'):
+        out['data']['output_file'] = 'XDS_ASCII.HKL'
+    else:
+        sub_dir = os.path.relpath(data_info['working_directory'], options.get('directory', ''))
+        out['data']['output_file'] = os.path.join(sub_dir, 'XDS_ASCII.HKL')
+    out['data']['trials'] = trials
+    return out
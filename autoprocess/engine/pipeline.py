@@ -0,0 +1,184 @@
+"""
+Dependency graph of processing tasks and a ready-queue scheduler to run them.
+
+"""
+from collections import OrderedDict
+from concurrent.futures import wait, FIRST_COMPLETED
+
+from autoprocess.utils import ledger, log
+
+logger = log.get_module_logger(__name__)
+
+
+class Task(object):
+    """
+    A node of the processing graph.
+
+    :param key: unique name of the task
+    :param prepare: function called in the calling thread once all requirements are complete. It returns a tuple
+        (function, args) of the work to do.
+    :param finish: function called in the calling thread with the result of the work, returns True if the task
+        succeeded.
+    :param requires: keys of tasks which must complete successfully before this one can start
+    :param resource: tasks sharing the same resource, typically a directory where fixed file names
+        are written, never run at the same time
+    :param remote: whether the work can be run by a worker of the executor
+    :param phase: processing step this task belongs to, used for reporting the position within the run
+    :param index: index of the dataset this task operates on
+    """
+
+    def __init__(self, key, prepare, finish=None, requires=(), resource=None, remote=True, phase=None, index=0):
+        self.key = key
+        self.prepare = prepare
+        self.finish = finish
+        self.requires = set(requires)
+        self.resource = resource
+        self.remote = remote
+        self.phase = phase or key
+        self.index = index
+        self.usage = None
+
+    def __repr__(self):
+        return '<Task: {}>'.format(self.key)
+
+
+def measure(key, function, *args):
+    """
+    Run the work of a task and return a tuple of the result and the resources used
+    """
+    with ledger.track(key) as usage:
+        result = function(*args)
+    return result, usage
+
+
+class Pipeline(object):
+    """
+    A directed acyclic graph of tasks. Tasks are started as soon as all their requirements are complete
+    and their resource is free. Remote tasks are submitted to an executor if one is provided
+    while local tasks and all tasks without an executor are run in the calling thread. The resources
+    used by each task are available as `task.usage` once it is finished.
+    """
+
+    def __init__(self):
+        self.tasks = OrderedDict()
+
+    def add(self, task):
+        if task.key in self.tasks:
+            raise ValueError('Duplicate task: {}'.format(task.key))
+        self.tasks[task.key] = task
+        return task
+
+    def __contains__(self, key):
+        return key in self.tasks
+
+    def __iter__(self):
+        return iter(self.tasks.values())
+
+    def validate(self):
+        """
+        Check that all requirements exist and that the graph has no cycles
+        """
+        for task in self:
+            missing = task.requires - set(self.tasks)
+            if missing:
+                raise ValueError('Task {} requires unknown tasks: {}'.format(task.key, ', '.join(sorted(missing))))
+
+        visited = set()
+        for task in self:
+            if task.key in visited:
+                continue
+            stack = [(task.key, iter(sorted(task.requires)))]
+            path = {task.key}
+            while stack:
+                key, children = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    stack.pop()
+                    path.discard(key)
+                    visited.add(key)
+                elif child in path:
+                    raise ValueError('Cyclic dependency between tasks {} and {}'.format(key, child))
+                elif child not in visited:
+                    path.add(child)
+                    stack.append((child, iter(sorted(self.tasks[child].requires))))
+
+    def pending(self, completed):
+        """
+        Return the list of tasks which are not yet complete in insertion order
+        """
+        return [task for task in self if task.key not in completed]
+
+    def run(self, completed=(), executor=None, workers=1, callback=None, measured=None):
+        """
+        Run all incomplete tasks of the graph.
+
+        :param completed: keys of tasks which are already complete
+        :param executor: optional concurrent.futures executor for remote tasks
+        :param workers: maximum number of remote tasks to run at the same time
+        :param callback: function(task, success) called in the calling thread after each task
+        :param measured: function(task) called in the calling thread once the work of a task is done and its usage
+            is known, before the finish function of the task
+        :return: set of keys of completed tasks
+        """
+        self.validate()
+        completed = set(completed)
+        failed = set()
+        pending = self.pending(completed)
+        running = {}
+        busy = set()
+
+        def _finish(task, output):
+            result, task.usage = output
+            if measured:
+                measured(task)
+            success = True if task.finish is None else task.finish(result)
+            if success is False:
+                failed.add(task.key)
+            else:
+                completed.add(task.key)
+            if callback:
+                callback(task, success is not False)
+
+        while pending or running:
+            # tasks are started in insertion order so the sequential order is deterministic
+            ready = [
+                task for task in pending
+                if task.requires <= completed and (task.resource is None or task.resource not in busy)
+            ]
+            blocked = [task for task in pending if task.requires & failed]
+            for task in blocked:
+                logger.warning('Skipping "{}", a required step failed.'.format(task.key))
+                pending.remove(task)
+                failed.add(task.key)
+
+            started = False
+            for task in ready:
+                if task.key in failed or (task.resource is not None and task.resource in busy):
+                    continue
+                if task.remote and executor is not None:
+                    if len(running) >= workers:
+                        continue
+                    function, args = task.prepare()
+                    running[executor.submit(measure, task.key, function, *args)] = task
+                    if task.resource is not None:
+                        busy.add(task.resource)
+                    pending.remove(task)
+                    started = True
+                else:
+                    # local task, runs in the calling thread. Run only one before checking remote tasks again
+                    function, args = task.prepare()
+                    pending.remove(task)
+                    _finish(task, measure(task.key, function, *args))
+                    started = True
+                    break
+
+            if running and not started:
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    busy.discard(task.resource)
+                    _finish(task, future.result())
+            elif not running and not started and pending:
+                raise RuntimeError('Unable to schedule tasks: {}'.format(', '.join(t.key for t in pending)))
+
+        return completed
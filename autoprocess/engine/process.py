@@ -1,19 +1,19 @@
 import copy
-import gzip
 import os
 import subprocess
 import sys
 import time
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import msgpack
 
 
 import autoprocess.errors
 from autoprocess import version
 from autoprocess.engine import indexing, spots, integration, scaling, solver, reporting
 from autoprocess.engine import symmetry, strategy, conversion
-from autoprocess.utils import dataset, misc, log, xtal
+from autoprocess.engine.pipeline import Pipeline, Task
+from autoprocess.utils import dataset, ledger, misc, log, programs, xtal
 
 logger = log.get_module_logger(__name__)
 
@@ -41,9 +41,47 @@ HARVEST_FUNCTIONS = {
     'correction': integration.harvest_correct,
 }
 
+# Order of processing phases, used to determine which steps to repeat when resuming from a given step
+PHASES = [
+    'initialize', 'spot_search', 'indexing', 'integration', 'correction', 'symmetry', 'scaling', 'strategy',
+    'data_quality', 'conversion', 'solve-small', 'reporting'
+]
+
+# Per-dataset phases which are resumed together
+PHASE_GROUPS = {
+    'initialize': 1, 'spot_search': 1, 'indexing': 1,
+    'integration': 2, 'correction': 2,
+}
+
 THICK_LINE = '*' * 79
 THIN_LINE = '-' * 79
 
+
+def execute_step(step, dset, options, overwrite=None, colonize=False):
+    """
+    Run the specified step for the dataset with optional overwritten parameters and
+    return the output dictionary without recording it in the dataset object.
+
+    """
+    overwrite = overwrite or {}
+
+    step_parameters = {}
+    step_parameters.update(dset.parameters)
+    step_parameters.update(overwrite)
+    if options.get('core_share'):
+        # datasets processed concurrently divide the processors between them
+        step_parameters.setdefault('processors', options['core_share'])
+
+    if colonize and step in HARVEST_FUNCTIONS:
+        out = HARVEST_FUNCTIONS[step](dset.parameters['working_directory'])
+    elif step == 'symmetry':
+        # symmetry needs an extra parameter
+        out = STEP_FUNCTIONS[step](step_parameters, dset, options)
+    else:
+        out = STEP_FUNCTIONS[step](step_parameters, options)
+    return out
+
+
 class DataSet(object):
     def __init__(self, filename=None, info=None, overwrites=None):
         overwrites = {} if overwrites is None else overwrites
@@ -58,6 +96,7 @@ class DataSet(object):
         else:
             raise autoprocess.errors.DatasetError('Filename/parameters not specified')
         self.name = self.parameters['name']
+        self.changes = {'parameters': None, 'results': None}
 
     def __str__(self):
         return "<DataSet: %s, %s, first=%d, n=%d>" % (self.name, self.parameters['file_template'],
@@ -89,6 +128,29 @@ class DataSet(object):
         self.parameters = info.get('parameters')
         self.log = info.get('log', [])
         self.results = info.get('results', {})
+        self.changes = {'parameters': None, 'results': None}
+
+    def mark(self, section=None, *keys):
+        """
+        Mark values as changed since the last checkpoint, so that only those are compared when saving
+        the next one. The whole section is marked if no keys are given, and the whole dataset if no
+        section is given.
+
+        :param section: 'parameters' or 'results'
+        :param keys: changed keys of the section
+        """
+        for name in ([section] if section else ['parameters', 'results']):
+            if keys and self.changes.get(name, set()) is not None:
+                self.changes.setdefault(name, set()).update(keys)
+            else:
+                self.changes[name] = None
+
+    def take_changes(self):
+        """
+        Return the values marked as changed since the last call and clear the marks
+        """
+        changes, self.changes = self.changes, {}
+        return changes
 
     def score(self):
 
@@ -123,6 +185,7 @@ class DataSet(object):
             resolution, completeness, r_meas, i_sigma, mosaicity, stdev_spot, stdev_spindle, rejected_fraction
         )
         self.results['crystal_score'] = score
+        self.mark('results', 'crystal_score')
         logger.debug('Scoring Details:')
         for name, quality, val in scores:
             logger.debug('\t{:>20}:\t[{:g}] {:5.2f}'.format(name, val, quality))
@@ -135,8 +198,15 @@ class Manager(object):
 
         self.datasets = OrderedDict()
 
+        self.pipeline = None
+        self.journal = None
+        self.usage = OrderedDict()
+        self.changed_usage = set()
+
         if checkpoint is not None:
             self.run_position = checkpoint['run_position']
+            self.completed = checkpoint.get('completed')
+            self.usage.update((record['task'], record) for record in checkpoint.get('usage', []))
             self.options = checkpoint['options']
             self.options['command_dir'] = os.path.abspath(os.getcwd())
 
@@ -146,6 +216,7 @@ class Manager(object):
 
         elif options is not None:
             self.run_position = (0, 'initialize')
+            self.completed = None
             self.options = options
             self.options['command_dir'] = os.path.abspath(os.getcwd())
 
@@ -203,24 +274,34 @@ class Manager(object):
                 misc.prepare_dir(dset.parameters['working_directory'])
             else:
                 dset.parameters['working_directory'] = self.options['directory']
+            dset.mark('parameters', 'working_directory')
 
-    def save_checkpoint(self):
+    def save_checkpoint(self, compact=False):
         """
         Save a checkpoint file to use for resuming or repeating auto-processing
-        steps.
+        steps. Only the changes since the previous save are appended to the checkpoint
+        journal unless a compact snapshot is requested.
         
         """
 
         info = {
             'options': self.options,
             'run_position': self.run_position,
+            'completed': sorted(self.completed) if self.completed is not None else None,
+            'usage': list(self.usage.values()),
             'datasets': [d.get_info() for d in list(self.datasets.values())]
         }
 
         # Checkpoint file is saved in top-level processing directory
         fname = os.path.join(self.options['directory'], 'process.chkpt')
-        with gzip.open(fname, 'wb') as handle:
-            msgpack.dump(info, handle, default=str) #msgpack_numpy.encode
+        if self.journal is None or self.journal.filename != fname:
+            self.journal = misc.CheckpointJournal(fname)
+        changes = {
+            'datasets': {dset.name: dset.take_changes() for dset in self.datasets.values()},
+            'usage': self.changed_usage,
+        }
+        self.changed_usage = set()
+        self.journal.save(info, compact=compact, changes=changes)
 
         return info
 
@@ -232,43 +313,585 @@ class Manager(object):
         Will exit the program if a non optional step fails.
         
         """
-        overwrite = overwrite or {}
+        key = '{}:{}'.format(step, dset.name)
+        with ledger.track(key) as usage:
+            out = execute_step(step, dset, self.options, overwrite=overwrite, colonize=colonize)
+        self.record_usage(key, step, usage)
+        self.record_step(step, dset, out, optional=optional)
+        self.save_checkpoint()
 
-        step_parameters = {}
-        step_parameters.update(dset.parameters)
-        step_parameters.update(overwrite)
+    def record_step(self, step, dset, out, optional=False):
+        """
+        Record the output of a step in the dataset object.
 
-        if colonize and step in HARVEST_FUNCTIONS:
-            out = HARVEST_FUNCTIONS[step]
-        else:
-            # symmetry needs an extra parameter
-            if step == 'symmetry':
-                out = STEP_FUNCTIONS[step](step_parameters, dset, self.options)
-            else:
-                out = STEP_FUNCTIONS[step](step_parameters, self.options)
+        Will save a checkpoint and exit the program if a non optional step fails.
+
+        """
 
         dset.log.append((time.time(), out['step'], out['success'], out.get('reason', None)))
         if out.get('data') is not None:
             dset.results[step] = out.get('data')
-        self.save_checkpoint()
+            dset.mark('results', step)
 
         if not out['success']:
             if optional:
                 logger.warning('Failed ({}): {}'.format(out['step'], out['reason']))
             else:
                 logger.error('Failed ({}): {}'.format(out['step'], out['reason']))
+                self.save_checkpoint()
                 sys.exit(1)
 
+    def record_usage(self, key, step, usage):
+        """
+        Record the resources used by a task, replacing those of a previous run of the same task
+
+        :param key: task key
+        :param step: processing step
+        :param usage: usage record from the ledger
+        """
+        record = {'task': key, 'step': step}
+        record.update(usage)
+        self.usage.pop(key, None)
+        self.usage[key] = record
+        self.changed_usage.add(key)
+
+    def get_executor(self):
+        """
+        Return a thread pool for running steps concurrently or None if steps should be run one
+        at a time. Steps run their programs within the working directory of each dataset, so several
+        datasets can be processed by threads of the same process. Spinners from several threads would
+        garble the terminal so they are disabled. Each dataset is limited to its share of the processors.
+
+        """
+        workers = self.options.get('workers', 1) or 1
+        concurrent = min(workers, len(self.datasets))
+        self.options.pop('core_share', None)
+        if concurrent > 1:
+            self.options['core_share'] = max(1, programs.EXECUTOR.slots.size // concurrent)
+        if workers > 1:
+            programs.SHOW_SPINNER = False
+            return ThreadPoolExecutor(max_workers=workers)
+
+    def step_task(self, step, i, dset, requires=(), key=None, phase=None, overwrite=None, colonize=False,
+                  prepare=None, finish=None):
+        """
+        Create a pipeline task for running a step on a single dataset
+
+        :param step: name of step in STEP_FUNCTIONS
+        :param i: index of the dataset
+        :param dset: DataSet instance
+        :param requires: keys of required tasks
+        :param key: task key, defaults to "<step>:<dataset name>"
+        :param phase: processing phase, defaults to the step name
+        :param overwrite: overwrite parameters for the step
+        :param colonize: harvest results of previous runs instead of running the step
+        :param prepare: optional function returning extra overwrite parameters, called just before running the step
+        :param finish: optional function(step, dset) called after the results have been recorded
+        :return: Task instance
+        """
+
+        def _prepare():
+            step_ovw = {}
+            step_ovw.update(overwrite or {})
+            if prepare:
+                step_ovw.update(prepare())
+            return execute_step, (step, dset, self.options, step_ovw, colonize)
+
+        def _finish(out):
+            self.record_step(step, dset, out)
+            if finish:
+                finish(step, dset)
+            return out['success']
+
+        task = Task(
+            key or '{}:{}'.format(step, dset.name), _prepare, _finish, requires=requires,
+            resource=dset.parameters['working_directory'], phase=phase or step, index=i,
+        )
+        return task
+
+    def build_pipeline(self, overwrite=None, colonize=False):
+        """
+        Build the dependency graph of all processing steps for the current mode.
+
+        Steps of a dataset depend only on earlier steps of the same dataset, except for reference-based
+        correction in merge and MAD modes which depends on correction of the previous dataset, and steps
+        which operate on all datasets together such as preparation of the reference and scaling.
+        """
+
+        overwrite = overwrite or {}
+        mode = self.options.get('mode')
+        directory = self.options['directory']
+        pipeline = Pipeline()
+
+        # 'combined' merged dataset is special
+        dsets = [
+            (i, dset) for i, dset in enumerate(self.datasets.values())
+            if not (dset.name == 'combined' and mode == 'merge')
+        ]
+
+        # initialize, index and integrate each dataset
+        for i, dset in dsets:
+            requires = []
+            if self.options.get('live') and not colonize:
+                # wait for the first wedge of frames to be collected
+                task = pipeline.add(Task(
+                    'frames:{}'.format(dset.name), lambda dset=dset: self.first_wedge_work(dset),
+                    lambda out, dset=dset: self.update_first_wedge(dset, out),
+                    resource=dset.parameters['working_directory'], phase='initialize', index=i
+                ))
+                requires = [task.key]
+            for step in ['initialize', 'spot_search', 'indexing', 'integration']:
+                task = pipeline.add(self.step_task(
+                    step, i, dset, requires=requires, overwrite=overwrite, colonize=colonize,
+                    finish=self.update_frames if step == 'integration' else self.update_lattice
+                ))
+                requires = [task.key]
+                if step == 'indexing' and mode == 'screen' and self.options.get('triage'):
+                    # stop screening early if the crystal is clearly unusable
+                    task = pipeline.add(Task(
+                        'triage:{}'.format(dset.name), lambda dset=dset: (indexing.triage, (
+                            dset.results['indexing'], self.options
+                        )), lambda out, dset=dset: self.check_triage(dset, out), requires=requires,
+                        remote=False, phase='indexing', index=i
+                    ))
+                    requires = [task.key]
+
+        # correction
+        previous = None
+        for i, dset in dsets:
+            requires = ['integration:{}'.format(dset.name)]
+            if mode in ['merge', 'mad'] and previous is not None:
+                # reference based correction must wait for the previous dataset
+                requires.append(previous)
+            task = pipeline.add(self.step_task(
+                'correction', i, dset, requires=requires, overwrite=overwrite, colonize=colonize,
+                prepare=lambda i=i: self.reference_overwrite(i), finish=self.check_correction
+            ))
+            previous = task.key
+
+        # Check Spacegroup and reindex the datasets
+        corrections = ['correction:{}'.format(dset.name) for i, dset in dsets]
+        sg_overwrite = overwrite.get('sg_overwrite')
+        if sg_overwrite is None and mode in ['merge', 'mad']:
+            ref_opts = {}
+            ref_opts.update(self.options)
+            ref_opts.update(overwrite)
+            pipeline.add(Task(
+                'reference', lambda: (scaling.prepare_reference, (self.datasets, ref_opts)),
+                self.set_reference, requires=corrections, resource=directory, remote=False, phase='symmetry'
+            ))
+
+        for i, dset in dsets:
+            if sg_overwrite is not None:
+                requires = ['correction:{}'.format(dset.name)]
+            elif mode in ['merge', 'mad']:
+                requires = ['reference']
+            else:
+                # automatic spacegroup determination
+                task = pipeline.add(self.step_task(
+                    'symmetry', i, dset, requires=['correction:{}'.format(dset.name)], colonize=colonize
+                ))
+                requires = [task.key]
+            pipeline.add(self.step_task(
+                'correction', i, dset, requires=requires, key='reindex:{}'.format(dset.name), phase='symmetry',
+                overwrite=overwrite, colonize=colonize, finish=self.check_refinement,
+                prepare=lambda dset=dset: self.reindex_overwrite(dset, sg_overwrite)
+            ))
+
+        reindexed = ['reindex:{}'.format(dset.name) for i, dset in dsets]
+        if mode == 'screen':
+            outputs = [dset.name for i, dset in dsets]
+            for i, dset in dsets:
+                pipeline.add(self.step_task(
+                    'strategy', i, dset, requires=['reindex:{}'.format(dset.name)], overwrite=overwrite,
+                    colonize=colonize, finish=self.show_strategy,
+                    prepare=lambda dset=dset: self.strategy_overwrite(dset, overwrite)
+                ))
+                pipeline.add(Task(
+                    'score:{}'.format(dset.name), lambda name=dset.name: (self.final_score, (name,)),
+                    requires=['strategy:{}'.format(dset.name)], remote=False, phase='data_quality', index=i
+                ))
+            return pipeline
+
+        pipeline.add(Task(
+            'scaling', lambda: (self.scale_datasets, (overwrite,)), requires=reindexed, resource=directory,
+            remote=False, phase='scaling'
+        ))
+
+        # Only calculate quality and convert formats for 'combined' dataset when merging.
+        if mode == 'merge':
+            outputs = ['combined']
+        else:
+            outputs = [dset.name for i, dset in dsets]
+
+        for i, name in enumerate(outputs):
+            pipeline.add(Task(
+                'data_quality:{}'.format(name), lambda name=name: self.quality_work(name),
+                lambda out, name=name: self.check_quality(name, out), requires=['scaling'],
+                resource=('xtriage', directory), phase='data_quality', index=i
+            ))
+            pipeline.add(Task(
+                'score:{}'.format(name), lambda name=name: (self.final_score, (name,)),
+                requires=['data_quality:{}'.format(name)], remote=False, phase='data_quality', index=i
+            ))
+            pipeline.add(Task(
+                'conversion:{}'.format(name), lambda name=name: self.conversion_work(name),
+                lambda out, name=name: self.check_conversion(name, out), requires=['scaling'],
+                phase='conversion', index=i
+            ))
+
+        if self.options.get('solve-small'):
+            name = outputs[0]
+            pipeline.add(Task(
+                'solve-small', lambda: self.solver_work(name), requires=['conversion:{}'.format(name)],
+                resource=('shelx', directory), phase='solve-small'
+            ))
+
+        return pipeline
+
+    def update_lattice(self, step, dset):
+        """
+        Special post processing after indexing, updates parameters with reduced cell and the run
+        parameters used for the solution
+        """
+        if step != 'indexing':
+            return
+        parameters = {
+            'unit_cell': dset.results['indexing']['parameters']['unit_cell'],
+            'space_group': dset.results['indexing']['parameters']['sg_number'],
+        }
+        # run parameters changed by indexing remedies
+        parameters.update(dset.results['indexing'].get('run_parameters', {}))
+        dset.parameters.update(parameters)
+        dset.mark('parameters', *parameters)
+        r_cell = "{:0.2f} {:0.2f} {:0.2f} {:0.2f} {:0.2f} {:0.2f}".format(
+            *dset.results['indexing']['parameters']['unit_cell']
+        )
+        xter_list = [v['character'] for v in dset.results['indexing']['lattices']]
+        p_groups = ", ".join(xtal.get_pg_list(xter_list, chiral=self.options.get('chiral', True)))
+        logger.info(log.log_value(f'Reduced Cell for "{dset.name}":', r_cell))
+        logger.info(log.log_value(f'Point Groups for "{dset.name}":', p_groups))
+
+    def check_triage(self, dset, out):
+        """
+        Record the triage of a screened dataset, returns False if screening should stop
+        """
+        dset.results['triage'] = out
+        dset.mark('results', 'triage')
+        logger.info(log.log_value(f'Indexing Score for "{dset.name}":', f'{out["score"]:0.2f}'))
+        for detail in out['details']:
+            logger.debug('\t{:>20}:\t[{:g}] {:5.2f}'.format(detail['name'], detail['value'], detail['quality']))
+        if out['abort']:
+            dset.log.append((time.time(), 'triage', False, 'Crystal rejected after indexing'))
+            logger.warning(
+                f'Screening of "{dset.name}" stopped, indexing score below {out["minimum"]:0.2f}: '
+                f'{", ".join(out["problems"]) or "poor indexing statistics"}'
+            )
+            return False
+        return True
+
+    def first_wedge_work(self, dset):
+        """
+        Work for waiting until the first wedge of frames of a dataset being collected is on disk
+        """
+        first_frame = dset.parameters['first_frame']
+        count = max(1, int(round(self.options.get('live_chunk', 10.0) / dset.parameters['delta_angle'])))
+        logger.info(f'Waiting for the first {count:d} frames of dataset "{dset.name}" ...')
+        return dataset.wait_for_frames, (
+            dset.parameters['file_template'], first_frame, first_frame + count - 1,
+            self.options.get('live_timeout', 60.0)
+        )
+
+    def update_first_wedge(self, dset, out):
+        """
+        Restrict the frame ranges of a dataset being collected to the frames available
+        """
+        frames, complete = out
+        if not frames:
+            logger.error(f'No frames found for dataset "{dset.name}"')
+            return False
+        parameters = dataset.frame_parameters(dset.parameters, frames)
+        dset.parameters.update(parameters)
+        dset.mark('parameters', *parameters)
+        frame_range = '{} - {}'.format(*dset.parameters['data_range'])
+        logger.info(log.log_value(f'Initial frames for "{dset.name}":', frame_range))
+        return True
+
+    def update_frames(self, step, dset):
+        """
+        Update frame ranges after integrating a dataset which was still being collected
+        """
+        frames = dset.results['integration'].get('frames')
+        if frames:
+            dset.parameters.update(frames)
+            dset.mark('parameters', *frames)
+
+    def check_correction(self, step, dset):
+        """
+        Special post processing after correction, summarizes the quality of the dataset
+        """
+        ISa = dset.results['correction']['correction_factors']['parameters'].get('ISa', -1)
+        r_meas = dset.results['correction']['summary']['inner_shell']['r_meas']
+        i_sigma = dset.results['correction']['summary']['inner_shell']['i_sigma']
+        logger.info(log.log_value(
+            'Low-res R-meas for "{}"'.format(dset.name),
+            f'{r_meas:0.1f} %'
+        ))
+        logger.info(log.log_value(
+            'Low-res I/Sigma for "{}"'.format(dset.name),
+            f'{i_sigma:0.1f}'
+        ))
+        if ISa >= 0:
+            logger.info(log.log_value(
+                'I/Sigma(I) Asymptote [ISa] for dataset "{}":'.format(dset.name),
+                f'{ISa:0.1f}'
+            ))
+        dset.results['integration']['statistics'] = copy.deepcopy(dset.results['correction'])
+        dset.mark('results', 'integration')
+
+    def check_refinement(self, step, dset):
+        """
+        Special post processing after reindexing and refinement
+        """
+        for trial in dset.results['correction'].get('trials', []):
+            if trial['selected'] and trial['sg_number'] != dset.results['symmetry']['sg_number']:
+                logger.warning(f'Space group {trial["sg_name"]} selected instead of '
+                               f'{xtal.SG_SYMBOLS[dset.results["symmetry"]["sg_number"]]} for "{dset.name}"')
+                dset.results['symmetry'].update({
+                    'sg_number': trial['sg_number'],
+                    'sg_name': trial['sg_name'],
+                    'unit_cell': trial['unit_cell'],
+                    'reindex_matrix': trial['reindex_matrix'],
+                    'character': xtal.get_character(trial['sg_number']),
+                })
+                dset.mark('results', 'symmetry')
+        cell_str = "{:0.6g} {:0.6g} {:0.6g} {:0.6g} {:0.6g} {:0.6g}".format(
+            *dset.results['correction']['summary']['unit_cell']
+        )
+        logger.info(log.log_value(
+            f'Refined unit cell for for "{dset.name}":', cell_str
+        ))
+
+        if self.options.get('mode') in ['merge']:
+            logger.info(log.log_value(f'Initial Score for dataset "{dset.name}"', f"{dset.score():0.2f}"))
+
+    def reference_overwrite(self, i):
+        """
+        Reference data parameters for correcting dataset i against the previous dataset in merge and MAD modes
+        """
+        if i > 0 and self.options.get('mode') in ['merge', 'mad']:
+            dsets = list(self.datasets.values())
+            ref_file = os.path.join('..', dsets[i - 1].results['correction']['output_file'])
+            ref_sg = dsets[0].results['correction']['summary']['spacegroup']
+            return {'reference_data': ref_file, 'reference_spacegroup': ref_sg}
+        return {}
+
+    def set_reference(self, ref_info):
+        """
+        Transfer symmetry info from the reference to all datasets
+        """
+        for dset in self.datasets.values():
+            dset.results['symmetry'] = copy.deepcopy(ref_info)
+            dset.mark('results', 'symmetry')
+        return True
+
+    def reindex_overwrite(self, dset, sg_number=None):
+        """
+        Parameters for reindexing a dataset into the selected space group
+        """
+        if sg_number is None and self.options.get('mode') in ['merge', 'mad']:
+            # symmetry info transferred from the reference
+            sg_number = dset.results['symmetry']['sg_number']
+
+        if sg_number is not None:
+            # update transferred symmetry info with the specific reindex matrix of this dataset
+            ref_sginfo = symmetry.get_symmetry_params(sg_number, dset)
+            dset.results.setdefault('symmetry', {}).update(ref_sginfo)
+            dset.mark('results', 'symmetry')
+        else:
+            ref_sginfo = dset.results['symmetry']
+
+        step_ovw = {
+            'space_group': ref_sginfo['sg_number'],
+            'unit_cell': ref_sginfo['unit_cell'],
+            'reindex_matrix': ref_sginfo['reindex_matrix'],
+            'message': 'Reindexing & refining',
+        }
+        if sg_number is None and self.options.get('sg_trials', 1) > 1:
+            step_ovw['trials'] = self.trial_candidates(dset, self.options['sg_trials'])
+        return step_ovw
+
+    def trial_candidates(self, dset, count):
+        """
+        Reindexing parameters for the top space group candidates of a dataset, starting with the selected one
+
+        :param dset: DataSet instance
+        :param count: maximum number of candidates
+        :return: list of dictionaries
+        """
+        selected = dset.results['symmetry']['sg_number']
+        numbers = [selected] + [
+            candidate['number'] for candidate in
+            sorted(dset.results['symmetry']['candidates'], key=lambda c: c['probability'], reverse=True)
+            if candidate['number'] != selected
+        ]
+        trials = []
+        for number in numbers:
+            if len(trials) >= count:
+                break
+            sg_info = symmetry.get_symmetry_params(number, dset)
+            if 'reindex_matrix' in sg_info:
+                trials.append({
+                    'space_group': number,
+                    'unit_cell': sg_info['unit_cell'],
+                    'reindex_matrix': sg_info['reindex_matrix'],
+                })
+        return trials
+
+    def strategy_overwrite(self, dset, overwrite):
+        if 'resolution' not in overwrite:
+            return {'resolution': dset.results['integration']['statistics']['summary']['stderr_resolution']}
+        return {}
+
+    def show_strategy(self, step, dset):
+        strategy = reporting.get_strategy(dset.results)
+        strategy_table = misc.sTable([
+            ['Recommended Strategy', ''],
+            ['Resolution', '{:0.2f}'.format(strategy['resolution'])],
+            ['Attenuation', '{:0.1f}'.format(strategy['attenuation'])],
+            ['Start Angle', '{:0.0f}'.format(strategy['start_angle'])],
+            ['Maximum Delta Angle', '{:0.2f}'.format(strategy['max_delta'])],
+            ['Minimum Angle Range', '{:0.1f}'.format(strategy['total_angle'])],
+            ['Exposure Rate (deg/sec)', '{:0.2f}'.format(strategy['exposure_rate'])],
+            ['Overlaps?', strategy['overlaps']],
+        ])
+        strategy_table.table.align[''] = 'r'
+        for line in str(strategy_table).splitlines():
+            logger.info(line)
+
+    def scale_datasets(self, overwrite):
+        logger.info(THIN_LINE)
+        step_ovw = {}
+        step_ovw.update(self.options)
+        step_ovw.update(overwrite)
+        if self.options.get('mode') == 'merge' and 'combined' in self.datasets:
+            # 'combined' merged dataset is special remove it before scaling
+            self.datasets.pop('combined', None)
+        out = scaling.scale_datasets(self.datasets, step_ovw)
+        for dset in self.datasets.values():
+            dset.mark('results', 'scaling')
+        if not out['success']:
+            logger.error(f'Failed ({out["step"]}): {out["reason"]}')
+            self.save_checkpoint()
+            sys.exit()
+        return out
+
+    def quality_work(self, name):
+        dset = self.datasets[name]
+        logger.info(THIN_LINE)
+        logger.info(f'Data processing of dataset "{dset.name}" complete.')
+        return scaling.data_quality, (dset, self.options)
+
+    def check_quality(self, name, out):
+        dset = self.datasets[name]
+        dset.log.append((time.time(), out['step'], out['success'], out.get('reason', None)))
+        if not out['success']:
+            logger.error(f'Failed ({"data quality"}): {out["reason"]}')
+            self.save_checkpoint()
+            sys.exit()
+        else:
+            dset.results['data_quality'] = out.get('data')
+            dset.mark('results', 'data_quality')
+        return True
+
+    def final_score(self, name):
+        dset = self.datasets[name]
+        logger.info(log.log_value(f'Final Score for dataset "{dset.name}"', f"{dset.score():0.2f}"))
+
+    def conversion_work(self, name):
+        dset = self.datasets[name]
+        step_options = {}
+        step_options.update(self.options)
+        step_options['file_root'] = dset.name
+        return conversion.convert_formats, (dset, step_options)
+
+    def check_conversion(self, name, out):
+        dset = self.datasets[name]
+        dset.log.append((time.time(), out['step'], out['success'], out.get('reason', None)))
+        if not out['success']:
+            logger.error(f'Failed ({"conversion"}): {out["reason"]}')
+        else:
+            dset.results['output_files'] = out.get('data')
+            dset.mark('results', 'output_files')
+        return out['success']
+
+    def solver_work(self, name):
+        dset = self.datasets[name]
+        step_info = {
+            'unit_cell': dset.results['correction']['summary']['unit_cell'],
+            'name': dset.name,
+            'formula': self.options.get('solve-small'),
+        }
+        return solver.solve_small_molecule, (step_info, self.options)
+
+    def resume_point(self, pipeline, position, step):
+        """
+        Determine the tasks to consider complete when resuming from a given dataset index and step. All
+        tasks of earlier phases are complete, as well as tasks of the same group of per-dataset
+        phases for earlier datasets.
+
+        :param pipeline: Pipeline instance
+        :param position: dataset index
+        :param step: processing phase
+        :return: set of task keys
+        """
+        phase = PHASES.index(step)
+        group = PHASE_GROUPS.get(step)
+        completed = set()
+        for task in pipeline:
+            task_phase = PHASES.index(task.phase)
+            if task_phase < phase:
+                completed.add(task.key)
+            elif group and PHASE_GROUPS.get(task.phase) == group and task.index < position:
+                completed.add(task.key)
+        return completed
+
+    def task_done(self, task, success):
+        """
+        Update the run position and save a checkpoint after each task
+        """
+        if success:
+            self.completed.add(task.key)
+        pending = self.pipeline.pending(self.completed)
+        if pending:
+            self.run_position = (pending[0].index, pending[0].phase)
+        else:
+            self.run_position = (0, 'reporting')
+        self.save_checkpoint()
+
     def screen(self, resume_from=None, single=False, overwrite=None):
         overwrite = overwrite or {}
 
     def process(self, resume_from=None, single=False, overwrite=None):
         overwrite = overwrite or {}
 
-    def run(self, resume_from=None, single=False, colonize=False, overwrite=None):
+    def resume(self, colonize=False, overwrite=None):
+        """
+        Resume every incomplete step of a previous run. Checkpoints which do not record
+        the completed steps are resumed from the saved run position.
+        """
+        if self.completed is not None:
+            self.run(completed=self.completed, colonize=colonize, overwrite=overwrite)
+        else:
+            self.run(resume_from=self.run_position, colonize=colonize, overwrite=overwrite)
+
+    def run(self, resume_from=None, single=False, colonize=False, overwrite=None, completed=None):
         """
+        Run all incomplete steps of the processing pipeline.
+
         resume_from is a tuple of the form
             (dataset_index, 'step')
+        completed is a list of keys of steps already completed in a previous run
         """
         overwrite = overwrite or {}
 
@@ -290,20 +913,17 @@ class Manager(object):
         env_hosts = os.environ.get('DPS_NODES', 'localhost')
         logger.debug('{:^79}'.format(f'Computer systems: {env_hosts}'))
 
-        if resume_from is not None:
-            cur_pos, next_step = resume_from
+        self.pipeline = self.build_pipeline(overwrite=overwrite, colonize=colonize)
+        if completed is not None:
+            self.completed = set(completed) & set(task.key for task in self.pipeline)
+        elif resume_from is not None:
+            self.completed = self.resume_point(self.pipeline, *resume_from)
         else:
-            cur_pos, next_step = (0, 'initialize')
-
-        # Fist initialize and index all datasets
-        sub_steps = ['initialize', 'spot_search', 'indexing']
+            self.completed = set()
 
-        if next_step in sub_steps:
-            for i, dset in enumerate(self.datasets.values()):
-                if dset.name == 'combined' and self.options.get('mode') == 'merge':
-                    # 'combined' merged dataset is special
-                    continue
-                if i < cur_pos: continue  # skip all datasets earlier than specified one
+        for i, dset in enumerate(self.datasets.values()):
+            keys = ['{}:{}'.format(step, dset.name) for step in ['initialize', 'spot_search', 'indexing']]
+            if any(key in self.pipeline and key not in self.completed for key in keys):
                 logger.info(THIN_LINE)
                 logger.info(
                     log.log_value('Processing dataset', dset.name, style=log.TermColor.normal)
@@ -312,240 +932,27 @@ class Manager(object):
                     log.log_value('Working directory:', dset.parameters["working_directory"])
                 )
 
-                for j, step in enumerate(sub_steps):
-                    self.run_position = (i, step)
-
-                    # prepare separate copy of overwrite parameters for this step
-                    step_ovw = {}
-                    step_ovw.update(overwrite)
-
-                    # skip this step based on the properties
-                    if j < sub_steps.index(next_step): continue
-                    self.run_step(step, dset, overwrite=step_ovw, colonize=colonize)
-
-                    # Special post processing after indexing
-                    if step == 'indexing':
-                        # Update parameters with reduced cell
-                        dset.parameters.update({
-                            'unit_cell': dset.results['indexing']['parameters']['unit_cell'],
-                            'space_group': dset.results['indexing']['parameters']['sg_number']})
-                        r_cell = "{:0.2f} {:0.2f} {:0.2f} {:0.2f} {:0.2f} {:0.2f}".format(
-                            *dset.results['indexing']['parameters']['unit_cell']
-                        )
-                        xter_list = [v['character'] for v in dset.results['indexing']['lattices']]
-                        p_groups = ", ".join(xtal.get_pg_list(xter_list, chiral=self.options.get('chiral', True)))
-                        logger.info(log.log_value('Reduced Cell:',r_cell))
-                        logger.info(log.log_value('Point Groups:', p_groups))
-
-            next_step = 'integration'
-
-        # then integrate and correct separately
-        sub_steps = ['integration', 'correction']
-        if next_step in sub_steps:
-            for i, dset in enumerate(self.datasets.values()):
-                if dset.name == 'combined' and self.options.get('mode') == 'merge':
-                    # 'combined' merged dataset is special
-                    continue
-                if i < cur_pos: continue  # skip all datasets earlier than specified one                    
-                logger.info(THIN_LINE)
-                for j, step in enumerate(sub_steps):
-                    self.run_position = (i, step)
-
-                    # skip this step based on the properties
-                    if j < sub_steps.index(next_step): continue
-
-                    # prepare separate copy of overwrite parameters for this step
-                    step_ovw = {}
-                    step_ovw.update(overwrite)
-
-                    # special pre-step handling  for correction
-                    if step == 'correction' and i > 0 and self.options.get('mode') in ['merge', 'mad']:
-                        # update parameters with reference after correction
-                        ref_file = os.path.join(
-                            '..', list(self.datasets.values())[i - 1].results['correction']['output_file']
-                        )
-                        ref_sg = list(self.datasets.values())[0].results['correction']['summary']['spacegroup']
-                        step_ovw.update({'reference_data': ref_file, 'reference_spacegroup': ref_sg})
-
-                    self.run_step(step, dset, overwrite=step_ovw, colonize=colonize)
-                    if step == 'correction':
-                        ISa = dset.results['correction']['correction_factors']['parameters'].get('ISa', -1)
-                        r_meas = dset.results['correction']['summary']['inner_shell']['r_meas']
-                        i_sigma = dset.results['correction']['summary']['inner_shell']['i_sigma']
-                        logger.info(log.log_value(
-                            'Low-res R-meas for "{}"'.format(dset.name),
-                            f'{r_meas:0.1f} %'
-                        ))
-                        logger.info(log.log_value(
-                            'Low-res I/Sigma for "{}"'.format(dset.name),
-                            f'{i_sigma:0.1f}'
-                        ))
-                        if ISa >= 0:
-                            logger.info(log.log_value(
-                                'I/Sigma(I) Asymptote [ISa] for dataset "{}":'.format(dset.name),
-                                f'{ISa:0.1f}'
-                            ))
-                        dset.results['integration']['statistics'] = copy.deepcopy(dset.results['correction'])
-
-            next_step = 'symmetry'
-
-        # Check Spacegroup and scale the datasets
-        if next_step == 'symmetry':
-            logger.info(THIN_LINE)
-            self.run_position = (0, 'symmetry')
-            ref_info = None
-            sg_number = 0
-            if overwrite.get('sg_overwrite') is not None:
-                sg_number = overwrite['sg_overwrite']
-                ref_info = None
-            elif self.options.get('mode') in ['merge', 'mad']:
-                ref_opts = {}
-                ref_opts.update(self.options)
-                ref_opts.update(overwrite)
-                ref_info = scaling.prepare_reference(self.datasets, ref_opts)
-                sg_number = ref_info['sg_number']
-
-            for dset in list(self.datasets.values()):
-                if dset.name == 'combined' and self.options.get('mode') == 'merge':
-                    # 'combined' merged dataset is special
-                    continue
-                if self.options.get('mode') in ['simple', 'screen'] and overwrite.get('sg_overwrite') is None:
-                    # automatic spacegroup determination
-                    self.run_step('symmetry', dset, colonize=colonize)
-                    ref_sginfo = dset.results['symmetry']
-                else:
-                    # tranfer symmetry info from reference to this dataset and update with specific reindex matrix
-                    if ref_info is not None:
-                        dset.results['symmetry'] = ref_info
-                    ref_sginfo = symmetry.get_symmetry_params(sg_number, dset)
-                    dset.results['symmetry'].update(ref_sginfo)
-
-                step_ovw = {}
-                step_ovw.update(overwrite)
-                step_ovw.update({
-                    'space_group': ref_sginfo['sg_number'],
-                    'unit_cell': ref_sginfo['unit_cell'],
-                    'reindex_matrix': ref_sginfo['reindex_matrix'],
-                    # 'reference_data': ref_sginfo.get('reference_data'), # will be none for single data sets
-                    'message': 'Reindexing & refining',
-                })
-                self.run_step('correction', dset, overwrite=step_ovw, colonize=colonize)
-                cell_str = "{:0.6g} {:0.6g} {:0.6g} {:0.6g} {:0.6g} {:0.6g}".format(
-                    *dset.results['correction']['summary']['unit_cell']
-                )
-                logger.info(log.log_value(
-                    f'Refined unit cell for for "{dset.name}":', cell_str
-                ))
-
-                if self.options.get('mode') in ['merge']:
-                    logger.info(log.log_value(f'Initial Score for dataset "{dset.name}"', f"{dset.score():0.2f}"))
-
-            self.save_checkpoint()
-            next_step = 'strategy' if self.options.get('mode') == 'screen' else 'scaling'
-
-        if next_step == 'scaling':
-
-            self.run_position = (0, 'scaling')
-            step_ovw = {}
-            step_ovw.update(self.options)
-            step_ovw.update(overwrite)
-            if self.options.get('mode') == 'merge' and 'combined' in self.datasets:
-                # 'combined' merged dataset is special remove it before scaling
-                self.datasets.pop('combined', None)
-            out = scaling.scale_datasets(self.datasets, step_ovw)
-            self.save_checkpoint()
-
-            if not out['success']:
-                logger.error(f'Failed ({out["step"]}): {out["reason"]}')
-                sys.exit()
-            next_step = 'strategy'
-
-        # Strategy
-        if self.options.get('mode') == 'screen' and next_step == 'strategy':
-            self.run_position = (0, 'strategy')
-            for dset in list(self.datasets.values()):
-                if not 'resolution' in overwrite:
-                    overwrite['resolution'] = dset.results['integration']['statistics']['summary']['stderr_resolution']
-                self.run_step('strategy', dset, overwrite=overwrite, colonize=colonize)
-
-                strategy = reporting.get_strategy(dset.results)
-                strategy_table = misc.sTable([
-                    ['Recommended Strategy', ''],
-                    ['Resolution', '{:0.2f}'.format(strategy['resolution'])],
-                    ['Attenuation', '{:0.1f}'.format(strategy['attenuation'])],
-                    ['Start Angle', '{:0.0f}'.format(strategy['start_angle'])],
-                    ['Maximum Delta Angle', '{:0.2f}'.format(strategy['max_delta'])],
-                    ['Minimum Angle Range', '{:0.1f}'.format(strategy['total_angle'])],
-                    ['Exposure Rate (deg/sec)', '{:0.2f}'.format(strategy['exposure_rate'])],
-                    ['Overlaps?', strategy['overlaps']],
-                ])
-                strategy_table.table.align[''] = 'r'
-                for line in str(strategy_table).splitlines():
-                    logger.info(line)
-
-            self.save_checkpoint()
-
-        # check quality and covert formats
-        for i, dset in enumerate(self.datasets.values()):
-            # Only calculate for 'combined' dataset when merging.
-            if self.options['mode'] == 'merge' and dset.name != 'combined': continue
-
-            # Run Data Quality Step:
-            if self.options['mode'] != 'screen':
-                logger.info(THIN_LINE)
-                logger.info(f'Data processing of dataset "{dset.name}" complete.')
-                self.run_position = (i, 'data_quality')
-
-                out = scaling.data_quality(dset, self.options)
-                dset.log.append((time.time(), out['step'], out['success'], out.get('reason', None)))
-                if not out['success']:
-                    logger.error(f'Failed ({"data quality"}): {out["reason"]}')
-                    sys.exit()
-                else:
-                    dset.results['data_quality'] = out.get('data')
-                self.save_checkpoint()
-
-            # Scoring
-            logger.info(log.log_value(f'Final Score for dataset "{dset.name}"', f"{dset.score():0.2f}"))
-
-            # file format conversions
-            self.run_position = (i, 'conversion')
-            if self.options.get('mode') != 'screen':
-                if self.options.get('mode') == 'merge' and dset.name != 'combined': continue
-                step_options = {}
-                step_options.update(self.options)
-                step_options['file_root'] = dset.name
-
-                out = conversion.convert_formats(dset, step_options)
-                dset.log.append((time.time(), out['step'], out['success'], out.get('reason', None)))
-                if not out['success']:
-                    dset.log.append((time.time(), out['step'], out['success'], out.get('reason', None)))
-                    logger.error(f'Failed ({"conversion"}): {out["reason"]}')
-                else:
-                    dset.results['output_files'] = out.get('data')
-                self.save_checkpoint()
-
-            if self.options.get('solve-small'):
-                self.run_position = (i, 'solve-small')
-                if self.options.get('mode') == 'merge' and i > 0:
-                    pass  # do not solve
-                else:
-                    step_info = {
-                        'unit_cell': dset.results['correction']['summary']['unit_cell'],
-                        'name': dset.name,
-                        'formula': self.options.get('solve-small'),
-                    }
-                    out = solver.solve_small_molecule(step_info, self.options)
-                self.save_checkpoint()
+        executor = self.get_executor()
+        try:
+            self.pipeline.run(
+                completed=self.completed, executor=executor, workers=self.options.get('workers', 1) or 1,
+                callback=self.task_done, measured=lambda task: self.record_usage(task.key, task.phase, task.usage)
+            )
+        except BaseException:
+            # programs started by other threads would otherwise keep running
+            programs.EXECUTOR.cancel()
+            raise
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
 
         # reporting
         self.run_position = (0, 'reporting')
-        os.chdir(self.options['directory'])
-        checkpoint = self.save_checkpoint()
+        checkpoint = self.save_checkpoint(compact=True)
 
         # Save summaries
         logger.info('Generating reports ... report.html, report.txt')
-        reporting.save_report(checkpoint['datasets'], self.options)
+        reporting.save_report(checkpoint['datasets'], self.options, usage=checkpoint['usage'])
 
 
         used_time = time.strftime('%H:%M:%S', time.gmtime(time.time() - self.start_time))
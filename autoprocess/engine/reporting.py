@@ -6,7 +6,7 @@ import numpy
 from prettytable import PrettyTable
 
 from autoprocess.utils import gnuplot
-from autoprocess.utils import xtal, misc, log
+from autoprocess.utils import clustering, xtal, misc, log
 from autoprocess.utils.misc import json
 
 _logger = log.get_module_logger(__name__)
@@ -14,7 +14,7 @@ _logger = log.get_module_logger(__name__)
 SHARE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'share')
 
 
-def save_report(datasets, options):
+def save_report(datasets, options, usage=None):
     directory = options['directory']
     report = {
         'id': None,
@@ -33,7 +33,13 @@ def save_report(datasets, options):
         old_report = misc.load_json(report_file)
         report['id'] = old_report.get('id')
 
-    if options.get('mode') == 'screen':
+    if options.get('mode') == 'screen' and datasets[0]['results'].get('triage', {}).get('abort'):
+        results = datasets[0]['results']
+        report['kind'] = 'MX Screening'
+        report['title'] = 'Screening of "{}" stopped after indexing'.format(datasets[0]['parameters']['name'])
+        report['details'] = triage_report(datasets[0], options)
+        report['score'] = results['triage']['score']
+    elif options.get('mode') == 'screen':
         results = datasets[0]['results']
         report['kind'] = 'MX Screening'
         report['title'] = '{}Screening of "{}"'.format(
@@ -71,6 +77,9 @@ def save_report(datasets, options):
         report['details'] = single_report(datasets[0], options)
         report['score'] = results['crystal_score']
 
+    if usage:
+        report['details'].append(resource_report(usage, options))
+
     # save
     with open(report_file, 'w') as handle:
         json.dump(report, handle)
@@ -304,6 +313,30 @@ def spacegroup_table(dataset, options):
     }
 
 
+def spacegroup_trials_table(dataset, options):
+    results = dataset['results']
+    return {
+        'title': "Refinement in Candidate Space-Groups",
+        'kind': 'table',
+        'data': [
+                    ['Selected', 'Space Group', 'Low-res R-meas', 'Low-res I/Sigma', 'Completeness', 'ISa']
+                ] + [
+                    [
+                        '*' if trial['selected'] else '', trial['sg_name'],
+                        '{:0.1f}'.format(trial['r_meas']), '{:0.1f}'.format(trial['i_sigma']),
+                        '{:0.1f}'.format(trial['completeness']), '{:0.1f}'.format(trial['ISa']),
+                    ] if trial['success'] else [
+                        '', trial['sg_name'], '-', '-', '-', '-'
+                    ] for trial in results['correction']['trials']
+                ],
+        'header': 'row',
+        'notes': (
+            "The top space group candidates were refined concurrently. The first candidate whose low resolution "
+            "R-meas is not significantly worse than the best was selected."
+        )
+    }
+
+
 def standard_error_report(dataset, options):
     results = dataset['results']
     return {
@@ -772,14 +805,17 @@ def single_report(dataset, options):
         title = 'Anomalous Data Quality Summary'
     else:
         title = 'Data Quality Summary'
+    content = [
+        summary_table([dataset], options),
+        lattice_table(dataset, options),
+        spacegroup_table(dataset, options)
+    ]
+    if dataset['results']['correction'].get('trials'):
+        content.append(spacegroup_trials_table(dataset, options))
     return [
         {
             'title': title,
-            'content': [
-                summary_table([dataset], options),
-                lattice_table(dataset, options),
-                spacegroup_table(dataset, options)
-            ],
+            'content': content,
         },
         standard_error_report(dataset, options),
         frame_statistics_report(dataset, options),
@@ -789,6 +825,35 @@ def single_report(dataset, options):
     ]
 
 
+def clustering_report(dataset, options):
+    info = dataset['results'].get('symmetry', {}).get('clustering')
+    if not info:
+        return None
+    dendrogram = info['dendrogram']
+    return {
+        'title': 'Dataset Clustering',
+        'description': (
+            'Datasets were clustered by the correlation of their intensities using {} linkage. The largest '
+            'cluster of datasets closer than {:0.3f} (1 - CC) was used to prepare the reference.'
+        ).format(dendrogram['linkage'], dendrogram['cutoff']),
+        'content': [
+            {
+                'title': 'Dendrogram of datasets',
+                'kind': 'dendrogram',
+                'data': dendrogram,
+            },
+            {
+                'title': 'Clusters',
+                'kind': 'table',
+                'data': [['Cluster', 'Size', 'Datasets']] + [
+                    [i + 1, len(names), ', '.join(names)] for i, names in enumerate(info['clusters'])
+                ],
+                'header': 'row',
+            }
+        ]
+    }
+
+
 def merge_report(datasets, options):
     if options.get('anomalous'):
         title = 'Anomalous Data Quality Summary'
@@ -802,6 +867,9 @@ def merge_report(datasets, options):
             ],
         }
     ]
+    clusters = clustering_report(datasets[0], options)
+    if clusters:
+        report.append(clusters)
     combined = None
     for dataset in datasets:
         if dataset['parameters']['name'] == 'combined':
@@ -890,6 +958,126 @@ def screening_report(dataset, options):
     return report
 
 
+def resource_table(usage, options):
+    megabyte = 1024 ** 2
+    rows = []
+    total = {'wall': 0.0, 'user': 0.0, 'system': 0.0, 'max_rss': 0, 'read_bytes': 0, 'write_bytes': 0}
+    for record in usage:
+        cpu = record['user'] + record['system']
+        rows.append([
+            record['task'],
+            '{:0.1f}'.format(record['wall']),
+            '{:0.1f}'.format(record['user']),
+            '{:0.1f}'.format(record['system']),
+            '{:0.1f}'.format(cpu / record['wall']) if record['wall'] > 0 else '-',
+            '{:0.0f}'.format(record['max_rss'] / megabyte),
+            '{:0.0f}'.format(record['read_bytes'] / megabyte),
+            '{:0.0f}'.format(record['write_bytes'] / megabyte),
+            len(record.get('commands', [])),
+        ])
+        for field in ['wall', 'user', 'system', 'read_bytes', 'write_bytes']:
+            total[field] += record[field]
+        total['max_rss'] = max(total['max_rss'], record['max_rss'])
+    total_cpu = total['user'] + total['system']
+    rows.append([
+        'Total',
+        '{:0.1f}'.format(total['wall']),
+        '{:0.1f}'.format(total['user']),
+        '{:0.1f}'.format(total['system']),
+        '{:0.1f}'.format(total_cpu / total['wall']) if total['wall'] > 0 else '-',
+        '{:0.0f}'.format(total['max_rss'] / megabyte),
+        '{:0.0f}'.format(total['read_bytes'] / megabyte),
+        '{:0.0f}'.format(total['write_bytes'] / megabyte),
+        sum(row[-1] for row in rows),
+    ])
+    return {
+        'title': 'Time and Resources Used by Each Step',
+        'kind': 'table',
+        'data': [
+            ['Step', 'Wall (s)', 'User CPU (s)', 'System CPU (s)', 'Cores Used', 'Peak Memory (MB)',
+             'Read (MB)', 'Written (MB)', 'Programs']
+        ] + rows,
+        'header': 'row',
+        'notes': (
+            "CPU times, memory and I/O include only external programs run by each step. 'Cores Used' is the "
+            "ratio of CPU time to wall time, values much lower than the number of processors indicate "
+            "steps which are not making good use of the available processors. Steps of different datasets may "
+            "overlap when datasets are processed concurrently, in which case the total wall time exceeds the "
+            "duration of the run."
+        )
+    }
+
+
+def resource_report(usage, options):
+    return {
+        'title': 'Processing Resources',
+        'content': [
+            resource_table(usage, options),
+        ]
+    }
+
+
+def triage_table(dataset, options):
+    results = dataset['results']
+    params = dataset['parameters']
+    triage = results['triage']
+    return {
+        'title': 'Indexing Statistics',
+        'kind': 'table',
+        'data': [
+            ['Observed Parameters', ''],
+            ['Indexing Score¹', '{:0.2f}'.format(triage['score'])],
+            ['Minimum Score', '{:0.2f}'.format(triage['minimum'])],
+            ['Wavelength (A)', '{:0.5g}'.format(params['wavelength'])],
+            [
+                'Reduced Cell (A)',
+                "{:0.2f} {:0.2f} {:0.2f} {:0.4g} {:0.4g} {:0.4g}".format(*results['indexing']['parameters']['unit_cell'])
+            ],
+        ] + [
+            [detail['name'].replace('_', ' '), '{:0.3g}'.format(detail['value'])] for detail in triage['details']
+        ] + [
+            ['Diagnosis', ', '.join(triage['problems']) or 'None'],
+        ],
+        'header': 'column',
+        'notes': inspect.cleandoc("""
+            1. Score calculated from the fraction of spots indexed, the fraction of indexed spots in the largest
+               subtree, the standard deviations of spot positions, the mosaicity and problems diagnosed during
+               indexing. Screening stops when the score is below the minimum."""
+        )
+    }
+
+
+def indexing_lattice_table(dataset, options):
+    results = dataset['results']
+    return {
+        'title': "Lattice Character",
+        'kind': 'table',
+        'data': [
+                    ['No.', 'Lattice type', 'Cell Parameters', 'Quality', 'Cell Volume']
+                ] + [
+                    [
+                        lattice['index'], lattice['character'],
+                        '{:0.1f} {:0.1f} {:0.1f} {:0.1f} {:0.1f} {:0.1f}'.format(*lattice['unit_cell']),
+                        '{:0.1f}'.format(lattice['quality']),
+                        '{:0.1f}'.format(xtal.cell_volume(lattice['unit_cell']))
+                    ] for lattice in sorted(results['indexing'].get('lattices', []), key=lambda d: d['index'])
+                ],
+        'header': 'row',
+    }
+
+
+def triage_report(dataset, options):
+    return [
+        {
+            'title': 'Indexing Summary',
+            'content': [
+                triage_table(dataset, options),
+                indexing_lattice_table(dataset, options),
+            ]
+        }
+    ]
+
+
 def heading(text, level):
     if level in [1, 2]:
         underline = {1: '=', 2: '-'}[level]
@@ -930,6 +1118,8 @@ def text_report(report):
                     plot_type = {'lineplot': 'linespoints', 'scatterplot': 'points'}[content['kind']]
                     plot_text = gnuplot.plot(content['data'], plot_type=plot_type, style=content.get('style', 'full-height'))
                     output.append(plot_text.decode('utf8'))
+                elif content.get('kind') == 'dendrogram':
+                    output.append('\n'.join(clustering.dendrogram_text(content['data']['tree'])))
                 if 'notes' in content:
                     output.append(heading('NOTES', 4))
                     output.append(content['notes'] + '\n')
@@ -3,15 +3,15 @@ import os
 import time
 from itertools import chain
 
-import cluster
-
 import autoprocess.errors
 from autoprocess.engine import symmetry
 from autoprocess.parsers import xds, pointless, phenix
-from autoprocess.utils import log, misc, programs, xdsio, xtal
+from autoprocess.utils import clustering, log, misc, programs, xdsio, xtal
 
 logger = log.get_module_logger(__name__)
 
+XTRIAGE_OUTPUTS = ['xtriage.log', 'unmerged.log', 'UNMERGED.mtz']
+
 
 def check_chisq(result):
     # check correction factors
@@ -24,7 +24,8 @@ def check_chisq(result):
 
 def scale_datasets(dsets, options=None, message="Scaling"):
     options = options or {}
-    os.chdir(options.get('directory', '.'))
+    directory = options.get('directory', '.')
+    xscale_file = os.path.join(directory, 'XSCALE.LP')
 
     # indicate overwritten parameters
     suffix = []
@@ -58,7 +59,7 @@ def scale_datasets(dsets, options=None, message="Scaling"):
                  'shells': xtal.resolution_shells(resol),
                  })
             if options.get('backup', False):
-                misc.backup_files(out_file, 'XSCALE.LP')
+                misc.backup_files(out_file, 'XSCALE.LP', directory=directory)
             dset.results['scaling'] = {'output_file': out_file}
     else:
         if options.get('mode') == 'merge':
@@ -82,16 +83,16 @@ def scale_datasets(dsets, options=None, message="Scaling"):
             'output_file': "XSCALE.HKL",
             'inputs': inputs, }]
         if options.get('backup', False):
-            misc.backup_files('XSCALE.HKL', 'XSCALE.LP')
+            misc.backup_files('XSCALE.HKL', 'XSCALE.LP', directory=directory)
 
     xscale_options = {
         'sections': sections
     }
 
-    xdsio.write_xscale_input(xscale_options)
+    xdsio.write_xscale_input(xscale_options, directory=directory)
     try:
-        programs.xscale_par(step_descr)
-        raw_info = xds.parse_xscale('XSCALE.LP')
+        programs.xscale_par(step_descr, directory=directory)
+        raw_info = xds.parse_xscale(xscale_file)
     except autoprocess.errors.ProcessError as e:
         for dset in list(dsets.values()):
             dset.log.append((time.time(), 'scaling', False, str(e)))
@@ -133,12 +134,14 @@ def scale_datasets(dsets, options=None, message="Scaling"):
 
 def prepare_reference(dsets, options=None):
     options = options or {}
-    os.chdir(options.get('directory', '.'))
+    directory = options.get('directory', '.')
+    xscale_file = os.path.join(directory, 'XSCALE.LP')
 
     # use most complete dataset if fewer than 4 are being scaled
     best = max([(dset.results['correction']['summary']['completeness'], dset.name) for dset in list(dsets.values())])
     reference_name = best[1]  # the most complete dataset of the lot
     minimum_correlation = 0.0
+    cluster_info = None
     if len(dsets) < 4 or best[0] >= 30.0:
         logger.info('Using the most complete dataset "{}" ({:0.1f}%) as reference.'.format(best[1], best[0]))
         reference_file = dsets[reference_name].results['correction']['output_file']
@@ -159,10 +162,10 @@ def prepare_reference(dsets, options=None):
             'inputs': dset_options,
         }]}
 
-        xdsio.write_xscale_input(xscale_options)
-        programs.xscale_par()
-        misc.backup_special_file('XSCALE.LP', 'first')
-        out = xds.parse_correlations('XSCALE.LP.first')
+        xdsio.write_xscale_input(xscale_options, directory=directory)
+        programs.xscale_par(directory=directory)
+        misc.backup_special_file('XSCALE.LP', 'first', directory=directory)
+        out = xds.parse_correlations(os.path.join(directory, 'XSCALE.LP.first'))
         correlations = out['correlations']
         corr_table = misc.Table(correlations)
         minimum_correlation = min(corr_table['corr'])
@@ -172,20 +175,15 @@ def prepare_reference(dsets, options=None):
         else:
             logger.info(f'Some correlations are low {min(corr_table["corr"]):0.3f}. Reference dataset needed ...')
             # cluster datasets by correlation
-            distance_dict = dict([(tuple(sorted((v['i'], v['j']))), (v['corr'], v['num'])) for v in correlations])
-
-            def _get_dist(x, y):
-                xn = x['name']
-                yn = y['name']
-                i = 1 + dset_names.index(xn)
-                j = 1 + dset_names.index(yn)
-                key = tuple(sorted((i, j)))
-                c, d = distance_dict[key]
-                return (1 - c)  # + 0.1/numpy.sqrt(d)
-
-            cl = cluster.HierarchicalClustering(dset_options, _get_dist, linkage='complete')
-            cl.cluster()
-            best_subtree = max(cl.getlevel(0.05), key=len)
+            corr_matrix = clustering.CorrelationMatrix.from_correlations(dset_names, correlations)
+            tree = clustering.Clustering(corr_matrix, method=options.get('linkage', clustering.DEFAULT_LINKAGE))
+            cutoff = options.get('cluster_cutoff', clustering.DEFAULT_CUTOFF)
+            best_names = tree.largest(cutoff)
+            best_subtree = [opt for opt in dset_options if opt['name'] in best_names]
+            cluster_info = {
+                'clusters': tree.clusters(cutoff),
+                'dendrogram': tree.dendrogram(cutoff),
+            }
 
             # set new reference name if old one not present withint the best subtree
             if reference_name not in [v['name'] for v in best_subtree]:
@@ -202,11 +200,11 @@ def prepare_reference(dsets, options=None):
                     'inputs': best_subtree,
                 }]}
 
-                xdsio.write_xscale_input(xscale_options)
-                programs.xscale_par()
-                opt_info = list(xds.parse_xscale('XSCALE.LP').values())[0]
+                xdsio.write_xscale_input(xscale_options, directory=directory)
+                programs.xscale_par(directory=directory)
+                opt_info = list(xds.parse_xscale(xscale_file).values())[0]
                 opt_info['output_file'] = 'REF1.HKL'
-                misc.backup_special_file('XSCALE.LP', 'ref1')
+                misc.backup_special_file('XSCALE.LP', 'ref1', directory=directory)
                 reference_file = 'REF1.HKL'
             else:
                 _good_corrs = [(v['i'], v['j']) for v in correlations if v['corr'] > 0.95 and v['num'] >= 10]
@@ -217,8 +215,8 @@ def prepare_reference(dsets, options=None):
                 logger.info(f'Using single {reference_file} as reference ... ')
 
     # Verify Spacegroup of reference
-    programs.pointless(filename=reference_file, chiral=options.get('chiral', True))
-    sg_info = pointless.parse_pointless()
+    programs.pointless(filename=reference_file, chiral=options.get('chiral', True), directory=directory)
+    sg_info = pointless.parse_pointless(os.path.join(directory, 'pointless.xml'))
 
     info = symmetry.get_symmetry_params(sg_info['sg_number'], dsets[reference_name])
     sg_info.update(info)
@@ -241,13 +239,15 @@ def prepare_reference(dsets, options=None):
         'inputs': [{'input_file': reference_file}],
     }]}
 
-    xdsio.write_xscale_input(xscale_options)
-    programs.xscale_par()
-    opt_info = list(xds.parse_xscale('XSCALE.LP').values())[0]
+    xdsio.write_xscale_input(xscale_options, directory=directory)
+    programs.xscale_par(directory=directory)
+    opt_info = list(xds.parse_xscale(xscale_file).values())[0]
     opt_info['output_file'] = 'REFERENCE.HKL'
-    misc.backup_special_file('XSCALE.LP', 'reference')
+    misc.backup_special_file('XSCALE.LP', 'reference', directory=directory)
     sg_info['reference_data'] = 'REFERENCE.HKL'
     sg_info['minimum_correlation'] = minimum_correlation
+    if cluster_info:
+        sg_info['clustering'] = cluster_info
 
     return sg_info
 
@@ -255,16 +255,23 @@ def prepare_reference(dsets, options=None):
 def data_quality(dset, options=None):
     filename = dset.results['scaling']['output_file']
     options = options or {}
-    os.chdir(options.get('directory', '.'))
+    directory = options.get('directory', '.')
 
     law_type = {'PM': 'Pseudo-merohedral', 'M': 'Merohedral'}
     # Check Requirements
-    if not misc.file_requirements(filename):
+    if not misc.file_requirements(filename, directory=directory):
         return {'step': 'data_quality', 'success': False, 'reason': 'Required files missing'}
 
     try:
-        programs.xtriage(filename, label=f'Checking quality of dataset "{dset.name}"')
-        info = phenix.parse_xtriage()
+        # run in a scratch directory so that conversions of the same file can run alongside
+        label = f'Checking quality of dataset "{dset.name}"'
+        result, = programs.run_isolated([(
+            lambda scratch: [programs.xtriage_command(filename, label=label, directory=scratch)],
+            [filename], XTRIAGE_OUTPUTS
+        )], directory=directory)
+        if result is not None:
+            raise result
+        info = phenix.parse_xtriage(os.path.join(directory, 'xtriage.log'))
     except autoprocess.errors.ProcessError as e:
         return {'step': 'data_quality', 'success': False, 'reason': str(e)}
 
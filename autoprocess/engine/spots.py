@@ -7,8 +7,10 @@ from autoprocess.utils import log, misc, programs, xdsio
 _logger = log.get_module_logger(__name__)
 
 
-def harvest_initialize():
-    if misc.file_requirements('X-CORRECTIONS.cbf', 'Y-CORRECTIONS.cbf', 'BKGINIT.cbf', 'BLANK.cbf', 'GAIN.cbf'):
+def harvest_initialize(directory='.'):
+    if misc.file_requirements(
+            'X-CORRECTIONS.cbf', 'Y-CORRECTIONS.cbf', 'BKGINIT.cbf', 'BLANK.cbf', 'GAIN.cbf', directory=directory
+    ):
         return {'step': 'initialize', 'success': True}
     else:
         return {'step': 'initialize', 'success': False, 'reason': 'Initialization unsuccessful!'}
@@ -16,38 +18,38 @@ def harvest_initialize():
 
 def initialize(data_info, options=None):
     options = options or {}
-    os.chdir(data_info['working_directory'])
+    directory = data_info['working_directory']
 
     run_info = {'mode': options.get('mode')}
     run_info.update(data_info)
 
-    xdsio.write_xds_input('XYCORR INIT', run_info)
+    xdsio.write_xds_input('XYCORR INIT', run_info, directory=directory)
     try:
-        programs.xds_par('Initializing')
+        programs.xds_par('Initializing', directory=directory)
     except autoprocess.errors.ProcessError as e:
         return {'step': 'initialize', 'success': False, 'reason': str(e)}
 
-    return harvest_initialize()
+    return harvest_initialize(directory)
 
 
 def analyse_image(data_info, options=None):
     options = options or {}
-    os.chdir(data_info['working_directory'])
+    directory = data_info['working_directory']
     _logger.info('Analyzing reference image ...')
 
     try:
-        programs.distl(data_info['reference_image'])
+        programs.distl(data_info['reference_image'], directory=directory)
     except autoprocess.errors.ProcessError as e:
         return {'step': 'image_analysis', 'success': False, 'reason': str(e)}
 
-    if not misc.file_requirements('distl.log'):
+    if not misc.file_requirements('distl.log', directory=directory):
         return {'step': 'image_analysis', 'success': False, 'reason': 'Could not analyse reference image'}
-    info = distl.parse_distl('distl.log')
+    info = distl.parse_distl(os.path.join(directory, 'distl.log'))
     return {'step': 'image_analysis', 'success': True, 'data': info}
 
 
-def harvest_spots():
-    if misc.file_requirements('SPOT.XDS'):
+def harvest_spots(directory='.'):
+    if misc.file_requirements('SPOT.XDS', directory=directory):
         return {'step': 'spot_search', 'success': True}
     else:
         return {'step': 'spot_search', 'success': False, 'reason': 'Could not find spots.'}
@@ -55,15 +57,15 @@ def harvest_spots():
 
 def find_spots(data_info, options=None):
     options = options or {}
-    os.chdir(data_info['working_directory'])
+    directory = data_info['working_directory']
 
     run_info = {'mode': options.get('mode')}
     run_info.update(data_info)
 
-    xdsio.write_xds_input('COLSPOT', run_info)
+    xdsio.write_xds_input('COLSPOT', run_info, directory=directory)
     try:
-        programs.xds_par('Searching for strong spots')
+        programs.xds_par('Searching for strong spots', directory=directory)
     except autoprocess.errors.ProcessError as e:
         return {'step': 'spot_search', 'success': False, 'reason': str(e)}
 
-    return harvest_spots()
+    return harvest_spots(directory)
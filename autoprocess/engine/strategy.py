@@ -10,7 +10,7 @@ _logger = log.get_module_logger(__name__)
 
 def calc_strategy(data_info, options=None):
     options = options or {}
-    os.chdir(data_info['working_directory'])
+    directory = data_info['working_directory']
 
     # indicate overwritten parameters
     suffix = []
@@ -24,22 +24,22 @@ def calc_strategy(data_info, options=None):
     else:
         step_descr = 'Calculating strategy'
 
-    if not misc.file_requirements('CORRECT.LP', 'BKGPIX.cbf', 'XDS_ASCII.HKL', 'GXPARM.XDS'):
+    if not misc.file_requirements('CORRECT.LP', 'BKGPIX.cbf', 'XDS_ASCII.HKL', 'GXPARM.XDS', directory=directory):
         return {'step': 'strategy', 'success': False, 'reason': 'Required files from integration missing'}
 
-    if os.path.exists('GXPARM.XDS'):
-        misc.backup_files('XPARM.XDS')
-        shutil.copy('GXPARM.XDS', 'XPARM.XDS')
+    if os.path.exists(os.path.join(directory, 'GXPARM.XDS')):
+        misc.backup_files('XPARM.XDS', directory=directory)
+        shutil.copy(os.path.join(directory, 'GXPARM.XDS'), os.path.join(directory, 'XPARM.XDS'))
     run_info = {'mode': options.get('mode'), 'anomalous': options.get('anomalous', False)}
     run_info.update(data_info)
-    xdsio.write_xds_input("XPLAN", run_info)
+    xdsio.write_xds_input("XPLAN", run_info, directory=directory)
 
     try:
-        programs.xds_par(step_descr)
-        info = xds.parse_xplan()
+        programs.xds_par(step_descr, directory=directory)
+        info = xds.parse_xplan(os.path.join(directory, 'XPLAN.LP'))
 
-        programs.best(data_info, options)
-        info.update(best.parse_best())
+        programs.best(data_info, options, directory=directory)
+        info.update(best.parse_best(os.path.join(directory, 'best')))
     except autoprocess.errors.ProcessError as e:
         return {'step': 'strategy', 'success': True, 'reason': str(e), 'data': info}
 
@@ -27,14 +27,14 @@ def get_symmetry_params(spacegroup, dset):
 
 def determine_sg(data_info, dset, options=None):
     options = options or {}
-    os.chdir(data_info['working_directory'])
+    directory = data_info['working_directory']
     _logger.info("Automaticaly Determining Symmetry ...")
-    if not misc.file_requirements('INTEGRATE.HKL'):
+    if not misc.file_requirements('INTEGRATE.HKL', directory=directory):
         return {'step': 'symmetry', 'success': False, 'reason': 'Required files from integration missing'}
 
     try:
-        programs.pointless(chiral=options.get('chiral', True))
-        sg_info = pointless.parse_pointless()
+        programs.pointless(chiral=options.get('chiral', True), directory=directory)
+        sg_info = pointless.parse_pointless(os.path.join(directory, 'pointless.xml'))
     except (autoprocess.errors.ProcessError, autoprocess.errors.ParserError, IOError) as e:
         return {'step': 'symmetry', 'success': False, 'reason': str(e)}
 
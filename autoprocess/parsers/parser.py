@@ -1,12 +1,35 @@
+"""
+Parsing of text output files using YAML specifications.
+
+Each specification is loaded once per process and compiled into section and field objects holding the
+regular expressions, so that parsing a file only costs the matching. The compiled specifications are also
+saved in a __pycache__ directory next to the YAML files, when it is writable, and reused by later processes
+for as long as the YAML file is unchanged.
+
+Files are memory-mapped rather than read into a string. The start and end markers of all sections are located
+in a single pass over the file, and the fields of each section are then matched in place on its own byte
+range, so that large files such as INTEGRATE.LP of many thousands of frames are parsed in linear time
+without copies of the text.
+
+"""
+
+import bisect
+import contextlib
+import functools
+import mmap
 import os
+import pickle
 import re
 from collections import defaultdict
 
-import yaml
-
 SPEC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+SPEC_CACHE_PATH = os.path.join(SPEC_PATH, '__pycache__')
+SPEC_CACHE_VERSION = 2  # increment when the compiled form changes
 ESCAPE_CHARS = ")(.*|"
 
+# domain expressions of the form <start marker>(.+?)<end marker>, which are resolved from the marker index
+DOMAIN_MARKERS = re.compile(r'^(?P<start>.+?)\((?P<body>\.\+\?|\.\*\?)\)(?P<end>.+)$', re.DOTALL)
+
 
 class ConverterType(type):
     def __init__(cls, *args, **kwargs):
@@ -35,6 +58,10 @@ class Converter(object, metaclass=ConverterType):
     """
     chars = r"."
 
+    @classmethod
+    def from_bytes(cls, value):
+        return cls.to_python(value.decode('utf-8'))
+
     @classmethod
     def regex(cls, name, size=None):
         if size is None:
@@ -58,6 +85,8 @@ class Int(Converter):
     def to_python(value):
         return int(value.strip())
 
+    from_bytes = to_python  # int() accepts bytes
+
 
 class String(Converter):
     name = 'str'
@@ -107,6 +136,8 @@ class Float(Converter):
     def to_python(value):
         return float(value.strip())
 
+    from_bytes = to_python  # float() accepts bytes
+
 
 class Line(Converter):
     name = 'line'
@@ -126,6 +157,19 @@ def escape(text):
     return text
 
 
+def literal_prefix(pattern):
+    """
+    Leading literal text of a regular expression, which every match must start with
+
+    :param pattern: regular expression as bytes
+    :return: bytes, empty if the expression does not start with literal text
+    """
+    prefix = re.match(rb'[^\\.^$*+?{}\[\]()|]*', pattern).group(0)
+    if pattern[len(prefix):len(prefix) + 1] in (b'*', b'?', b'{'):
+        prefix = prefix[:-1]  # the last character is optional
+    return prefix
+
+
 def build(pattern):
     """
     Parse the text and generate the corresponding regex expression, replacing all fields
@@ -173,80 +217,346 @@ def build(pattern):
     return re.compile(pattern), variables
 
 
-def parse_fields(spec, text, table=False):
-    groups = defaultdict(list)
-    regex, variables = build(spec)
-    converters = {variable['key']: variable['converter'] for variable in variables}
-    for variable in variables:
-        # ignore internal names
-        if not variable['name'].startswith('_'):
-            groups[variable['name']].append(variable['key'])
-
-    if table:
-        results = []
-        for m in regex.finditer(text):
-            raw_values = {k: converters[k].to_python(v) for k, v in m.groupdict().items() if not k.startswith('_')}
-            results.append({
-                name: raw_values[name] if len(keys) == 1 else tuple(raw_values[key] for key in keys)
-                for name, keys in groups.items()
-            })
-        return results
-    else:
-        m = regex.search(text)
-        if m:
-            raw_values = {k: converters[k].to_python(v) for k, v in m.groupdict().items() if not k.startswith('_')}
-            return {
-                name: raw_values[name] if len(keys) == 1 else tuple(raw_values[key] for key in keys)
-                for name, keys in groups.items()
-            }
-    return {}
+class FieldSpec(object):
+    """
+    A field specification compiled into a regular expression
 
+    :param spec: field specification
+    """
 
-def parse_section(section, data):
-    if section.get('domains'):
-        sub_data = '\n'.join(re.findall(section["domains"], data, re.DOTALL))
-    elif section.get('domain'):
-        m = re.search(section["domain"], data, re.DOTALL)
-        if m:
-            sub_data = m.group(0)
+    def __init__(self, spec):
+        self.regex, variables = build(spec)
+        self.byte_regex = re.compile(self.regex.pattern.encode('utf-8'), self.regex.flags & ~re.UNICODE)
+        self.converters = {variable['key']: variable['converter'] for variable in variables}
+        self.groups = defaultdict(list)
+        for variable in variables:
+            # ignore internal names
+            if not variable['name'].startswith('_'):
+                self.groups[variable['name']].append(variable['key'])
+        self.keys = [
+            (key, index - 1, self.converters[key]) for key, index in self.regex.groupindex.items()
+            if not key.startswith('_')
+        ]
+
+    def values(self, match):
+        groups = match.groups()
+        if match.re is self.regex:
+            raw_values = {key: converter.to_python(groups[index]) for key, index, converter in self.keys}
         else:
-            sub_data = ""
-    else:
-        sub_data = data
+            raw_values = {key: converter.from_bytes(groups[index]) for key, index, converter in self.keys}
+        return {
+            name: raw_values[name] if len(keys) == 1 else tuple(raw_values[key] for key in keys)
+            for name, keys in self.groups.items()
+        }
+
+    def parse(self, text, table=False):
+        if table:
+            return [self.values(m) for m in self.regex.finditer(text)]
+        else:
+            m = self.regex.search(text)
+            if m:
+                return self.values(m)
+        return {}
+
+    def scan(self, document, ranges, table=False):
+        """
+        Match the field in place on byte ranges of a document
+
+        :param document: Document
+        :param ranges: list of (start, end) byte offsets, searched in order
+        :param table: if True, return the values of all matches
+        """
+        if table:
+            return [
+                self.values(m) for start, end in ranges for m in self.byte_regex.finditer(document.view[start:end])
+            ]
+        for start, end in ranges:
+            m = self.byte_regex.search(document.view[start:end])
+            if m:
+                return self.values(m)
+        return {}
+
+
+class SectionSpec(object):
+    """
+    A section specification with compiled domain, field and sub-section specifications
+
+    :param section: section specification
+    """
 
-    output = {}
-    if sub_data:
+    def __init__(self, section):
+        self.domains = re.compile(section['domains'], re.DOTALL) if section.get('domains') else None
+        self.domain = re.compile(section['domain'], re.DOTALL) if section.get('domain') else None
+
+        # split the domain into start and end markers where possible, otherwise match the whole expression
+        self.markers = None
+        self.byte_domain = None
+        pattern = section.get('domains') or section.get('domain')
+        if pattern:
+            m = DOMAIN_MARKERS.match(pattern)
+            start, end = (m.group('start').encode('utf-8'), m.group('end').encode('utf-8')) if m else (b'', b'')
+            if literal_prefix(start) and literal_prefix(end) and end != b'$':
+                self.markers = (start, end, 1 if m.group('body') == '.+?' else 0)
+            else:
+                self.byte_domain = re.compile(pattern.encode('utf-8'), re.DOTALL)
+        self.fields = []
+        self.table = None
         if 'fields' in section:
             if isinstance(section['fields'], list):
-                for spec in section['fields']:
-                    output.update(parse_fields(spec, sub_data))
+                self.fields = [FieldSpec(spec) for spec in section['fields']]
         elif 'lines' in section:
             if isinstance(section['lines'], list):
-                spec = '\\n' +'\\n'.join(section['lines'])
-                output.update(parse_fields(spec, sub_data))
+                self.fields = [FieldSpec('\\n' + '\\n'.join(section['lines']))]
         elif 'table' in section:
             if isinstance(section['table'], list):
-                spec = '\\n' + '\\n'.join(section['table'])
+                self.table = FieldSpec('\\n' + '\\n'.join(section['table']))
             else:
-                spec = section['table']
-            return parse_fields(spec, sub_data, table=True)
-        if 'sections' in section:
-            for sub_name, sub_section in section['sections'].items():
-                output[sub_name] = parse_section(sub_section, sub_data)
-    return output
+                self.table = FieldSpec(section['table'])
+        self.sections = {
+            name: SectionSpec(sub_section) for name, sub_section in section.get('sections', {}).items()
+        }
+
+        # markers of this section and all sub-sections, indexed together before parsing
+        self.index_markers = set(self.markers[:2]) if self.markers else set()
+        for sub_section in self.sections.values():
+            self.index_markers |= sub_section.index_markers
+
+    def parse(self, data):
+        if self.domains:
+            sub_data = '\n'.join(self.domains.findall(data))
+        elif self.domain:
+            m = self.domain.search(data)
+            sub_data = m.group(0) if m else ""
+        else:
+            sub_data = data
+
+        output = {}
+        if sub_data:
+            if self.table:
+                return self.table.parse(sub_data, table=True)
+            for field in self.fields:
+                output.update(field.parse(sub_data))
+            for sub_name, sub_section in self.sections.items():
+                output[sub_name] = sub_section.parse(sub_data)
+        return output
+
+    def select(self, document, ranges):
+        """
+        Byte ranges of the section domain within the ranges of the parent section
+
+        :param document: Document
+        :param ranges: list of (start, end) byte offsets of the parent section
+        :return: list of (start, end) byte offsets
+        """
+        if self.markers:
+            start, end, minimum = self.markers
+            spans = (
+                span for lower, upper in ranges for span in document.spans(start, end, minimum, lower, upper)
+            )
+            if self.domains:
+                return [(start_end, end_start) for start_start, start_end, end_start, end_end in spans]
+            span = next(spans, None)
+            return [(span[0], span[3])] if span else []
+
+        selected = []
+        for lower, upper in ranges:
+            for m in self.byte_domain.finditer(document.view[lower:upper]):
+                group = 1 if self.domains and self.byte_domain.groups else 0
+                selected.append((lower + m.start(group), lower + m.end(group)))
+                if not self.domains:
+                    return selected
+        return selected
+
+    def scan(self, document, ranges=None):
+        """
+        Parse the section in place on byte ranges of a document, equivalent to :meth:`parse` on the text of
+        the ranges joined by new lines.
+
+        :param document: Document
+        :param ranges: list of (start, end) byte offsets, default is the whole document
+        """
+        document.index(self.index_markers)
+        ranges = [(0, len(document))] if ranges is None else ranges
+        if self.domains or self.domain:
+            ranges = self.select(document, ranges)
+
+        output = {}
+        if sum(end - start for start, end in ranges) + len(ranges) > 1:
+            if self.table:
+                return self.table.scan(document, ranges, table=True)
+            for field in self.fields:
+                output.update(field.scan(document, ranges))
+            for sub_name, sub_section in self.sections.items():
+                output[sub_name] = sub_section.scan(document, ranges)
+        return output
+
+
+class Document(object):
+    """
+    Text parsed in place from a buffer, usually a memory-mapped file, with an index of section markers
+
+    :param data: bytes-like object
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.view = memoryview(data)
+        self.positions = {}  # marker -> (match starts, match ends)
+
+    def __len__(self):
+        return len(self.view)
+
+    def index(self, markers):
+        """
+        Locate all occurrences of the markers in one pass over the text. Candidate positions are found by
+        searching for the literal prefixes of all markers at once, and each marker is matched only there.
+
+        :param markers: iterable of regular expressions as bytes, each starting with literal text
+        """
+        regexes = {marker: re.compile(marker, re.DOTALL) for marker in markers if marker not in self.positions}
+        if not regexes:
+            return
+        for marker in regexes:
+            self.positions[marker] = ([], [])
+        prefixes = sorted({literal_prefix(marker) for marker in regexes}, key=len, reverse=True)
+        finder = re.compile(b'|'.join(re.escape(prefix) for prefix in prefixes))
+
+        # continue after the start of each candidate rather than its end, markers may overlap
+        candidate = finder.search(self.data)
+        while candidate:
+            position = candidate.start()
+            for marker, regex in regexes.items():
+                m = regex.match(self.data, position)
+                if m:
+                    self.positions[marker][0].append(m.start())
+                    self.positions[marker][1].append(m.end())
+            candidate = finder.search(self.data, position + 1)
+
+    def spans(self, start, end, minimum=1, lower=0, upper=None):
+        """
+        Non-overlapping spans from a start marker to the nearest following end marker, as matched by the
+        expression <start>(.+?)<end> in DOTALL mode.
+
+        :param start: start marker
+        :param end: end marker
+        :param minimum: minimum number of bytes between the markers
+        :param lower: byte offset where the search starts
+        :param upper: byte offset where the search ends, default is the end of the text
+        :return: generator of tuples (start of start marker, end of start marker, start of end marker,
+            end of end marker)
+        """
+        self.index([start, end])
+        upper = len(self) if upper is None else upper
+        start_starts, start_ends = self.positions[start]
+        end_starts, end_ends = self.positions[end]
+        position = lower
+        while True:
+            i = bisect.bisect_left(start_starts, position)
+            while i < len(start_starts) and start_starts[i] < upper and start_ends[i] > upper:
+                i += 1
+            if i == len(start_starts) or start_starts[i] >= upper:
+                return
+            j = bisect.bisect_left(end_starts, start_ends[i] + minimum)
+            while j < len(end_starts) and end_starts[j] < upper and end_ends[j] > upper:
+                j += 1
+            if j == len(end_starts) or end_starts[j] >= upper:
+                return
+            yield start_starts[i], start_ends[i], end_starts[j], end_ends[j]
+            position = end_ends[j]
+
+    def close(self):
+        self.view.release()
+        if isinstance(self.data, mmap.mmap):
+            try:
+                self.data.close()
+            except BufferError:
+                pass  # views of the map are still referenced, it is closed when they are released
+
+
+@contextlib.contextmanager
+def open_document(filename):
+    """
+    Memory-map a text file for parsing
+
+    :param filename: file name
+    :return: Document
+    """
+    with open(filename, 'rb') as handle:
+        if os.fstat(handle.fileno()).st_size:
+            document = Document(mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ))
+        else:
+            document = Document(b'')
+    try:
+        yield document
+    finally:
+        document.close()
+
+
+@functools.lru_cache(maxsize=None)
+def compile_fields(spec):
+    return FieldSpec(spec)
+
+
+def parse_fields(spec, text, table=False):
+    return compile_fields(spec).parse(text, table=table)
+
+
+def parse_section(section, data):
+    return SectionSpec(section).parse(data)
+
+
+@functools.lru_cache(maxsize=None)
+def get_spec(spec_name):
+    """
+    Compiled specification, loaded once per process from the YAML file or its compiled copy
+
+    :param spec_name: name of the specification file without extension
+    :return: SectionSpec of the root section
+    """
+    spec_file = os.path.join(SPEC_PATH, '{}.yml'.format(spec_name))
+    cache_file = os.path.join(SPEC_CACHE_PATH, '{}.pickle'.format(spec_name))
+    st = os.stat(spec_file)
+    ident = (SPEC_CACHE_VERSION, st.st_size, st.st_mtime_ns)
+    try:
+        with open(cache_file, 'rb') as handle:
+            cached_ident, spec = pickle.load(handle)
+        if cached_ident == ident:
+            return spec
+    except (OSError, EOFError, ValueError, TypeError, AttributeError, pickle.UnpicklingError):
+        pass
+
+    import yaml
+    with open(spec_file, 'r') as handle:
+        spec = SectionSpec(yaml.safe_load(handle)['root'])
+    try:
+        os.makedirs(SPEC_CACHE_PATH, exist_ok=True)
+        tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+        with open(tmp_file, 'wb') as handle:
+            pickle.dump((ident, spec), handle)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
+    return spec
 
 
 def parse_text(data, spec_name):
-    spec_file = '{}.yml'.format(spec_name)
-    with open(os.path.join(SPEC_PATH, spec_file), 'r') as handle:
-        specs = yaml.safe_load(handle)
-    return parse_section(specs['root'], data)
+    return get_spec(spec_name).parse(data)
 
 
 def parse(data_file, spec_name, size=-1):
-    with open(data_file, 'r', encoding='utf-8') as handle:
-        data = handle.read(size)
-    return parse_text(data, spec_name)
+    """
+    Parse a file with a specification
+
+    :param data_file: file name
+    :param spec_name: name of the specification
+    :param size: if given, only parse the first size characters of the file
+    :return: dictionary
+    """
+    if size >= 0:
+        with open(data_file, 'r', encoding='utf-8') as handle:
+            return parse_text(handle.read(size), spec_name)
+    with open_document(data_file) as document:
+        return get_spec(spec_name).scan(document)
 
 
 def cut_section(start, end, s, position=0):
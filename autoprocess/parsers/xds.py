@@ -31,6 +31,14 @@ IDXREF_FAILURES = {
     7: 'Program died'
 }
 
+# start and end markers of the common header and of the statistics of each output dataset in XSCALE.LP
+XSCALE_HEADER = (rb'CONTROL CARDS', rb'CORRECTION FACTORS AS FUNCTION')
+XSCALE_DATASET = (
+    rb'STATISTICS OF SCALED OUTPUT DATA SET : (?:\d+-)?([\w_]+)/?[\w]*?.HKL',
+    rb'R-FACTORS FOR INTENSITIES OF DATA SET [^\n]+?\n'
+)
+XSCALE_NAME = re.compile(XSCALE_DATASET[0])
+
 
 def parse_idxref(filename='IDXREF.LP'):
     info = parser.parse(filename, 'idxref')
@@ -61,8 +69,9 @@ def parse_idxref(filename='IDXREF.LP'):
     else:
         info['failure_code'] = 7
 
-    if misc.file_requirements(filename, 'XPARM.XDS'):
-        info['parameters'] = parse_xparm('XPARM.XDS')
+    xparm_file = os.path.join(os.path.dirname(filename), 'XPARM.XDS')
+    if misc.file_requirements(filename, xparm_file):
+        info['parameters'] = parse_xparm(xparm_file)
     info['failure'] = IDXREF_FAILURES[info['failure_code']]
     return info
 
@@ -78,8 +87,9 @@ def parse_correct(filename='CORRECT.LP'):
         info['summary']['inner_shell'] = info['statistics'][0]
         info['summary']['outer_shell'] = info['statistics'][-1]
 
-    if info['summary']['spacegroup'] == 1 and filename != 'CORRECT.LP.first':
-        shutil.copy(filename, 'CORRECT.LP.first')
+    directory = os.path.dirname(filename)
+    if info['summary']['spacegroup'] == 1 and os.path.basename(filename) != 'CORRECT.LP.first':
+        shutil.copy(filename, os.path.join(directory, 'CORRECT.LP.first'))
 
     for stats in info['standard_errors'][:-1]:
         if stats['i_sigma'] < 0.5:
@@ -91,7 +101,7 @@ def parse_correct(filename='CORRECT.LP'):
             info['summary']['stderr_resolution'] = stats['resol_range'][-1]
 
     # parse GXPARM.XDS and update with more accurate cell parameters
-    xparm = parse_xparm('GXPARM.XDS')
+    xparm = parse_xparm(os.path.join(directory, 'GXPARM.XDS'))
     info['parameters'] = xparm
     info['summary']['unit_cell'] = xparm['unit_cell']
     info['summary']['ISa'] = info['correction_factors']['parameters'].get('ISa', -1)
@@ -101,8 +111,9 @@ def parse_correct(filename='CORRECT.LP'):
 def parse_xplan(filename='XPLAN.LP'):
     raw_info = parser.parse(filename, 'xplan')
 
-    index_info = parse_idxref()
-    correct_info = parse_correct('CORRECT.LP.first')
+    directory = os.path.dirname(filename)
+    index_info = parse_idxref(os.path.join(directory, 'IDXREF.LP'))
+    correct_info = parse_correct(os.path.join(directory, 'CORRECT.LP.first'))
 
     start_plan = {}
     for start_plan in raw_info['summary']:
@@ -209,27 +220,22 @@ def parse_xscale(filename='XSCALE.LP'):
     if not os.path.exists(filename):
         return {'failure': 'Scaling step failed'}
 
-    with open(filename, 'r') as handle:
-        data = handle.read()
-
-    # extract separate sections corresponding to different datasets
-    header = re.compile(r'(CONTROL CARDS.+?CORRECTION FACTORS AS FUNCTION)', re.DOTALL)
-    section = re.compile(
-        r'(STATISTICS OF SCALED OUTPUT DATA SET : (?:\d+-)?([\w_]+)/?[\w]*?.HKL'
-        r'.+?R-FACTORS FOR INTENSITIES OF DATA SET [^\n]+?\n)',
-        re.DOTALL
-    )
-
-    header_text = "\n".join(header.findall(data))
-    data_sections = {}
-    for d, k in section.findall(data):
-        data_sections[k] = header_text + "\n" + d
-    info = {}
-    for k, d in list(data_sections.items()):
-        info[k] = parser.parse_text(d, 'xscale')
-        if len(info[k]['statistics']) > 1:
-            info[k]['summary']['inner_shell'] = info[k]['statistics'][0]
-            info[k]['summary']['outer_shell'] = info[k]['statistics'][-1]
+    # extract separate sections corresponding to different datasets, each parsed with the common header
+    spec = parser.get_spec('xscale')
+    with parser.open_document(filename) as document:
+        document.index(spec.index_markers | set(XSCALE_HEADER + XSCALE_DATASET))
+        header = [(span[0], span[3]) for span in document.spans(*XSCALE_HEADER)]
+        data_sections = {}
+        for span in document.spans(*XSCALE_DATASET):
+            name = XSCALE_NAME.match(document.view[span[0]:span[1]]).group(1).decode('utf-8')
+            data_sections[name] = header + [(span[0], span[3])]
+
+        info = {}
+        for k, ranges in list(data_sections.items()):
+            info[k] = spec.scan(document, ranges)
+            if len(info[k]['statistics']) > 1:
+                info[k]['summary']['inner_shell'] = info[k]['statistics'][0]
+                info[k]['summary']['outer_shell'] = info[k]['statistics'][-1]
     return info
 
 
@@ -240,14 +246,7 @@ def parse_correlations(filename='XSCALE.LP'):
     if not os.path.exists(filename):
         return {'failure': 'Scaling step failed'}
 
-    with open(filename, 'r') as handle:
-        data = handle.read()
-
-    # extract separate sections corresponding to different datasets
-    header = re.compile(r'(CONTROL CARDS.+?CORRECTION FACTORS AS FUNCTION)', re.DOTALL)
-
-    header_text = "\n".join(header.findall(data))
-    return parser.parse_text(header, 'xscale')
+    return parser.parse(filename, 'xscale')
 
 
 def parse_integrate(filename='INTEGRATE.LP'):
@@ -504,6 +504,55 @@ function draw_xy_chart() {
 }
 
 
+function draw_dendrogram(selector, data, width) {
+    // dendrogram from scipy coordinates, leaves are placed at 5, 15, 25, ...
+    var margin = {top: 20, right: 40, bottom: 120, left: 60};
+    var height = 400;
+    var inner_width = width - margin.left - margin.right;
+    var inner_height = height - margin.top - margin.bottom;
+    var ymax = d3.max(data['y'], function (d) {
+        return d3.max(d);
+    }) || 1;
+    var x = d3.scaleLinear().domain([0, 10 * data['labels'].length]).range([0, inner_width]);
+    var y = d3.scaleLinear().domain([0, Math.max(ymax, data['cutoff']) * 1.05]).range([inner_height, 0]);
+    var svg = d3.select(selector).append("svg")
+        .attr("width", width)
+        .attr("height", height)
+        .append("g")
+        .attr("transform", "translate(" + margin.left + "," + margin.top + ")");
+    svg.append("g").attr("class", "y axis").call(d3.axisLeft(y))
+        .append("text")
+        .attr("transform", "rotate(-90)")
+        .attr("y", -45)
+        .attr("x", -inner_height / 2)
+        .style("text-anchor", "middle")
+        .text("Distance (1 - CC)");
+    $.each(data['x'], function (k, xs) {
+        var points = xs.map(function (v, n) {
+            return x(v) + "," + y(data['y'][k][n]);
+        });
+        svg.append("path")
+            .attr("d", "M" + points.join("L"))
+            .attr("fill", "none")
+            .attr("stroke", d3.max(data['y'][k]) <= data['cutoff'] ? "#1f77b4" : "#7f7f7f");
+    });
+    svg.append("line")
+        .attr("x1", 0).attr("x2", inner_width)
+        .attr("y1", y(data['cutoff'])).attr("y2", y(data['cutoff']))
+        .attr("stroke", "#d62728")
+        .attr("stroke-dasharray", "4,4");
+    svg.selectAll(".leaf").data(data['labels']).enter().append("text")
+        .attr("class", "leaf")
+        .attr("transform", function (d, n) {
+            return "translate(" + x(10 * n + 5) + "," + (inner_height + 8) + ") rotate(-60)";
+        })
+        .style("text-anchor", "end")
+        .style("font-size", "10px")
+        .text(function (d) {
+            return d;
+        });
+}
+
 // Report Builder from MxLIVE
 function build_report(selector, report) {
     var converter = new showdown.Converter();
@@ -589,6 +638,12 @@ function build_report(selector, report) {
                 if (entry['title']) {
                     $('#figure-' + i + '-' + j).append("<figcaption class='text-center'>Figure " + ($('svg').length) + '. ' + entry['title'] + "</figcaption>")
                 }
+            } else if (entry['kind'] === 'dendrogram') {
+                $("#entry-" + i + "-" + j).append("<figure id='figure-" + i + "-" + j + "'></figure>");
+                draw_dendrogram('#figure-' + i + '-' + j, entry['data'], section_box.width());
+                if (entry['title']) {
+                    $('#figure-' + i + '-' + j).append("<figcaption class='text-center'>Figure " + ($('svg').length) + '. ' + entry['title'] + "</figcaption>")
+                }
             }
             if (entry['notes']) {
                 entry_row.append("<div class='notes well'>" + converter.makeHtml(entry['notes']) + "</div>");
@@ -0,0 +1,449 @@
+"""
+Content-addressed cache of XDS and XSCALE results.
+
+A cache key is derived from the rendered input file (XDS.INP or XSCALE.INP) and the contents of all
+files consumed by the jobs it describes, and from the size and modification time of the frames they read.
+When a program is run with an identical input file and identical input files, the output files are restored
+from the cache instead of running the program again. Only outputs written by the run are stored.
+
+The cache is located in the directory given by the DPS_CACHE environment variable, or `~/.cache/autoprocess`,
+and its total size is limited to DPS_CACHE_SIZE gigabytes (default 10). Setting DPS_CACHE_SIZE to 0 disables
+the cache. Least recently used entries are evicted first.
+
+Frame headers are cached in the `headers` sub-directory of the same location, keyed by the path, size and
+modification time of the frame and of its directory, so that commands repeated on the same dataset, from the
+command line or the server, do not need to open the data files again. Header entries are small and are not
+counted in the size limit, instead entries not used for HEADER_MAX_AGE seconds, including those made stale by
+new frames, are removed once per process.
+
+"""
+
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import stat
+import tempfile
+import time
+
+import msgpack
+import msgpack_numpy
+
+from autoprocess.utils import log, misc
+
+logger = log.get_module_logger(__name__)
+
+CACHE_DIR = os.environ.get('DPS_CACHE', os.path.join(misc.get_home_dir(), '.cache', 'autoprocess'))
+CACHE_SIZE = float(os.environ.get('DPS_CACHE_SIZE', 10)) * 1024 ** 3
+ENTRY_FILE = 'entry.json'
+HASH_CHUNK = 4 * 1024 ** 2
+HEADER_MAX_AGE = 30 * 86400  # seconds after which unused header cache entries are removed
+
+# Files consumed and produced by each XDS job
+XDS_JOB_FILES = {
+    'XYCORR': (
+        [],
+        ['X-CORRECTIONS.cbf', 'Y-CORRECTIONS.cbf', 'XYCORR.LP']
+    ),
+    'INIT': (
+        ['X-CORRECTIONS.cbf', 'Y-CORRECTIONS.cbf'],
+        ['BKGINIT.cbf', 'BLANK.cbf', 'GAIN.cbf', 'INIT.LP']
+    ),
+    'COLSPOT': (
+        ['X-CORRECTIONS.cbf', 'Y-CORRECTIONS.cbf', 'BKGINIT.cbf', 'BLANK.cbf', 'GAIN.cbf'],
+        ['SPOT.XDS', 'COLSPOT.LP']
+    ),
+    'IDXREF': (
+        ['X-CORRECTIONS.cbf', 'Y-CORRECTIONS.cbf', 'SPOT.XDS'],
+        ['XPARM.XDS', 'IDXREF.LP', 'SPOT.XDS']
+    ),
+    'DEFPIX': (
+        ['X-CORRECTIONS.cbf', 'Y-CORRECTIONS.cbf', 'BKGINIT.cbf', 'XPARM.XDS'],
+        ['BKGPIX.cbf', 'ABS.cbf', 'DEFPIX.LP']
+    ),
+    'INTEGRATE': (
+        ['X-CORRECTIONS.cbf', 'Y-CORRECTIONS.cbf', 'BLANK.cbf', 'GAIN.cbf', 'BKGPIX.cbf', 'XPARM.XDS'],
+        ['INTEGRATE.HKL', 'INTEGRATE.LP', 'FRAME.cbf']
+    ),
+    'CORRECT': (
+        ['X-CORRECTIONS.cbf', 'Y-CORRECTIONS.cbf', 'BKGPIX.cbf', 'XPARM.XDS', 'INTEGRATE.HKL'],
+        ['XDS_ASCII.HKL', 'CORRECT.LP', 'GXPARM.XDS', 'DECAY.cbf', 'MODPIX.cbf', 'ABSORP.cbf']
+    ),
+    'XPLAN': (
+        ['X-CORRECTIONS.cbf', 'Y-CORRECTIONS.cbf', 'BKGINIT.cbf', 'XPARM.XDS'],
+        ['XPLAN.LP']
+    ),
+}
+
+# Jobs which read the diffraction frames
+FRAME_JOBS = ('INIT', 'COLSPOT', 'INTEGRATE')
+
+# Keywords which do not affect the results and are ignored when calculating keys
+IGNORED_KEYWORDS = ('CLUSTER_NODES', 'MAXIMUM_NUMBER_OF_JOBS', 'MAXIMUM_NUMBER_OF_PROCESSORS')
+
+
+def read_input(filename):
+    """
+    Read an XDS style input file and return the normalized text without comments and
+    keywords which do not affect the results.
+
+    :param filename: input file name
+    :return: normalized text
+    """
+    lines = []
+    with open(filename, 'r') as handle:
+        for line in handle:
+            line = line.split('!', 1)[0].strip()
+            if line and not line.startswith(IGNORED_KEYWORDS):
+                lines.append(line)
+    return '\n'.join(lines)
+
+
+def xds_files(text):
+    """
+    Determine the files consumed and produced by the jobs of an XDS input file
+
+    :param text: normalized XDS.INP text
+    :return: tuple of lists (inputs, outputs) or None if the jobs are not known
+    """
+    jobs = re.findall(r'^JOB=\s*(.+)$', text, re.MULTILINE)
+    if not jobs:
+        return
+    inputs = []
+    outputs = []
+    for job in jobs[0].split():
+        if job not in XDS_JOB_FILES:
+            return
+        job_inputs, job_outputs = XDS_JOB_FILES[job]
+        # files produced by earlier jobs of the same run are not inputs
+        inputs.extend(f for f in job_inputs if f not in outputs and f not in inputs)
+        outputs.extend(f for f in job_outputs if f not in outputs)
+    inputs.extend(re.findall(r'^REFERENCE_DATA_SET=\s*(\S+)', text, re.MULTILINE))
+    return inputs, outputs
+
+
+def frame_files(text, directory='.'):
+    """
+    Determine the frames read by the jobs of an XDS input file
+
+    :param text: normalized XDS.INP text
+    :param directory: working directory
+    :return: list of frame file names, empty if no job reads frames
+    """
+    jobs = re.findall(r'^JOB=\s*(.+)$', text, re.MULTILINE)
+    template = re.findall(r'^NAME_TEMPLATE_OF_DATA_FRAMES=\s*(\S+)', text, re.MULTILINE)
+    data_range = re.findall(r'^DATA_RANGE=\s*(\d+)\s+(\d+)', text, re.MULTILINE)
+    if not (jobs and template and data_range) or not set(jobs[0].split()) & set(FRAME_JOBS):
+        return []
+    template = os.path.join(directory, template[0])
+    width = template.count('?')
+    first, last = int(data_range[0][0]), int(data_range[0][1])
+    frames = [template.replace('?' * width, '{:0{}d}'.format(i, width)) for i in range(first, last + 1)]
+    if not any(os.path.exists(frame) for frame in frames[:1] + frames[-1:]):
+        # frames within container files
+        frames = sorted(glob.glob(template))
+    return frames
+
+
+def xscale_files(text):
+    """
+    Determine the files consumed and produced by an XSCALE input file
+
+    :param text: normalized XSCALE.INP text
+    :return: tuple of lists (inputs, outputs)
+    """
+    inputs = re.findall(r'^INPUT_FILE=\s*\*?\s*(\S+)', text, re.MULTILINE)
+    outputs = re.findall(r'^OUTPUT_FILE=\s*(\S+)', text, re.MULTILINE) + ['XSCALE.LP']
+    return inputs, outputs
+
+
+def file_states(filenames, directory='.'):
+    """
+    Size and modification time of existing files
+
+    :param filenames: file names relative to the directory
+    :param directory: directory
+    :return: dictionary mapping file names to (size, mtime_ns) tuples
+    """
+    states = {}
+    for filename in filenames:
+        try:
+            st = os.stat(os.path.join(directory, filename))
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            states[filename] = (st.st_size, st.st_mtime_ns)
+    return states
+
+
+class StepCache(object):
+    """
+    A size-bounded cache of program output files
+
+    :param directory: cache directory
+    :param max_size: maximum size in bytes
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_size=CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.hashes = {}
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def file_hash(self, filename):
+        """
+        Content hash of a file, memoized by path, size and modification time
+
+        :param filename: file name
+        :return: hexadecimal digest
+        """
+        st = os.stat(filename)
+        ident = (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+        if ident not in self.hashes:
+            digest = hashlib.sha1()
+            with open(filename, 'rb') as handle:
+                for chunk in iter(lambda: handle.read(HASH_CHUNK), b''):
+                    digest.update(chunk)
+            self.hashes[ident] = digest.hexdigest()
+        return self.hashes[ident]
+
+    def get_key(self, program, text, inputs, directory='.', frames=()):
+        """
+        Calculate the cache key for a program run
+
+        :param program: program name
+        :param text: normalized input file text
+        :param inputs: list of files consumed by the program, relative to the directory
+        :param directory: working directory of the program
+        :param frames: list of frame files read by the program. Frames are too large to hash, their size and
+            modification time are used, with those of their directories.
+        :return: key or None if a required input file is missing
+        """
+        digest = hashlib.sha1()
+        digest.update(program.encode('utf-8'))
+        digest.update(text.encode('utf-8'))
+        for filename in inputs:
+            path = os.path.join(directory, filename)
+            if not os.path.exists(path):
+                return
+            digest.update('{}:{}'.format(filename, self.file_hash(path)).encode('utf-8'))
+        for path in sorted({os.path.dirname(os.path.abspath(frame)) for frame in frames}) + list(frames):
+            try:
+                st = os.stat(path)
+                digest.update('{}:{}:{}'.format(path, st.st_size, st.st_mtime_ns).encode('utf-8'))
+            except OSError:
+                digest.update('{}:missing'.format(path).encode('utf-8'))
+        return digest.hexdigest()
+
+    def restore(self, key, directory='.'):
+        """
+        Restore the output files of a cache entry into a directory
+
+        :param key: cache key
+        :param directory: destination directory
+        :return: True if the entry was found and restored
+        """
+        path = os.path.join(self.directory, key)
+        entry_file = os.path.join(path, ENTRY_FILE)
+        if not os.path.exists(entry_file):
+            return False
+        try:
+            entry = misc.load_json(entry_file)
+            for i, filename in enumerate(entry['files']):
+                filename = os.path.join(directory, filename)
+                dest_dir = os.path.dirname(filename)
+                if dest_dir and not os.path.exists(dest_dir):
+                    os.makedirs(dest_dir)
+                # new modification times, caches validated against them must see the files as changed
+                shutil.copyfile(os.path.join(path, str(i)), filename)
+            os.utime(entry_file)
+        except (OSError, ValueError, KeyError) as e:
+            logger.debug('Unable to restore cache entry {}: {}'.format(key, e))
+            return False
+        return True
+
+    def store(self, key, outputs, directory='.', previous=None):
+        """
+        Store the output files from a directory in a new cache entry
+
+        :param key: cache key
+        :param outputs: list of output files relative to the directory, missing files are ignored
+        :param directory: source directory
+        :param previous: file states from :func:`file_states` before the run. Files which have not changed since
+            then were not written by the run and are ignored.
+        """
+        previous = previous or {}
+        current = file_states(outputs, directory)
+        files = [f for f in outputs if f in current and current[f] != previous.get(f)]
+        size = sum(os.path.getsize(os.path.join(directory, f)) for f in files)
+        if not files or size > self.max_size:
+            return
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            self.evict(self.max_size - size)
+            tmp_path = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+            for i, filename in enumerate(files):
+                shutil.copy2(os.path.join(directory, filename), os.path.join(tmp_path, str(i)))
+            with open(os.path.join(tmp_path, ENTRY_FILE), 'w') as handle:
+                json.dump({'files': files, 'size': size, 'created': time.time()}, handle)
+            path = os.path.join(self.directory, key)
+            if os.path.exists(path):
+                shutil.rmtree(tmp_path, ignore_errors=True)
+            else:
+                os.rename(tmp_path, path)
+        except OSError as e:
+            logger.debug('Unable to store cache entry {}: {}'.format(key, e))
+
+    def entries(self):
+        """
+        Return a list of (last_used, size, path) tuples for all cache entries
+        """
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for name in os.listdir(self.directory):
+            entry_file = os.path.join(self.directory, name, ENTRY_FILE)
+            try:
+                entries.append((os.path.getmtime(entry_file), misc.load_json(entry_file)['size'],
+                                os.path.join(self.directory, name)))
+            except (OSError, ValueError, KeyError):
+                continue
+        return entries
+
+    def evict(self, limit):
+        """
+        Remove least recently used entries until the total size of the cache is below the limit
+
+        :param limit: size limit in bytes
+        """
+        entries = sorted(self.entries())
+        total = sum(size for used, size, path in entries)
+        while entries and total > limit:
+            used, size, path = entries.pop(0)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def run(self, command, input_file):
+        """
+        Run a command in its working directory, restoring results from the cache if possible
+
+        :param command: programs.Command instance
+        :param input_file: XDS.INP or XSCALE.INP
+        """
+        key = None
+        directory = command.directory
+        input_path = os.path.join(directory, input_file)
+        if self.enabled and os.path.exists(input_path):
+            text = read_input(input_path)
+            files = xscale_files(text) if input_file == 'XSCALE.INP' else xds_files(text)
+            if files is not None:
+                inputs, outputs = files
+                frames = frame_files(text, directory) if input_file == 'XDS.INP' else []
+                key = self.get_key(input_file, text, inputs, directory=directory, frames=frames)
+        if key and self.restore(key, directory=directory):
+            logger.debug('Restored results of {} from cache entry {}'.format(command.args, key))
+            command.skip('done (cached)')
+            return
+
+        previous = file_states(outputs, directory) if key else None
+        command.start()
+        if key:
+            self.store(key, outputs, directory=directory, previous=previous)
+
+
+
+def _encode(obj):
+    encoded = msgpack_numpy.encode(obj)
+    return str(obj) if encoded is obj else encoded
+
+
+class HeaderCache(object):
+    """
+    A persistent cache of values read from data files, such as frame headers
+
+    :param directory: cache directory
+    :param enabled: whether values are saved and restored
+    :param max_age: seconds after which unused entries are removed
+    """
+
+    def __init__(self, directory=os.path.join(CACHE_DIR, 'headers'), enabled=CACHE_SIZE > 0, max_age=HEADER_MAX_AGE):
+        self.directory = directory
+        self.enabled = enabled
+        self.max_age = max_age
+        self.pruned = False
+
+    def prune(self):
+        """
+        Remove entries which have not been used for longer than the maximum age
+        """
+        limit = time.time() - self.max_age
+        # leftovers of interrupted writes are hidden files
+        paths = glob.glob(os.path.join(self.directory, '*', '*'))
+        paths += glob.glob(os.path.join(self.directory, '*', '.tmp-*'))
+        for path in paths:
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.remove(path)
+            except OSError:
+                continue
+
+    def get_key(self, filename, tag):
+        """
+        Calculate the cache key of a value read from a file. Adding files to the directory of the file,
+        for example new frames of the same dataset, changes the key.
+
+        :param filename: data file name
+        :param tag: name of the value, including the version of the reader
+        :return: key
+        """
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        dir_st = os.stat(os.path.dirname(path))
+        ident = '{}:{}:{}:{}:{}'.format(tag, path, st.st_size, st.st_mtime_ns, dir_st.st_mtime_ns)
+        return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+    def fetch(self, filename, reader, tag='header'):
+        """
+        Return the value read from a file, from the cache if possible
+
+        :param filename: data file name
+        :param reader: function which reads the value, called with the file name on a cache miss
+        :param tag: name of the value, including the version of the reader
+        :return: value
+        """
+        if not self.enabled:
+            return reader(filename)
+        key = self.get_key(filename, tag)
+        path = os.path.join(self.directory, key[:2], key)
+        try:
+            with open(path, 'rb') as handle:
+                value = msgpack.unpack(handle, object_hook=msgpack_numpy.decode, strict_map_key=False)
+            os.utime(path)
+            return value
+        except (OSError, ValueError):
+            pass
+
+        value = reader(filename)
+        if not self.pruned:
+            self.pruned = True
+            self.prune()
+        try:
+            data = msgpack.packb(value, default=_encode)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            handle, tmp_name = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+            with os.fdopen(handle, 'wb') as outfile:
+                outfile.write(data)
+            os.replace(tmp_name, path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.debug('Unable to cache {} of {}: {}'.format(tag, filename, e))
+        return value
+
+
+STEP_CACHE = StepCache()
+HEADER_CACHE = HeaderCache()
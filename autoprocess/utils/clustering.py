@@ -0,0 +1,136 @@
+"""
+Clustering of datasets by the correlation of their intensities.
+
+The pairwise correlation coefficients are held in a dense matrix, which is filled in one step from the
+correlation table of XSCALE.
+
+Datasets are clustered by agglomerative hierarchical clustering of the distances 1 - CC using SciPy, which
+is only imported when needed.
+
+"""
+
+import numpy
+
+LINKAGE_METHODS = ('single', 'complete', 'average', 'weighted')
+DEFAULT_LINKAGE = 'complete'
+DEFAULT_CUTOFF = 0.05  # largest distance (1 - CC) between datasets of the same cluster
+MIN_COMMON = 10  # minimum number of common reflections for a valid correlation
+
+
+class CorrelationMatrix(object):
+    """
+    Pairwise correlations between datasets
+    """
+
+    def __init__(self):
+        self.names = []
+        self.matrix = numpy.zeros((0, 0))
+        self.counts = numpy.zeros((0, 0), dtype=int)
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_correlations(cls, names, correlations):
+        """
+        Create the matrix from a list of pairwise correlations as parsed from XSCALE.LP
+
+        :param names: dataset names in the order of the XSCALE inputs
+        :param correlations: list of dictionaries with keys 'i', 'j' (1-based), 'corr' and 'num'
+        :return: CorrelationMatrix
+        """
+        matrix = cls()
+        size = len(names)
+        matrix.names = list(names)
+        matrix.matrix = numpy.eye(size)
+        matrix.counts = numpy.zeros((size, size), dtype=int)
+        if correlations:
+            table = numpy.array([(v['i'], v['j'], v['corr'], v['num']) for v in correlations])
+            i, j = table[:, 0].astype(int) - 1, table[:, 1].astype(int) - 1
+            matrix.matrix[i, j] = matrix.matrix[j, i] = table[:, 2]
+            matrix.counts[i, j] = matrix.counts[j, i] = table[:, 3]
+        return matrix
+
+    def distances(self):
+        """
+        Condensed distance matrix, 1 - CC. Pairs with too few common reflections are at the maximum distance.
+        """
+        from scipy.spatial import distance
+        dist = numpy.clip(1 - self.matrix, 0, 2)
+        dist[(self.counts < MIN_COMMON) & ~numpy.eye(len(self), dtype=bool)] = 2.0
+        numpy.fill_diagonal(dist, 0)
+        return distance.squareform(dist, checks=False)
+
+
+class Clustering(object):
+    """
+    Hierarchical clustering of datasets
+
+    :param correlations: CorrelationMatrix
+    :param method: linkage method, one of LINKAGE_METHODS
+    """
+
+    def __init__(self, correlations, method=DEFAULT_LINKAGE):
+        if method not in LINKAGE_METHODS:
+            raise ValueError('Unknown linkage method: {}'.format(method))
+        from scipy.cluster import hierarchy
+        self.names = list(correlations.names)
+        self.method = method
+        self.linkage = hierarchy.linkage(correlations.distances(), method=method)
+
+    def clusters(self, cutoff=DEFAULT_CUTOFF):
+        """
+        Clusters of datasets closer than the cutoff distance
+
+        :param cutoff: largest distance (1 - CC) within a cluster
+        :return: list of lists of dataset names, largest cluster first
+        """
+        from scipy.cluster import hierarchy
+        labels = hierarchy.fcluster(self.linkage, t=cutoff, criterion='distance')
+        groups = {}
+        for name, label in zip(self.names, labels):
+            groups.setdefault(label, []).append(name)
+        return sorted(groups.values(), key=len, reverse=True)
+
+    def largest(self, cutoff=DEFAULT_CUTOFF):
+        return self.clusters(cutoff)[0]
+
+    def dendrogram(self, cutoff=DEFAULT_CUTOFF):
+        """
+        Dendrogram of the clustering in the form used by the report
+
+        :param cutoff: cluster cutoff distance, marked on the dendrogram
+        :return: dictionary
+        """
+        from scipy.cluster import hierarchy
+        tree = hierarchy.dendrogram(self.linkage, labels=self.names, no_plot=True, color_threshold=cutoff)
+
+        def _nested(node):
+            if node.is_leaf():
+                return self.names[node.id]
+            return [round(node.dist, 4), _nested(node.left), _nested(node.right)]
+
+        return {
+            'labels': tree['ivl'],
+            'x': [[round(v, 4) for v in x] for x in tree['icoord']],
+            'y': [[round(v, 4) for v in y] for y in tree['dcoord']],
+            'tree': _nested(hierarchy.to_tree(self.linkage)),
+            'cutoff': cutoff,
+            'linkage': self.method,
+        }
+
+
+def dendrogram_text(tree, prefix=''):
+    """
+    Draw a dendrogram as text
+
+    :param tree: nested lists [distance, left, right] with dataset names as leaves
+    :param prefix: indentation of the current level
+    :return: list of lines
+    """
+    if not isinstance(tree, list):
+        return ['{}+-- {}'.format(prefix, tree)]
+    lines = ['{}+-- {:0.3f}'.format(prefix, tree[0])]
+    lines += dendrogram_text(tree[1], prefix + '|   ')
+    lines += dendrogram_text(tree[2], prefix + '    ')
+    return lines
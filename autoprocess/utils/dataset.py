@@ -1,20 +1,54 @@
+import functools
 import glob
+import inspect
 import os
 import re
+import time
 
 import numpy
-from mxio import read_image
-from scipy.ndimage import filters
-from scipy.ndimage import measurements
 
 import autoprocess.errors
 from autoprocess.utils import misc
+from autoprocess.utils.cache import HEADER_CACHE
+from autoprocess.utils.frames import FrameSet
 from autoprocess.utils.log import get_module_logger
 
 logger = get_module_logger(__name__)
 
 
+@functools.lru_cache(maxsize=None)
+def header_only_supported():
+    """
+    Whether the installed mxio can read the header of a frame without its image data. Current mxio
+    releases cannot, so the whole frame is read on a header cache miss.
+    """
+    from mxio import read_image
+    try:
+        return 'header_only' in inspect.signature(read_image).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def read_header(filename):
+    """
+    Read the header of a frame, including the dataset sequence, without the image data if supported by mxio
+    """
+    from mxio import read_image
+    if header_only_supported():
+        return read_image(filename, header_only=True).header
+    return read_image(filename).header
+
+
 def detect_beam_peak(filename):
+    """
+    Find the position of the direct beam on a frame, cached for each frame
+    """
+    return tuple(HEADER_CACHE.fetch(filename, _find_beam_peak, tag='beam-peak'))
+
+
+def _find_beam_peak(filename):
+    from mxio import read_image
+    from scipy.ndimage import filters, measurements
     img_info = read_image(filename)
     img = img_info.image
     img_array = numpy.fromstring(img.tostring(), numpy.uint32)
@@ -33,7 +67,7 @@ def detect_beam_peak(filename):
     if cmin[0] < beam_y < cmax[0] and cmin[1] < beam_x < cmax[1]:
         good = True
 
-    return beam_x, beam_y, good
+    return int(beam_x), int(beam_y), good
 
 
 def import_parameters(inp_file):
@@ -45,36 +79,18 @@ def import_parameters(inp_file):
 
 
 def summarize_list(full_frame_set):
-    # takes a list of integers such as [1,2,3,4,6,7,8]
-    # and reduces it to the string [(1,4),(6,8)]
-    sum_list = []
-    tmp_pairs = []
-    full_set = list(set(full_frame_set))
-
-    if len(full_set) == 0:
-        return ""
-    full_set.sort()
-    cur = full_set.pop(0)
-    tmp_pairs.append([cur, cur])
-    while len(full_set) > 0:
-        cur = full_set.pop(0)
-        last_pair = tmp_pairs[-1]
-        if (cur - last_pair[-1]) == 1:
-            last_pair[-1] = cur
-        else:
-            tmp_pairs.append([cur, cur])
-
-    return tmp_pairs
+    """
+    Reduce a list of frame numbers such as [1, 2, 3, 4, 6, 7, 8] to the list of ranges [(1, 4), (6, 8)]
+    """
+    return FrameSet.from_frames(full_frame_set).ranges()
 
 
 def summarize_gaps(frame_list):
-    # takes a list of integers such as [1,2,3,4,7,8]
-    # and reduces it to the string of skipped regions such as "[(5,6)]"
-
-    complete_set = set(range(1, max(frame_list) + 1))
-    frame_set = set(frame_list)
-    full_set = list(complete_set.difference(frame_set))
-    return summarize_list(full_set)
+    """
+    Reduce a list of frame numbers such as [1, 2, 3, 4, 7, 8] to the list of missing ranges [(5, 6)],
+    counting from frame 1
+    """
+    return FrameSet.from_frames(frame_list).gaps(first=1).ranges()
 
 
 def get_parameters(img_file):
@@ -83,43 +99,96 @@ def get_parameters(img_file):
     returns a dictionary of results
     
     """
-    data = read_image(os.path.abspath(img_file))
-    if not data.header['dataset'] or len(data.header['dataset']['sequence']) == 0:
+    import mxio
+    # cached headers are only valid for the version of mxio which read them
+    tag = 'header:{}'.format(getattr(mxio, '__version__', ''))
+    info = HEADER_CACHE.fetch(os.path.abspath(img_file), read_header, tag=tag)
+    if not info.get('dataset') or len(info['dataset']['sequence']) == 0:
         logger.error("Dataset not found")
         raise autoprocess.errors.DatasetError('Dataset not found')
 
-    info = data.header
     info['energy'] = misc.wavelength_to_energy(info['wavelength'])
     info['first_frame'] = info['dataset']['sequence'][0]
-    info['frame_count'] = info['dataset']['sequence'][-1]
     info['name'] = info['dataset']['label']
     info['file_template'] = os.path.join(info['dataset']['directory'], info['dataset']['template'])
 
-    # Generate a list of wedges. each wedge is a tuple. The first value is the
-    # first frame number and the second is the number of frames in the wedge
-    wedges = summarize_list(info['dataset']['sequence'])
+    info.update(frame_parameters(info, info['dataset']['sequence']))
+    return info
+
 
-    # determine spot ranges from wedges
-    # up to 4 degrees per wedge starting at 0 and 45 and 90
+def frame_parameters(info, sequence):
+    """
+    Determine the frame dependent parameters of a dataset from the list of frame numbers available
+
+    :param info: dataset parameters, the oscillation angle 'delta_angle' is required
+    :param sequence: sorted list of frame numbers
+    :return: dictionary of frame ranges
+    """
+
+    frames = FrameSet.from_frames(sequence)
+
+    # determine spot ranges from the frames available within
+    # up to 4 degrees starting at 0 and 45 and 90
     spot_range = []
     spot_span = int(4.0 // info['delta_angle'])  # frames in 4 deg
-    first_wedge = wedges[0]
-
     for _ang in [0.0, 45.0, 90.0]:
-        _rs = first_wedge[0] + int(_ang // info['delta_angle'])
-        _re = _rs + spot_span
-        _exp_set = set(range(_rs, _re))
-        for wedge in wedges:
-            _obs_set = set(range(wedge[0], wedge[0] + wedge[1]))
-            _range = (_exp_set & _obs_set)
-            if len(_range) > 0:
-                spot_range.append((min(_range), max(_range)))
-
-    biggest_wedge = sorted(wedges, key=lambda x: x[1], reverse=True)[0]
-
-    info['spot_range'] = spot_range
-    info['data_range'] = info['dataset']['sequence'][0], info['dataset']['sequence'][-1]
-    info['background_range'] = (biggest_wedge[0], biggest_wedge[0] + min(10, biggest_wedge[1]) - 1)
-    info['skip_range'] = summarize_gaps(info['dataset']['sequence'])
-    info['max_delphi'] = info['delta_angle'] * biggest_wedge[1]
-    return info
+        _rs = frames.first + int(_ang // info['delta_angle'])
+        spot_range.extend((frames & FrameSet([(_rs, _rs + spot_span - 1)])).ranges())
+
+    # the biggest wedge of contiguous frames
+    sizes = frames.sizes()
+    biggest = int(numpy.argmax(sizes))
+    wedge_start, wedge_size = int(frames.starts[biggest]), int(sizes[biggest])
+
+    return {
+        'frame_count': frames.last,
+        'spot_range': spot_range,
+        'data_range': (frames.first, frames.last),
+        'background_range': (wedge_start, wedge_start + min(10, wedge_size) - 1),
+        'skip_range': frames.gaps(first=1).ranges(),
+        'max_delphi': info['delta_angle'] * wedge_size,
+    }
+
+
+def list_frames(template):
+    """
+    Return the sorted list of frame numbers of all the files on disk matching a frame template
+
+    :param template: file name template with the frame number represented by '?' characters
+    """
+    head, width, tail = re.match(r'^(.*?)(\?+)([^?]*)$', template).groups()
+    pattern = re.compile(r'^{}(\d{{{}}}){}$'.format(re.escape(head), len(width), re.escape(tail)))
+    frames = []
+    for filename in glob.glob(template):
+        match = pattern.match(filename)
+        if match:
+            frames.append(int(match.group(1)))
+    return sorted(frames)
+
+
+def wait_for_frames(template, first_frame, last_frame, timeout=60.0, interval=2.0):
+    """
+    Wait until all frames from first_frame to last_frame are on disk. Frames are polled at the given interval,
+    waiting stops early if no new frames appear within the timeout.
+
+    :param template: file name template with the frame number represented by '?' characters
+    :param first_frame: first frame number
+    :param last_frame: last frame number
+    :param timeout: time in seconds to wait for a new frame before giving up
+    :param interval: polling interval in seconds
+    :return: tuple (frames, complete) where frames is the sorted list of frame numbers from first_frame on disk,
+        and complete is False if the timeout expired
+    """
+    required = set(range(first_frame, last_frame + 1))
+    count = 0
+    last_change = time.time()
+    while True:
+        frames = [frame for frame in list_frames(template) if frame >= first_frame]
+        if required <= set(frames):
+            return frames, True
+        if len(frames) != count:
+            count = len(frames)
+            last_change = time.time()
+        elif time.time() - last_change > timeout:
+            return frames, False
+        time.sleep(interval)
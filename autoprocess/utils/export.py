@@ -0,0 +1,334 @@
+"""
+Native export of reflection files.
+
+XDS_ASCII.HKL or XSCALE.HKL files are read once into NumPy arrays through hklio, symmetry equivalent
+observations are merged and the merged reflections are written as MTZ, SHELX (HKLF 4) and CNS files without external
+programs. CNS amplitudes are estimated from the intensities by the method of French & Wilson. Free-R flags are
+derived from the asymmetric unit indices of each reflection, so that the same reflection receives the same flag
+in every file and in every dataset of the same crystal form.
+
+"""
+
+import os
+import re
+import struct
+import time
+
+import numpy
+
+from autoprocess.utils import hklio, log, xtal
+
+logger = log.get_module_logger(__name__)
+
+FREE_R_FRACTION = 0.05
+SHELX_MAX_INTENSITY = 99999.0  # largest value which fits the F8.2 fields of HKLF 4 files
+WILSON_BINS = 20  # resolution shells for the mean intensity of the French & Wilson prior
+POSTERIOR_POINTS = 201  # amplitude samples for integrating the posterior of each reflection
+SYMBOL_TOKENS = re.compile(r'-?\d(?:\(\d\))?(?:/[abcdemn])?|[abcdemn]')
+
+
+def free_r_flags(hkl, fraction=FREE_R_FRACTION):
+    """
+    Deterministic free-R flags following the CCP4 convention, reflections flagged 0 form the test set
+
+    :param hkl: asymmetric unit indices, integer array of shape (n, 3)
+    :param fraction: approximate fraction of test reflections
+    :return: integer array of flags in the range 0 to round(1/fraction) - 1
+    """
+    num_flags = max(2, int(round(1.0 / fraction)))
+    index = hkl.astype(numpy.uint64) + numpy.uint64(1 << 20)
+    code = (index[:, 0] << numpy.uint64(42)) | (index[:, 1] << numpy.uint64(21)) | index[:, 2]
+    # splitmix64 finalizer, scatters neighbouring indices uniformly
+    with numpy.errstate(over='ignore'):
+        code ^= code >> numpy.uint64(30)
+        code *= numpy.uint64(0xbf58476d1ce4e5b9)
+        code ^= code >> numpy.uint64(27)
+        code *= numpy.uint64(0x94d049bb133111eb)
+        code ^= code >> numpy.uint64(31)
+    return (code % numpy.uint64(num_flags)).astype(numpy.int32)
+
+
+def _merge(keys, intensity, weight, size):
+    """Inverse variance weighted mean of observations grouped by keys"""
+    total = numpy.bincount(keys, weights=weight, minlength=size)
+    mean = numpy.full(size, numpy.nan)
+    sigma = numpy.full(size, numpy.nan)
+    valid = total > 0
+    mean[valid] = numpy.bincount(keys, weights=weight * intensity, minlength=size)[valid] / total[valid]
+    sigma[valid] = 1 / numpy.sqrt(total[valid])
+    return mean, sigma
+
+
+def wilson_intensity(intensity, inv_d2, num_bins=WILSON_BINS):
+    """
+    Mean intensity as a function of resolution, from shells containing equal numbers of reflections
+
+    :param intensity: intensities divided by their epsilon factors
+    :param inv_d2: 1/d² of the reflections
+    :param num_bins: number of resolution shells
+    :return: function of 1/d² returning the mean intensity
+    """
+    order = numpy.argsort(inv_d2)
+    shells = [shell for shell in numpy.array_split(order, max(1, min(num_bins, len(order) // 50))) if len(shell)]
+    centres = numpy.array([inv_d2[shell].mean() for shell in shells])
+    means = numpy.array([intensity[shell].mean() for shell in shells])
+    # shells of weak data can average to zero or less, the prior needs a positive mean
+    floor = max(numpy.abs(intensity).mean(), 1e-6) * 1e-3
+    means = numpy.clip(means, floor, None)
+    return lambda values: numpy.interp(values, centres, means)
+
+
+def french_wilson(intensity, sigma, expected, centric, chunk_size=4096):
+    """
+    Amplitudes from intensities following French & Wilson (1978). The Wilson distribution of acentric or
+    centric reflections with the expected intensity is the prior, the amplitude and its error are the mean
+    and standard deviation of the posterior distribution of the amplitude given the measured intensity.
+
+    :param intensity: measured intensities
+    :param sigma: errors of the intensities
+    :param expected: expected intensities, epsilon times the mean intensity at the resolution of each reflection
+    :param centric: boolean array, True for centric reflections
+    :param chunk_size: number of reflections integrated at a time, limits the memory used
+    :return: tuple of arrays (amplitude, sigma)
+    """
+    amplitude = numpy.empty(len(intensity))
+    sigma_amplitude = numpy.empty(len(intensity))
+    steps = numpy.linspace(0.0, 1.0, POSTERIOR_POINTS)
+    # trapezoidal rule, the samples of each reflection are evenly spaced so only ratios of sums are needed
+    rule = numpy.ones(POSTERIOR_POINTS)
+    rule[[0, -1]] = 0.5
+    for start in range(0, len(intensity), chunk_size):
+        block = slice(start, start + chunk_size)
+        sig = sigma[block][:, None]
+        acentric = ~centric[block][:, None]
+
+        # combined with the prior, the likelihood of F² is a gaussian centred at h, times F for acentrics
+        h = intensity[block][:, None] - sig ** 2 / (numpy.where(acentric, 1.0, 2.0) * expected[block][:, None])
+        low = numpy.sqrt(numpy.clip(h - 6 * sig, 0, None))
+        high = numpy.sqrt(numpy.clip(h, 0, None) + 6 * sig)
+        values = low + (high - low) * steps
+        exponent = -(values ** 2 - h) ** 2 / (2 * sig ** 2)
+        density = numpy.exp(exponent - exponent.max(axis=1, keepdims=True))
+        density = numpy.where(acentric, values * density, density) * rule
+
+        total = density.sum(axis=1)
+        mean = (values * density).sum(axis=1) / total
+        mean_square = (values ** 2 * density).sum(axis=1) / total
+        amplitude[block] = mean
+        sigma_amplitude[block] = numpy.sqrt(numpy.clip(mean_square - mean ** 2, 0, None))
+    return amplitude, sigma_amplitude
+
+
+class Reflections(object):
+    """
+    Merged reflections of an XDS_ASCII.HKL or XSCALE.HKL file
+
+    :param filename: reflection file
+    :param free_r_fraction: fraction of reflections in the free-R test set
+    """
+
+    def __init__(self, filename, free_r_fraction=FREE_R_FRACTION):
+        reflection_file, data = hklio.read_reflections(filename, columns=['H', 'K', 'L', 'IOBS', 'SIGMA(IOBS)'])
+        self.filename = filename
+        self.space_group = reflection_file.space_group
+        self.unit_cell = reflection_file.unit_cell
+        self.wavelength = reflection_file.wavelength
+
+        # misfits and rejected observations have negative sigmas
+        valid = data['SIGMA(IOBS)'] > 0
+        hkl = numpy.column_stack([data['H'], data['K'], data['L']])[valid].astype(numpy.int32)
+        intensity = data['IOBS'][valid].astype(float)
+        weight = 1 / data['SIGMA(IOBS)'][valid].astype(float) ** 2
+
+        asu_hkl, minus = xtal.map_to_asu(hkl, self.space_group)
+        self.hkl, keys = xtal.unique_hkl(asu_hkl)
+        size = len(self.hkl)
+
+        self.centric = xtal.is_centric(self.hkl, self.space_group)
+        self.mean, self.sigma = _merge(keys, intensity, weight, size)
+        plus, sig_plus = _merge(keys[~minus], intensity[~minus], weight[~minus], size)
+        neg, sig_neg = _merge(keys[minus], intensity[minus], weight[minus], size)
+
+        # centric reflections have no anomalous differences, both halves are the mean
+        self.plus = numpy.where(self.centric, self.mean, plus)
+        self.sigma_plus = numpy.where(self.centric, self.sigma, sig_plus)
+        self.minus = numpy.where(self.centric, self.mean, neg)
+        self.sigma_minus = numpy.where(self.centric, self.sigma, sig_neg)
+        self.free_r = free_r_flags(self.hkl, free_r_fraction)
+        self.inv_d2 = xtal.inverse_d_squared(self.hkl, self.unit_cell)
+        self.epsilon = xtal.epsilon_factor(self.hkl, self.space_group)
+
+    def __len__(self):
+        return len(self.hkl)
+
+    def amplitudes(self, intensity, sigma, rows):
+        """
+        Convert intensities to amplitudes by the French & Wilson method, using the mean intensities
+        of all merged reflections for the prior. Weak and negative intensities give small positive amplitudes.
+
+        :param intensity: intensities to convert
+        :param sigma: errors of the intensities
+        :param rows: merged reflection of each intensity, for its resolution, epsilon factor and centricity
+        :return: tuple of arrays (amplitude, sigma)
+        """
+        valid = numpy.isfinite(self.mean)
+        mean_intensity = wilson_intensity(self.mean[valid] / self.epsilon[valid], self.inv_d2[valid])
+        expected = self.epsilon[rows] * mean_intensity(self.inv_d2[rows])
+        return french_wilson(intensity, sigma, expected, self.centric[rows])
+
+
+def _mtz_symbol(sg_number):
+    """
+    Space group and point group names in the form used by CCP4, eg ('P 21 21 21', 'PG222') for P2(1)2(1)2(1).
+    Rhombohedral space groups are in the hexagonal setting and named H 3 and H 3 2.
+    """
+    name = xtal.SG_SYMBOLS[sg_number]
+    tokens = SYMBOL_TOKENS.findall(name[1:])
+    lattice = 'H' if name[0] == 'R' else name[0]
+    symbol = ' '.join([lattice] + [token.replace('(', '').replace(')', '') for token in tokens])
+    point_group = re.sub(r'\(\d\)', '', ''.join(tokens))
+    point_group = re.sub(r'[abcdemn]', 'm', point_group)
+    return symbol, 'PG{}'.format(point_group)
+
+
+def write_mtz(reflections, filename, project='AutoProcess', crystal='XTAL', dataset='DATA'):
+    """
+    Write merged intensities to an MTZ file with columns H, K, L, FreeRflag, IMEAN, SIGIMEAN, I(+), SIGI(+),
+    I(-) and SIGI(-)
+
+    :param reflections: Reflections instance
+    :param filename: output file name
+    :param project: project name
+    :param crystal: crystal name
+    :param dataset: dataset name
+    """
+    columns = [
+        ('H', 'H', reflections.hkl[:, 0], 0),
+        ('K', 'H', reflections.hkl[:, 1], 0),
+        ('L', 'H', reflections.hkl[:, 2], 0),
+        ('FreeRflag', 'I', reflections.free_r, 1),
+        ('IMEAN', 'J', reflections.mean, 1),
+        ('SIGIMEAN', 'Q', reflections.sigma, 1),
+        ('I(+)', 'K', reflections.plus, 1),
+        ('SIGI(+)', 'M', reflections.sigma_plus, 1),
+        ('I(-)', 'K', reflections.minus, 1),
+        ('SIGI(-)', 'M', reflections.sigma_minus, 1),
+    ]
+    table = numpy.column_stack([values.astype('<f4') for _, _, values, _ in columns])
+    num_columns, num_refl = len(columns), len(reflections)
+
+    info = xtal.XTAL_TABLES[str(reflections.space_group)]
+    symops = info['symmetry']
+    num_primitive = len(xtal.get_rotations(reflections.space_group))
+    symbol, point_group = _mtz_symbol(reflections.space_group)
+    cell = ' '.join('{:9.4f}'.format(v) for v in reflections.unit_cell)
+    resolution = (reflections.inv_d2.min(), reflections.inv_d2.max()) if num_refl else (0, 0)
+
+    records = [
+        'VERS MTZ:V1.1',
+        'TITLE {}'.format(os.path.basename(reflections.filename)),
+        'NCOL {:8d} {:12d} {:8d}'.format(num_columns, num_refl, 0),
+        'CELL  {}'.format(cell),
+        'SORT    1   2   3   0   0',
+        "SYMINF {:3d} {:2d} {} {:5d} {:>22s} {:>5s}".format(
+            len(symops), num_primitive, symbol[0], reflections.space_group, "'{}'".format(symbol), point_group
+        ),
+    ] + [
+        'SYMM {}'.format(op) for op in symops
+    ] + [
+        'RESO {:<20.12f}{:<20.12f}'.format(*resolution),
+        'VALM NAN',
+    ] + [
+        'COLUMN {:<30s} {} {:>17.4f} {:>17.4f} {:4d}'.format(
+            label, kind, numpy.nanmin(values) if num_refl else 0, numpy.nanmax(values) if num_refl else 0, ident
+        ) for label, kind, values, ident in columns
+    ] + [
+        'NDIF        2',
+        'PROJECT       0 HKL_base',
+        'CRYSTAL       0 HKL_base',
+        'DATASET       0 HKL_base',
+        'DCELL         0 {}'.format(cell),
+        'DWAVEL        0    0.00000',
+        'PROJECT       1 {}'.format(project),
+        'CRYSTAL       1 {}'.format(crystal),
+        'DATASET       1 {}'.format(dataset),
+        'DCELL         1 {}'.format(cell),
+        'DWAVEL        1 {:10.5f}'.format(reflections.wavelength),
+        'END',
+        'MTZHIST   1',
+        'From auto.process export, {}'.format(time.strftime('%d/%b/%Y %H:%M:%S')),
+        'MTZENDOFHEADERS',
+    ]
+    with open(filename, 'wb') as handle:
+        # header location in 4-byte words, counting from 1, and the machine stamp for little endian IEEE
+        handle.write(b'MTZ ' + struct.pack('<i', 21 + num_columns * num_refl) + bytes([0x44, 0x41, 0, 0]))
+        handle.write(bytes(80 - 12))
+        handle.write(table.tobytes())
+        handle.write(''.join('{:<80.80s}'.format(record) for record in records).encode('ascii'))
+
+
+def write_shelx(reflections, filename, anomalous=False):
+    """
+    Write merged intensities to a SHELX HKLF 4 file. Intensities are scaled down if necessary to fit the
+    fixed format fields.
+
+    :param reflections: Reflections instance
+    :param filename: output file name
+    :param anomalous: write I(+) and I(-) as separate reflections
+    """
+    if anomalous:
+        hkl = numpy.concatenate([reflections.hkl, -reflections.hkl[~reflections.centric]])
+        intensity = numpy.concatenate([reflections.plus, reflections.minus[~reflections.centric]])
+        sigma = numpy.concatenate([reflections.sigma_plus, reflections.sigma_minus[~reflections.centric]])
+    else:
+        hkl, intensity, sigma = reflections.hkl, reflections.mean, reflections.sigma
+    valid = numpy.isfinite(intensity) & numpy.isfinite(sigma)
+    hkl, intensity, sigma = hkl[valid], intensity[valid], sigma[valid]
+
+    largest = numpy.abs(intensity).max() if len(intensity) else 0
+    scale = min(1.0, SHELX_MAX_INTENSITY / largest) if largest else 1.0
+    if scale < 1:
+        logger.debug('Intensities scaled by {:0.4g} to fit the SHELX format'.format(scale))
+    table = numpy.column_stack([hkl, intensity * scale, sigma * scale])
+    with open(filename, 'w') as handle:
+        numpy.savetxt(handle, table, fmt='%4d%4d%4d%8.2f%8.2f')
+        handle.write('{:4d}{:4d}{:4d}{:8.2f}{:8.2f}\n'.format(0, 0, 0, 0, 0))
+
+
+def write_cns(reflections, filename, anomalous=False):
+    """
+    Write merged amplitudes and intensities to a CNS reflection file. The test set is flagged with TEST=1.
+
+    :param reflections: Reflections instance
+    :param filename: output file name
+    :param anomalous: write F(+) and F(-) as separate reflections
+    """
+    rows = numpy.arange(len(reflections))
+    if anomalous:
+        acentric = rows[~reflections.centric]
+        rows = numpy.concatenate([rows, acentric])
+        hkl = numpy.concatenate([reflections.hkl, -reflections.hkl[acentric]])
+        intensity = numpy.concatenate([reflections.plus, reflections.minus[acentric]])
+        sigma = numpy.concatenate([reflections.sigma_plus, reflections.sigma_minus[acentric]])
+    else:
+        hkl, intensity, sigma = reflections.hkl, reflections.mean, reflections.sigma
+    valid = numpy.isfinite(intensity) & numpy.isfinite(sigma)
+    hkl, intensity, sigma, rows = hkl[valid], intensity[valid], sigma[valid], rows[valid]
+    test = reflections.free_r[rows]
+    amplitude, sigma_amplitude = reflections.amplitudes(intensity, sigma, rows)
+
+    with open(filename, 'w') as handle:
+        handle.write(
+            ' NREFlection={}\n'
+            ' ANOMalous={}\n'
+            ' DECLare NAME=FOBS  DOMAin=RECIprocal TYPE=REAL END\n'
+            ' DECLare NAME=SIGMA DOMAin=RECIprocal TYPE=REAL END\n'
+            ' DECLare NAME=IOBS  DOMAin=RECIprocal TYPE=REAL END\n'
+            ' DECLare NAME=SIGI  DOMAin=RECIprocal TYPE=REAL END\n'
+            ' DECLare NAME=TEST  DOMAin=RECIprocal TYPE=INTE END\n'.format(len(hkl), 'TRUE' if anomalous else 'FALSE')
+        )
+        table = numpy.column_stack([hkl, amplitude, sigma_amplitude, intensity, sigma, test == 0])
+        numpy.savetxt(
+            handle, table,
+            fmt=' INDE %d %d %d FOBS= %.3f SIGMA= %.3f IOBS= %.3f SIGI= %.3f TEST= %d'
+        )
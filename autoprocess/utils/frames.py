@@ -0,0 +1,156 @@
+"""
+Compact sets of frame numbers.
+
+A set of frames is stored as sorted arrays of the first and last frame of each contiguous range, so that
+datasets of many thousands of frames are represented by a few numbers. Membership is tested by binary search,
+and set operations work on the range boundaries without enumerating the frames.
+
+"""
+
+import numpy
+
+
+def _normalize(starts, stops):
+    """
+    Sort ranges and merge those which overlap or touch
+
+    :param starts: array of first frames
+    :param stops: array of last frames, inclusive
+    :return: tuple of arrays (starts, stops) of disjoint ranges in increasing order
+    """
+    valid = stops >= starts
+    starts, stops = starts[valid], stops[valid]
+    if not len(starts):
+        return starts, stops
+    order = numpy.argsort(starts, kind='stable')
+    starts, stops = starts[order], stops[order]
+    reach = numpy.maximum.accumulate(stops)
+    first = numpy.ones(len(starts), dtype=bool)
+    first[1:] = starts[1:] > reach[:-1] + 1
+    return starts[first], numpy.maximum.reduceat(stops, numpy.flatnonzero(first))
+
+
+class FrameSet(object):
+    """
+    A set of frame numbers stored as contiguous ranges
+
+    :param ranges: sequence of (first, last) pairs, inclusive. Ranges may overlap and need not be sorted.
+    """
+
+    def __init__(self, ranges=()):
+        ranges = numpy.asarray(ranges, dtype=numpy.int64).reshape(-1, 2)
+        self.starts, self.stops = _normalize(ranges[:, 0], ranges[:, 1])
+
+    @classmethod
+    def from_frames(cls, frames):
+        """
+        Create a set from individual frame numbers
+
+        :param frames: sequence of frame numbers, in any order
+        """
+        frames = numpy.unique(numpy.asarray(frames, dtype=numpy.int64))
+        breaks = numpy.flatnonzero(numpy.diff(frames) > 1)
+        frame_set = cls()
+        if len(frames):
+            frame_set.starts = frames[numpy.concatenate([[0], breaks + 1])]
+            frame_set.stops = frames[numpy.concatenate([breaks, [len(frames) - 1]])]
+        return frame_set
+
+    @classmethod
+    def _from_arrays(cls, starts, stops):
+        frame_set = cls()
+        frame_set.starts, frame_set.stops = _normalize(starts, stops)
+        return frame_set
+
+    @property
+    def first(self):
+        return int(self.starts[0]) if len(self.starts) else None
+
+    @property
+    def last(self):
+        return int(self.stops[-1]) if len(self.stops) else None
+
+    def ranges(self):
+        """
+        Contiguous ranges of frames
+
+        :return: list of (first, last) tuples, inclusive
+        """
+        return list(zip(self.starts.tolist(), self.stops.tolist()))
+
+    def sizes(self):
+        """Number of frames in each contiguous range"""
+        return self.stops - self.starts + 1
+
+    def frames(self):
+        """All frame numbers in increasing order"""
+        if not len(self.starts):
+            return numpy.zeros(0, dtype=numpy.int64)
+        sizes = self.sizes()
+        offsets = numpy.repeat(self.starts - numpy.concatenate([[0], numpy.cumsum(sizes)[:-1]]), sizes)
+        return numpy.arange(sizes.sum()) + offsets
+
+    def contains(self, frames):
+        """
+        Test the membership of many frames at once
+
+        :param frames: array of frame numbers
+        :return: boolean array
+        """
+        frames = numpy.asarray(frames, dtype=numpy.int64)
+        if not len(self.starts):
+            return numpy.zeros(frames.shape, dtype=bool)
+        index = numpy.searchsorted(self.starts, frames, side='right') - 1
+        return (index >= 0) & (frames <= self.stops[numpy.maximum(index, 0)])
+
+    def gaps(self, first=None, last=None):
+        """
+        Ranges of missing frames
+
+        :param first: first frame to consider, default is the first frame of the set
+        :param last: last frame to consider, default is the last frame of the set
+        :return: FrameSet of missing frames
+        """
+        first = self.first if first is None else first
+        last = self.last if last is None else last
+        if first is None or last is None:
+            return FrameSet()
+        return FrameSet([(first, last)]) - self
+
+    def _combine(self, other, operation):
+        # elementary segments between all range boundaries of both sets are either fully in or out of each set
+        points = numpy.union1d(
+            numpy.concatenate([self.starts, self.stops + 1]), numpy.concatenate([other.starts, other.stops + 1])
+        )
+        if len(points) < 2:
+            return FrameSet()
+        keep = operation(self.contains(points[:-1]), other.contains(points[:-1]))
+        return FrameSet._from_arrays(points[:-1][keep], points[1:][keep] - 1)
+
+    def __or__(self, other):
+        return self._combine(other, numpy.logical_or)
+
+    def __and__(self, other):
+        return self._combine(other, numpy.logical_and)
+
+    def __sub__(self, other):
+        return self._combine(other, lambda a, b: a & ~b)
+
+    def __contains__(self, frame):
+        index = numpy.searchsorted(self.starts, frame, side='right') - 1
+        return bool(index >= 0 and frame <= self.stops[index])
+
+    def __len__(self):
+        return int(self.sizes().sum())
+
+    def __bool__(self):
+        return bool(len(self.starts))
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, FrameSet)
+            and numpy.array_equal(self.starts, other.starts) and numpy.array_equal(self.stops, other.stops)
+        )
+
+    def __repr__(self):
+        return '<FrameSet: {}>'.format(', '.join('{}-{}'.format(*r) for r in self.ranges()) or 'empty')
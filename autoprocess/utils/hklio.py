@@ -0,0 +1,210 @@
+"""
+Reader for reflection files in the XDS ASCII format: INTEGRATE.HKL, XDS_ASCII.HKL and XSCALE.HKL.
+
+The header is parsed for the column definitions, unit cell, space group and wavelength. The data block
+is parsed in chunks of whole lines directly from a memory map of the file by NumPy, without creating Python
+objects for individual reflections, and is returned as a structured array with one field per column.
+Chunks can be processed one at a time to bound the memory used for very large files.
+
+Parsed reflections can optionally be cached in a binary .npy file next to the reflection file. The cache is
+memory-mapped when read and is regenerated whenever the size or modification time of the reflection file
+changes.
+
+"""
+
+import mmap
+import os
+
+import numpy
+
+from autoprocess.utils import log, misc
+
+logger = log.get_module_logger(__name__)
+
+CHUNK_SIZE = 32 * 1024 * 1024  # bytes of text parsed at a time
+END_OF_HEADER = b'!END_OF_HEADER'
+END_OF_DATA = b'!END_OF_DATA'
+
+# columns which hold integer values, all others are stored as 32-bit floats
+INTEGER_ITEMS = ('H', 'K', 'L', 'ISET', 'ISEG', 'MAXC', 'PEAK', 'CORR')
+
+# INTEGRATE.HKL lists its columns without ITEM_ definitions, use the XDS_ASCII names for them
+ITEM_ALIASES = {
+    'SIGMA': 'SIGMA(IOBS)',
+    'XCAL': 'XD',
+    'YCAL': 'YD',
+    'ZCAL': 'ZD',
+}
+
+
+class FormatError(ValueError):
+    pass
+
+
+def _parse_header(text):
+    """
+    Parse the header of a reflection file
+
+    :param text: header text
+    :return: dictionary
+    """
+    header = {
+        'format': 'XDS_ASCII', 'items': [], 'num_items': 0, 'friedel': True, 'merged': False,
+        'space_group': 1, 'unit_cell': None, 'wavelength': 0.0,
+    }
+    positions = {}
+    listed = []
+    for line in text.splitlines():
+        content = line[1:].split('!')[0].strip()
+        if '=' not in content:
+            # column names listed without ITEM_ definitions, as in INTEGRATE.HKL
+            names = [name.strip() for name in content.split(',') if name.strip()]
+            if ',' in content and all(name.replace('(', '').replace(')', '').isalnum() for name in names):
+                listed.extend(names)
+            continue
+        if line.startswith('!SPACE_GROUP_NUMBER='):
+            header['space_group'] = int(content.split('=')[1].split()[0])
+        elif line.startswith('!UNIT_CELL_CONSTANTS='):
+            header['unit_cell'] = tuple(float(v) for v in content.split('=')[1].split()[:6])
+        elif line.startswith('!X-RAY_WAVELENGTH=') and not header['wavelength']:
+            header['wavelength'] = float(content.split('=')[1].split()[0])
+        else:
+            for field in content.split():
+                key, _, value = field.partition('=')
+                if not value:
+                    continue
+                if key.startswith('ITEM_'):
+                    positions[key[5:]] = int(value) - 1
+                elif key == 'NUMBER_OF_ITEMS_IN_EACH_DATA_RECORD':
+                    header['num_items'] = int(value)
+                elif key == "FRIEDEL'S_LAW":
+                    header['friedel'] = (value.upper() == 'TRUE')
+                elif key == 'MERGE':
+                    header['merged'] = (value.upper() == 'TRUE')
+                elif key == 'OUTPUT_FILE':
+                    header['format'] = os.path.splitext(value)[0].upper()
+
+    if positions:
+        header['items'] = [name for name, _ in sorted(positions.items(), key=lambda item: item[1])]
+        if [positions[name] for name in header['items']] != list(range(len(header['items']))):
+            raise FormatError('Column definitions are not contiguous')
+    else:
+        header['items'] = [ITEM_ALIASES.get(name, name) for name in listed]
+    if not header['num_items']:
+        header['num_items'] = len(header['items'])
+    if len(header['items']) != header['num_items'] or not {'H', 'K', 'L'} <= set(header['items']):
+        raise FormatError('Column definitions do not match the number of items')
+    return header
+
+
+class ReflectionFile(object):
+    """
+    A reflection file in the XDS ASCII format
+
+    :param filename: path of INTEGRATE.HKL, XDS_ASCII.HKL or XSCALE.HKL
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            end = data.find(END_OF_HEADER)
+            if end < 0:
+                raise FormatError('{} has no header'.format(filename))
+            self.data_start = data.find(b'\n', end) + 1
+            self.data_end = data.find(END_OF_DATA, self.data_start)
+            if self.data_end < 0:
+                self.data_end = len(data)
+            self.header = _parse_header(data[:end].decode('ascii', 'replace'))
+
+        self.items = self.header['items']
+        self.space_group = self.header['space_group']
+        self.unit_cell = self.header['unit_cell']
+        self.wavelength = self.header['wavelength']
+        self.friedel = self.header['friedel']
+        self.dtype = numpy.dtype([
+            (name, numpy.int32 if name in INTEGER_ITEMS else numpy.float32) for name in self.items
+        ])
+
+    def _select(self, columns):
+        if columns is None:
+            return self.dtype
+        missing = set(columns) - set(self.items)
+        if missing:
+            raise KeyError('Columns not in {}: {}'.format(self.filename, ', '.join(sorted(missing))))
+        return numpy.dtype([(name, self.dtype[name]) for name in self.items if name in columns])
+
+    def chunks(self, columns=None, chunk_size=CHUNK_SIZE):
+        """
+        Iterate over the reflections in chunks of whole records
+
+        :param columns: names of the columns to include, default is all columns
+        :param chunk_size: approximate number of bytes of text parsed per chunk
+        :return: generator of structured arrays
+        """
+        dtype = self._select(columns)
+        num_items = len(self.items)
+        with open(self.filename, 'rb') as handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = self.data_start
+            while start < self.data_end:
+                end = min(start + chunk_size, self.data_end)
+                if end < self.data_end:
+                    end = data.rfind(b'\n', start, end) + 1 or data.find(b'\n', end) + 1 or self.data_end
+                values = numpy.fromstring(data[start:end], dtype=float, sep=' ')
+                if len(values) % num_items:
+                    raise FormatError('Incomplete record in {} near byte {}'.format(self.filename, start))
+                values = values.reshape(-1, num_items)
+                chunk = numpy.empty(len(values), dtype=dtype)
+                for name in dtype.names:
+                    chunk[name] = values[:, self.items.index(name)]
+                yield chunk
+                start = end
+
+    def read(self, columns=None):
+        """
+        Read all reflections
+
+        :param columns: names of the columns to include, default is all columns
+        :return: structured array
+        """
+        chunks = list(self.chunks(columns))
+        if len(chunks) == 1:
+            return chunks[0]
+        return numpy.concatenate(chunks) if chunks else numpy.empty(0, dtype=self._select(columns))
+
+    def load(self, columns=None):
+        """
+        Read all reflections through a binary cache file, which is memory-mapped. The cache is created or
+        updated if the reflection file has changed or the cached columns differ.
+
+        :param columns: names of the columns to include, default is all columns
+        :return: read-only structured array
+        """
+        cache_file = '{}.npy'.format(self.filename)
+        dtype = self._select(columns)
+        cached = misc.load_array_cache(cache_file, self.filename, mmap_mode='r')
+        if cached is not None and set(dtype.names) <= set(cached.dtype.names or ()):
+            return cached[list(dtype.names)] if columns else cached
+        ident = misc.file_ident(self.filename)
+        reflections = self.read()
+        try:
+            misc.save_array_cache(cache_file, reflections, ident)
+            cached = numpy.load(cache_file, mmap_mode='r')
+            return cached[list(dtype.names)] if columns else cached
+        except OSError as e:
+            logger.debug('Unable to cache reflections: {}'.format(e))
+            return reflections[list(dtype.names)] if columns else reflections
+
+    def __repr__(self):
+        return '<ReflectionFile: {}, {} columns>'.format(self.filename, len(self.items))
+
+
+def read_reflections(filename, columns=None):
+    """
+    Read the header and reflections of a file in the XDS ASCII format
+
+    :param filename: reflection file
+    :param columns: names of the columns to include, default is all columns
+    :return: tuple (ReflectionFile, structured array)
+    """
+    reflection_file = ReflectionFile(filename)
+    return reflection_file, reflection_file.read(columns)
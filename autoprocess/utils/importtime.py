@@ -0,0 +1,101 @@
+"""
+Import time benchmark of the command line entry points.
+
+Each entry point module is imported in a fresh interpreter with `python -X importtime`, and its cumulative
+import time is compared with a budget. The best of several runs is used, to reduce the effect of a cold
+disk cache. The benchmark exits with status 1 if any entry point exceeds its budget:
+
+    python -m autoprocess.utils.importtime [--repeat N] [--scale FACTOR] [module ...]
+
+Budgets are in milliseconds. The scale factor adjusts all budgets for slower or faster hosts.
+
+"""
+
+import argparse
+import subprocess
+import sys
+
+# import time budgets of the entry points in milliseconds
+BUDGETS = {
+    'autoprocess.auto_analyse': 300,
+    'autoprocess.auto_inputs': 300,
+    'autoprocess.auto_report': 300,
+    'autoprocess.auto_integrate': 500,
+    'autoprocess.auto_process': 500,
+    'autoprocess.auto_scale': 500,
+    'autoprocess.auto_strategy': 500,
+    'autoprocess.auto_symmetry': 500,
+    'autoprocess.auto_tune': 500,
+}
+
+
+def import_time(module):
+    """
+    Measure the time taken to import a module in a new interpreter
+
+    :param module: module name
+    :return: tuple (cumulative import time in milliseconds, list of (milliseconds, name) of the imports
+        sorted by decreasing time)
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError('Unable to import {}:\n{}'.format(module, proc.stderr.strip()))
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit():
+            imports.append((int(cumulative) / 1000, name.strip()))
+    total = next(elapsed for elapsed, name in imports if name == module)
+    return total, sorted(imports, reverse=True)
+
+
+def benchmark(modules, repeat=3, scale=1.0):
+    """
+    Compare the import time of modules with their budgets
+
+    :param modules: list of module names, in BUDGETS
+    :param repeat: number of runs for each module, the fastest is used
+    :param scale: factor applied to the budgets
+    :return: list of dictionaries with keys 'module', 'time', 'budget', 'passed' and 'imports'
+    """
+    results = []
+    for module in modules:
+        total, imports = min((import_time(module) for i in range(repeat)), key=lambda run: run[0])
+        budget = BUDGETS[module] * scale
+        results.append({
+            'module': module, 'time': total, 'budget': budget, 'passed': total <= budget, 'imports': imports
+        })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the import time of the command line entry points')
+    parser.add_argument('modules', nargs='*', help='Entry point modules, default is all', default=sorted(BUDGETS))
+    parser.add_argument('-r', '--repeat', help='Number of runs for each module', type=int, default=3)
+    parser.add_argument('-s', '--scale', help='Factor applied to all budgets', type=float, default=1.0)
+    parser.add_argument('-v', '--verbose', help='Show the slowest imports of modules over budget', action='store_true')
+    args = parser.parse_args(argv)
+
+    unknown = set(args.modules) - set(BUDGETS)
+    if unknown:
+        parser.error('No budget for {}'.format(', '.join(sorted(unknown))))
+
+    passed = True
+    for result in benchmark(args.modules, repeat=max(1, args.repeat), scale=args.scale):
+        status = 'ok' if result['passed'] else 'OVER BUDGET'
+        print('{module:<30} {time:8.1f} ms  (budget {budget:6.0f} ms)  {status}'.format(status=status, **result))
+        if not result['passed']:
+            passed = False
+            if args.verbose:
+                for elapsed, name in result['imports'][1:11]:
+                    print('    {:8.1f} ms  {}'.format(elapsed, name))
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
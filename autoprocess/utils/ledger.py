@@ -0,0 +1,123 @@
+"""
+Resource ledger for processing steps and external programs.
+
+Usage is tracked per thread, so that steps running concurrently in a thread pool are accounted
+separately. The resources used by each external program are obtained from `os.wait4` when the
+program exits and are added to every step being tracked by the thread which started it. Functions
+which a step runs in helper threads are wrapped with `bind`, so that their programs are added to
+the steps of the thread which submitted them.
+
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+_lock = threading.Lock()  # records may be shared by helper threads
+
+# fields accumulated from program resource usage
+USAGE_FIELDS = ('wall', 'user', 'system', 'max_rss', 'read_bytes', 'write_bytes')
+BLOCK_SIZE = 512
+
+
+def new_record(name):
+    """
+    Create an empty usage record
+
+    :param name: name of the step or command
+    :return: dictionary
+    """
+    record = {'name': name, 'commands': []}
+    record.update({field: 0 for field in USAGE_FIELDS})
+    return record
+
+
+def from_rusage(name, rusage, wall):
+    """
+    Create a usage record from the resource usage of an exited program
+
+    :param name: name of the command
+    :param rusage: resource.struct_rusage instance as returned by os.wait4
+    :param wall: elapsed time in seconds
+    :return: dictionary
+    """
+    return {
+        'name': name,
+        'wall': wall,
+        'user': rusage.ru_utime,
+        'system': rusage.ru_stime,
+        'max_rss': rusage.ru_maxrss * 1024,  # kilobytes on Linux
+        'read_bytes': rusage.ru_inblock * BLOCK_SIZE,
+        'write_bytes': rusage.ru_oublock * BLOCK_SIZE,
+    }
+
+
+def add_usage(record, usage):
+    """
+    Add the program usage to a step record. CPU time and I/O are summed while the peak memory is
+    the largest of all programs.
+    """
+    record['user'] += usage['user']
+    record['system'] += usage['system']
+    record['read_bytes'] += usage['read_bytes']
+    record['write_bytes'] += usage['write_bytes']
+    record['max_rss'] = max(record['max_rss'], usage['max_rss'])
+    record['commands'].append(usage)
+
+
+def record_command(name, rusage, wall):
+    """
+    Record the resources used by an external program in all steps tracked by the current thread
+
+    :param name: name of the command
+    :param rusage: resource.struct_rusage instance as returned by os.wait4
+    :param wall: elapsed time in seconds
+    :return: usage record of the command
+    """
+    usage = from_rusage(name, rusage, wall)
+    with _lock:
+        for record in getattr(_local, 'records', []):
+            add_usage(record, usage)
+    return usage
+
+
+def bind(func):
+    """
+    Wrap a function to be run in another thread, so that the programs it runs are recorded in the steps
+    tracked by the current thread
+
+    :param func: function
+    :return: wrapped function
+    """
+    records = list(getattr(_local, 'records', []))
+
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, 'records', [])
+        _local.records = previous + [record for record in records if all(record is not r for r in previous)]
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.records = previous
+
+    return wrapper
+
+
+@contextmanager
+def track(name):
+    """
+    Context manager which tracks the resources used within the current thread and yields the usage record.
+    Wall time is set when the context exits.
+
+    :param name: name of the step
+    """
+    if not hasattr(_local, 'records'):
+        _local.records = []
+    record = new_record(name)
+    start_time = time.time()
+    _local.records.append(record)
+    try:
+        yield record
+    finally:
+        _local.records.remove(record)
+        record['wall'] = time.time() - start_time
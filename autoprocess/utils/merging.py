@@ -0,0 +1,297 @@
+"""
+Merging statistics of unmerged reflections, calculated in-process with NumPy.
+
+Observations of systematically absent reflections are discarded, the others are grouped by their reduced indices
+in the reciprocal space asymmetric unit and all per-reflection sums are accumulated once with bincount. Statistics
+for any set of resolution shells and high resolution limit are then obtained by binning the unique reflections,
+which takes milliseconds even for millions of observations. Rows use the same keys as the statistics tables
+parsed from CORRECT.LP and XSCALE.LP, so they can be used with xtal.select_resolution and the report functions.
+
+"""
+
+import numpy
+
+from autoprocess.utils import hklio, xtal
+
+# critical value of the standard normal distribution for significance at the 0.1% level, as used by XDS
+SIGNIFICANCE_LEVEL = 3.09
+
+
+def _group_sums(keys, values, size):
+    return numpy.bincount(keys, weights=values, minlength=size)
+
+
+def _correlation(x, y, shells, num_shells):
+    """
+    Pearson correlation of x and y within each shell, and over all shells
+
+    :return: tuple (per-shell coefficients, per-shell counts, overall coefficient, overall count)
+    """
+    sums = [
+        numpy.bincount(shells, weights=values, minlength=num_shells)
+        for values in (numpy.ones_like(x), x, y, x * x, y * y, x * y)
+    ]
+    sums = numpy.array(sums)
+    sums = numpy.column_stack([sums, sums.sum(axis=1)])
+    n, sx, sy, sxx, syy, sxy = sums
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        cc = (n * sxy - sx * sy) / numpy.sqrt((n * sxx - sx * sx) * (n * syy - sy * sy))
+    cc = numpy.nan_to_num(cc)
+    return cc[:-1], n[:-1], cc[-1], n[-1]
+
+
+def is_significant(cc, n):
+    """Test whether correlation coefficients are significantly above zero at the 0.1% level"""
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        z = numpy.arctanh(numpy.clip(cc, -0.999999, 0.999999)) * numpy.sqrt(numpy.clip(n - 3, 0, None))
+    return z > SIGNIFICANCE_LEVEL
+
+
+def possible_reflections(space_group, unit_cell, d_min, anomalous=False):
+    """
+    Calculate the resolution of all reflections of the asymmetric unit which are not systematically absent
+
+    :param space_group: space group number
+    :param unit_cell: unit cell parameters
+    :param d_min: high resolution limit
+    :param anomalous: count Friedel mates of acentric reflections separately
+    :return: array of 1/d² values, acentric reflections are repeated if anomalous
+    """
+    condition = xtal.ASU_CONDITIONS[xtal.laue_asu(space_group)]
+    limits = [int(length / d_min) + 1 for length in unit_cell[:3]]
+    k, l = numpy.mgrid[-limits[1]:limits[1] + 1, -limits[2]:limits[2] + 1].reshape(2, -1)
+    inv_d_max = (1 + 1e-6) / d_min ** 2
+    found = []
+    for h in range(-limits[0], limits[0] + 1):
+        hkl = numpy.column_stack([numpy.full_like(k, h), k, l])
+        hkl = hkl[condition(hkl[:, 0], hkl[:, 1], hkl[:, 2]) & (hkl != 0).any(axis=1)]
+        inv_d2 = xtal.inverse_d_squared(hkl, unit_cell)
+        hkl, inv_d2 = hkl[inv_d2 <= inv_d_max], inv_d2[inv_d2 <= inv_d_max]
+        absent = xtal.is_absent(hkl, space_group)
+        hkl, inv_d2 = hkl[~absent], inv_d2[~absent]
+        if anomalous:
+            centric = xtal.is_centric(hkl, space_group)
+            inv_d2 = numpy.concatenate([inv_d2, inv_d2[~centric]])
+        found.append(inv_d2)
+    return numpy.concatenate(found)
+
+
+class MergingStatistics(object):
+    """
+    Merging statistics of a set of unmerged observations
+
+    :param hkl: integer array of shape (n, 3) with the observed indices
+    :param intensity: observed intensities
+    :param sigma: standard deviations of the intensities, observations with sigma <= 0 and observations of
+        systematically absent reflections are excluded
+    :param space_group: space group number
+    :param unit_cell: unit cell parameters
+    :param anomalous: treat Friedel mates as distinct reflections
+    :param seed: seed of the random half-dataset split used for CC½
+    """
+
+    def __init__(self, hkl, intensity, sigma, space_group, unit_cell, anomalous=False, seed=0):
+        hkl = numpy.asarray(hkl, dtype=numpy.int32)
+        sigma = numpy.asarray(sigma, dtype=float)
+        # absent reflections are not among the possible ones, counting them would overstate the completeness
+        valid = (sigma > 0) & ~xtal.is_absent(hkl, space_group)
+        hkl = hkl[valid]
+        intensity = numpy.asarray(intensity, dtype=float)[valid]
+        sigma = sigma[valid]
+        self.space_group = space_group
+        self.unit_cell = unit_cell
+        self.anomalous = anomalous
+        self.num_observations = len(intensity)
+        self._possible = {}
+
+        asu_hkl, minus = xtal.map_to_asu(hkl, space_group)
+        unique_hkl, parent = xtal.unique_hkl(asu_hkl)
+        centric = xtal.is_centric(unique_hkl, space_group)
+
+        # unique reflections, Friedel mates of acentric reflections are separate if anomalous
+        if anomalous:
+            keys = parent * 2 + (minus & ~centric[parent])
+            size = len(unique_hkl) * 2
+        else:
+            keys = parent
+            size = len(unique_hkl)
+        counts = numpy.bincount(keys, minlength=size)
+        present = counts > 0
+        self.inv_d2 = numpy.repeat(xtal.inverse_d_squared(unique_hkl, unit_cell), size // len(unique_hkl))[present]
+        renumber = numpy.cumsum(present) - 1
+        keys = renumber[keys]
+        size = present.sum()
+        self.counts = counts[present]
+
+        # sums over the observations of each unique reflection
+        weights = 1 / sigma ** 2
+        self.sum_i = _group_sums(keys, intensity, size)
+        self.mean_i = self.sum_i / self.counts
+        self.deviation = _group_sums(keys, numpy.abs(intensity - self.mean_i[keys]), size)
+        self.sum_sigma = _group_sums(keys, sigma, size)
+        sum_weights = _group_sums(keys, weights, size)
+        self.merged_i = _group_sums(keys, weights * intensity, size) / sum_weights
+        self.merged_sigma = 1 / numpy.sqrt(sum_weights)
+
+        # random half-datasets, each reflection has its observations split evenly between the halves
+        random = numpy.random.default_rng(seed).random(len(keys))
+        order = numpy.argsort(keys + random)
+        starts = numpy.concatenate([[0], numpy.cumsum(self.counts)[:-1]])
+        rank = numpy.empty(len(keys), dtype=numpy.int64)
+        rank[order] = numpy.arange(len(keys)) - starts[keys[order]]
+        half = rank % 2
+        halves = []
+        for i in (0, 1):
+            n = numpy.bincount(keys[half == i], minlength=size)
+            total = numpy.bincount(keys[half == i], weights=intensity[half == i], minlength=size)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                halves.append(total / n)
+        self.half_i = numpy.array(halves)
+
+        # anomalous pairs, indexed by unique reflection of the Friedel-merged set
+        self.anomalous_pairs = None
+        if anomalous:
+            parent_key = numpy.full(size, -1)
+            parent_key[keys] = parent
+            sign = numpy.zeros(size, dtype=int)
+            sign[keys] = numpy.where(minus & ~centric[parent], -1, 1)
+            acentric = ~centric[parent_key]
+            plus = numpy.flatnonzero(acentric & (sign > 0))
+            neg = numpy.flatnonzero(acentric & (sign < 0))
+            common = numpy.intersect1d(parent_key[plus], parent_key[neg])
+            plus = plus[numpy.searchsorted(parent_key[plus], common)]
+            neg = neg[numpy.searchsorted(parent_key[neg], common)]
+            self.anomalous_pairs = (plus, neg)
+
+    def possible(self, d_min):
+        """Resolutions of the possible reflections to d_min, cached for each resolution"""
+        if d_min not in self._possible:
+            self._possible[d_min] = possible_reflections(
+                self.space_group, self.unit_cell, d_min, anomalous=self.anomalous
+            )
+        return self._possible[d_min]
+
+    def shells(self, resolution=None, num_shells=10):
+        """
+        Resolution shells with equal numbers of possible reflections
+
+        :param resolution: high resolution limit, default is the highest resolution observed
+        :param num_shells: number of shells
+        :return: list of shell limits in Å, from low to high resolution
+        """
+        inv_d2_max = 1 / resolution ** 2 if resolution else self.inv_d2.max()
+        edges = numpy.linspace(0, inv_d2_max ** 1.5, num_shells + 1)[1:] ** (2 / 3)
+        return [round(float(v), 2) for v in 1 / numpy.sqrt(edges)]
+
+    def table(self, resolution=None, shells=None, num_shells=10):
+        """
+        Calculate the statistics table
+
+        :param resolution: high resolution limit, default is the highest resolution observed
+        :param shells: high resolution limits of the shells, calculated if not given
+        :param num_shells: number of shells to calculate if shells is not given
+        :return: list of dictionaries, one per shell followed by the overall statistics
+        """
+        shells = list(shells or self.shells(resolution, num_shells))
+        d_min = shells[-1]
+        edges = 1 / numpy.array(shells) ** 2
+        num = len(shells)
+
+        def shell_index(inv_d2):
+            return numpy.searchsorted(edges, inv_d2 * (1 - 1e-6))
+
+        def per_shell(values, select=None):
+            select = inside if select is None else inside & select
+            sums = numpy.bincount(shell_index(self.inv_d2[select]), weights=values[select], minlength=num)
+            return numpy.append(sums, sums.sum())
+
+        inside = self.inv_d2 <= edges[-1] * (1 + 1e-6)
+        counts = self.counts.astype(float)
+        multiple = self.counts > 1
+        observed = per_shell(counts)
+        unique = per_shell(numpy.ones_like(counts))
+        possible = numpy.bincount(shell_index(self.possible(d_min)), minlength=num)[:num]
+        possible = numpy.append(possible, possible.sum())
+        compared = per_shell(counts, multiple)
+        sum_i = per_shell(self.sum_i, multiple)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            r_obs = per_shell(self.deviation, multiple) / sum_i
+            r_meas = per_shell(self.deviation * numpy.sqrt(counts / (counts - 1)), multiple) / sum_i
+            r_pim = per_shell(self.deviation * numpy.sqrt(1 / (counts - 1)), multiple) / sum_i
+            r_exp = per_shell(self.sum_sigma, multiple) / sum_i
+            i_sigma = per_shell(self.merged_i / self.merged_sigma) / unique
+
+        split = inside & numpy.isfinite(self.half_i).all(axis=0)
+        cc, cc_n, cc_all, cc_n_all = _correlation(
+            self.half_i[0][split], self.half_i[1][split], shell_index(self.inv_d2[split]), num
+        )
+        cc, cc_n = numpy.append(cc, cc_all), numpy.append(cc_n, cc_n_all)
+
+        cor_ano = numpy.zeros(num + 1)
+        sig_ano = numpy.zeros(num + 1)
+        num_ano = numpy.zeros(num + 1, dtype=int)
+        ano_significant = numpy.zeros(num + 1, dtype=bool)
+        if self.anomalous_pairs is not None:
+            plus, neg = self.anomalous_pairs
+            pairs = self.inv_d2[plus] <= edges[-1] * (1 + 1e-6)
+            plus, neg = plus[pairs], neg[pairs]
+            pair_shells = shell_index(self.inv_d2[plus])
+            difference = self.merged_i[plus] - self.merged_i[neg]
+            sigma = numpy.hypot(self.merged_sigma[plus], self.merged_sigma[neg])
+            num_ano = numpy.bincount(pair_shells, minlength=num)
+            num_ano = numpy.append(num_ano, num_ano.sum())
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                sig_ano = numpy.bincount(pair_shells, weights=numpy.abs(difference) / sigma, minlength=num)
+                sig_ano = numpy.append(sig_ano, sig_ano.sum()) / num_ano
+            halves = numpy.isfinite(self.half_i[:, plus]).all(axis=0) & numpy.isfinite(self.half_i[:, neg]).all(axis=0)
+            ano_1 = self.half_i[0, plus] - self.half_i[0, neg]
+            ano_2 = self.half_i[1, plus] - self.half_i[1, neg]
+            cor, cor_n, cor_all, cor_n_all = _correlation(ano_1[halves], ano_2[halves], pair_shells[halves], num)
+            cor_ano = numpy.append(cor, cor_all)
+            ano_significant = is_significant(cor_ano, numpy.append(cor_n, cor_n_all))
+
+        significant = is_significant(cc, cc_n)
+        rows = []
+        for i in range(num + 1):
+            rows.append({
+                'shell': '{:0.2f}'.format(shells[i]) if i < num else 'total',
+                'observed': int(observed[i]),
+                'unique': int(unique[i]),
+                'possible': int(possible[i]),
+                'completeness': float(numpy.nan_to_num(100 * unique[i] / possible[i])) if possible[i] else 0.0,
+                'multiplicity': float(observed[i] / unique[i]) if unique[i] else 0.0,
+                'r_obs': float(numpy.nan_to_num(100 * r_obs[i])),
+                'r_exp': float(numpy.nan_to_num(100 * r_exp[i])),
+                'compared': int(compared[i]),
+                'i_sigma': float(numpy.nan_to_num(i_sigma[i])),
+                'r_meas': float(numpy.nan_to_num(100 * r_meas[i])),
+                'r_pim': float(numpy.nan_to_num(100 * r_pim[i])),
+                'cc_half': float(100 * cc[i]),
+                'signif': '*' if significant[i] else ' ',
+                'cor_ano': int(round(100 * cor_ano[i])),
+                'asignif': '*' if ano_significant[i] else ' ',
+                'sig_ano': float(numpy.nan_to_num(sig_ano[i])),
+                'Nano': int(num_ano[i]),
+            })
+        return rows
+
+
+def merging_statistics(filename, resolution=None, shells=None, anomalous=None, num_shells=10):
+    """
+    Calculate the merging statistics of an unmerged reflection file
+
+    :param filename: XDS_ASCII.HKL or XSCALE.HKL file
+    :param resolution: high resolution limit
+    :param shells: high resolution limits of the shells
+    :param anomalous: treat Friedel mates separately, default follows the FRIEDEL'S_LAW of the file
+    :param num_shells: number of shells to calculate if shells is not given
+    :return: list of dictionaries, one per shell followed by the overall statistics
+    """
+    reflection_file = hklio.ReflectionFile(filename)
+    data = reflection_file.read(['H', 'K', 'L', 'IOBS', 'SIGMA(IOBS)'])
+    anomalous = (not reflection_file.friedel) if anomalous is None else anomalous
+    stats = MergingStatistics(
+        numpy.column_stack([data['H'], data['K'], data['L']]), data['IOBS'], data['SIGMA(IOBS)'],
+        reflection_file.space_group, reflection_file.unit_cell, anomalous=anomalous
+    )
+    return stats.table(resolution=resolution, shells=shells, num_shells=num_shells)
@@ -1,10 +1,12 @@
 import functools
 import gzip
+import hashlib
 import json
 import math
 import os
 import pwd
 import shutil
+import time
 
 import msgpack
 import numpy
@@ -67,8 +69,9 @@ def get_home_dir():
     return pwd.getpwuid(os.geteuid())[5]
 
 
-def backup_files(*args):
+def backup_files(*args, directory='.'):
     for filename in args:
+        filename = os.path.join(directory, filename)
         if os.path.exists(filename):
             index = 0
             while os.path.exists('%s.%0d' % (filename, index)):
@@ -77,21 +80,108 @@ def backup_files(*args):
     return
 
 
-def backup_special_file(filename, suffix):
+def backup_special_file(filename, suffix, directory='.'):
+    filename = os.path.join(directory, filename)
     if os.path.exists(filename):
         shutil.copy(filename, '%s.%s' % (filename, suffix))
     return
 
 
-def file_requirements(*args):
+def file_requirements(*args, directory='.'):
     all_exist = True
     for f in args:
-        if not os.path.exists(f):
+        if not os.path.exists(os.path.join(directory, f)):
             all_exist = False
             break
     return all_exist
 
 
+def link_files(source, destination, filenames):
+    """
+    Make the files available in the destination directory, using hard links where possible.
+    Files which do not exist are skipped.
+
+    :param source: source directory
+    :param destination: destination directory
+    :param filenames: file names relative to the source directory, may include sub-directories
+    """
+    for filename in filenames:
+        src = os.path.join(source, filename)
+        if not os.path.exists(src):
+            continue
+        dst = os.path.join(destination, filename)
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+
+def move_files(source, destination, filenames):
+    """
+    Move files between two directories on the same file system. Each file is replaced atomically,
+    so readers of the destination never see a partially written file. Files which do not exist are skipped.
+
+    :param source: source directory
+    :param destination: destination directory
+    :param filenames: file names relative to the source directory, may include sub-directories
+    :return: list of files moved
+    """
+    moved = []
+    for filename in filenames:
+        src = os.path.join(source, filename)
+        if os.path.isfile(src):
+            os.replace(src, os.path.join(destination, filename))
+            moved.append(filename)
+    return moved
+
+
+def file_ident(filename):
+    """
+    Identify the version of a file by its size and modification time in nanoseconds
+
+    :param filename: file name
+    :return: list [size, mtime_ns]
+    """
+    st = os.stat(filename)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def load_array_cache(cache_file, source, mmap_mode=None):
+    """
+    Load a NumPy array cached from a source file. The version of the source recorded with the cache must match
+    exactly, since a source which has been replaced or restored can be older than its cache.
+
+    :param cache_file: .npy cache file
+    :param source: source file
+    :param mmap_mode: memory-map mode passed to numpy.load
+    :return: array, or None if there is no valid cache
+    """
+    try:
+        with open('{}.src'.format(cache_file), 'r') as handle:
+            if json.load(handle) == file_ident(source):
+                return numpy.load(cache_file, mmap_mode=mmap_mode)
+    except (OSError, ValueError):
+        pass
+
+
+def save_array_cache(cache_file, array, ident):
+    """
+    Save a NumPy array cached from a source file, replacing the cache atomically
+
+    :param cache_file: .npy cache file
+    :param array: array
+    :param ident: version of the source from which the array was created, from :func:`file_ident`
+    """
+    for filename, write in ((cache_file, lambda handle: numpy.save(handle, array)),
+                            ('{}.src'.format(cache_file), lambda handle: handle.write(json.dumps(ident).encode()))):
+        temp_file = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(temp_file, 'wb') as handle:
+            write(handle)
+        os.replace(temp_file, filename)
+
+
 def combine_names(names):
     """
     Return a combined name to represent a set of names
@@ -448,9 +538,191 @@ def load_json(filename):
 def load_chkpt(filename='process.chkpt'):
     with gzip.open(filename, 'rb') as handle:
         info = msgpack.load(handle, object_hook=msgpack_numpy.decode)
+    journal = '{}.journal'.format(filename)
+    if os.path.exists(journal):
+        info = replay_journal(info, journal)
     return info
 
 
+def replay_journal(info, filename):
+    """
+    Apply all complete records of a checkpoint journal to the checkpoint information. An incomplete
+    trailing record from an interrupted write is ignored, as are records from before the snapshot was last
+    written, which remain if the journal could not be removed after writing it.
+
+    :param info: checkpoint dictionary
+    :param filename: journal file name
+    :return: updated checkpoint dictionary
+    """
+    datasets = {d['parameters']['name']: d for d in info['datasets']}
+    records = []
+    with gzip.open(filename, 'rb') as handle:
+        unpacker = msgpack.Unpacker(handle, object_hook=msgpack_numpy.decode, strict_map_key=False)
+        try:
+            for record in unpacker:
+                records.append(record)
+        except (EOFError, OSError, ValueError):
+            pass
+
+    for record in records:
+        if record.get('generation') != info.get('generation'):
+            continue
+        for key in ['options', 'run_position', 'completed']:
+            if key in record:
+                info[key] = record[key]
+        for name, delta in record.get('datasets', {}).items():
+            dset = datasets.setdefault(name, {'parameters': {}, 'log': [], 'results': {}})
+            for section in ['parameters', 'results']:
+                dset[section].update(delta.get(section, {}))
+                for key in delta.get('removed', {}).get(section, []):
+                    dset[section].pop(key, None)
+            if 'log' in delta:
+                dset['log'] = dset['log'][:delta['log']['start']] + delta['log']['entries']
+        info['datasets'] = [datasets[name] for name in record['order']]
+        if 'usage' in record:
+            usage = {entry['task']: entry for entry in info.get('usage', [])}
+            usage.update((entry['task'], entry) for entry in record['usage']['records'])
+            info['usage'] = [usage[task] for task in record['usage']['order']]
+    return info
+
+
+class CheckpointJournal(object):
+    """
+    Saves checkpoints as a compact snapshot followed by an append-only journal of changes, so that
+    the cost of saving a checkpoint depends on what changed since the previous save rather than on the
+    size of the whole checkpoint. When the changed values are reported on save, only those are serialized
+    to detect changes. The journal is folded into a new snapshot every `compact_every` records.
+
+    :param filename: snapshot file name, the journal is saved next to it with a ".journal" suffix
+    :param compact_every: number of journal records after which a new snapshot is written
+    """
+
+    def __init__(self, filename='process.chkpt', compact_every=25):
+        self.filename = filename
+        self.journal = '{}.journal'.format(filename)
+        self.compact_every = compact_every
+        self.digests = None
+        self.records = 0
+        self.generation = None
+
+    @staticmethod
+    def digest(value):
+        return hashlib.sha1(msgpack.packb(value, default=str)).digest()
+
+    def get_digests(self, info, changes=None):
+        """
+        Digests of the values of the checkpoint. If the changes since the previous save are known, only the
+        changed values are serialized and the digests of all other values are reused.
+
+        :param info: checkpoint dictionary
+        :param changes: optional dictionary mapping 'datasets' to the changed keys of each section of each
+            dataset, None instead of the keys for a whole section, and 'usage' to the tasks with new usage records
+        :return: dictionary of digests
+        """
+        previous = self.digests if changes is not None and self.digests is not None else {}
+        changed = changes.get('datasets', {}) if previous else {}
+        tasks = changes.get('usage', set()) if previous else set()
+        digests = {key: self.digest(info.get(key)) for key in ['options', 'run_position', 'completed']}
+        digests['order'] = [d['parameters']['name'] for d in info['datasets']]
+        usage = previous.get('usage', {})
+        digests['usage'] = {
+            entry['task']: (
+                usage[entry['task']] if entry['task'] in usage and entry['task'] not in tasks else self.digest(entry)
+            ) for entry in info.get('usage', [])
+        }
+        for dset in info['datasets']:
+            name = dset['parameters']['name']
+            digests[name] = {'log': len(dset['log'])}
+            for section in ['parameters', 'results']:
+                keys = changed.get(name, {}).get(section, set())
+                if name not in previous or keys is None:
+                    digests[name][section] = {k: self.digest(v) for k, v in dset[section].items()}
+                    continue
+                digests[name][section] = dict(previous[name][section])
+                for key in keys:
+                    if key in dset[section]:
+                        digests[name][section][key] = self.digest(dset[section][key])
+                    else:
+                        digests[name][section].pop(key, None)
+        return digests
+
+    def diff(self, info, digests):
+        """
+        Generate a journal record of the changes between the previously saved checkpoint and the current one
+        """
+        record = {'order': digests['order'], 'datasets': {}}
+        for key in ['options', 'run_position', 'completed']:
+            if digests[key] != self.digests[key]:
+                record[key] = info.get(key)
+        previous = self.digests.get('usage', {})
+        if list(digests['usage'].items()) != list(previous.items()):
+            # usage records of tasks which were run again move to the end
+            record['usage'] = {
+                'order': list(digests['usage']),
+                'records': [
+                    entry for entry in info.get('usage', [])
+                    if previous.get(entry['task']) != digests['usage'][entry['task']]
+                ],
+            }
+
+        for dset in info['datasets']:
+            name = dset['parameters']['name']
+            current = digests[name]
+            previous = self.digests.get(name, {'parameters': {}, 'results': {}, 'log': 0})
+            delta = {}
+            for section in ['parameters', 'results']:
+                changed = {
+                    k: dset[section][k] for k, v in current[section].items() if previous[section].get(k) != v
+                }
+                removed = [k for k in previous[section] if k not in current[section]]
+                if changed:
+                    delta[section] = changed
+                if removed:
+                    delta.setdefault('removed', {})[section] = removed
+            start = min(previous['log'], current['log'])
+            if current['log'] != previous['log']:
+                delta['log'] = {'start': start, 'entries': dset['log'][start:]}
+            if delta:
+                record['datasets'][name] = delta
+        return record
+
+    def compact(self, info, digests=None):
+        """
+        Write a new snapshot of the full checkpoint and discard the journal. The snapshot and the records
+        appended after it share a new generation, so that records of an older snapshot are not replayed.
+        """
+        self.generation = time.time_ns()
+        tmp_file = '{}.tmp'.format(self.filename)
+        with gzip.open(tmp_file, 'wb') as handle:
+            msgpack.dump(dict(info, generation=self.generation), handle, default=str)
+        os.replace(tmp_file, self.filename)
+        if os.path.exists(self.journal):
+            os.remove(self.journal)
+        self.digests = digests or self.get_digests(info)
+        self.records = 0
+
+    def save(self, info, compact=False, changes=None):
+        """
+        Save the checkpoint, appending only the changes since the previous save to the journal
+
+        :param info: checkpoint dictionary
+        :param compact: force writing a new snapshot
+        :param changes: optional changes since the previous save, see `get_digests`. All values are
+            compared if not given.
+        """
+        if compact or self.digests is None or self.records >= self.compact_every:
+            self.compact(info)
+            return
+
+        digests = self.get_digests(info, changes)
+        record = self.diff(info, digests)
+        record['generation'] = self.generation
+        with gzip.open(self.journal, 'ab') as handle:
+            msgpack.dump(record, handle, default=str)
+        self.digests = digests
+        self.records += 1
+
+
 def savgol_filter(data, window_length, polyorder, deriv=0):
     """
         applies a Savitzky-Golay filter
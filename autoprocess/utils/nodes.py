@@ -0,0 +1,160 @@
+"""
+Load-aware registry of the cluster nodes used by XDS.
+
+The nodes configured in the DPS_NODES environment variable are probed for their load average and number
+of cores before an XDS.INP file is written. Only nodes which respond and are lightly loaded are included in
+CLUSTER_NODES, and the number of jobs is sized by the free cores of those nodes. Probe results are reused
+for a short time so that several input files written in quick succession do not probe the nodes again.
+
+Remote nodes are probed through ssh, the same way XDS reaches them. Probing can be disabled by setting
+DPS_NODE_PROBE to "off", in which case all nodes are assumed to be idle. DPS_NODE_MAX_LOAD sets the
+largest load per core of a node which is still used (default 0.75).
+
+"""
+
+import functools
+import os
+import socket
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from autoprocess.utils import log
+
+logger = log.get_module_logger(__name__)
+
+PROBE_TIMEOUT = 5  # seconds
+PROBE_CACHE_TIME = 30  # seconds
+MAX_LOAD = float(os.environ.get('DPS_NODE_MAX_LOAD', 0.75))
+LOCAL_NAMES = ('localhost', '127.0.0.1')
+
+
+@functools.lru_cache(maxsize=None)
+def get_fqdn():
+    """Fully qualified name of the local host, resolved on first use since the lookup can be slow"""
+    return socket.getfqdn()
+
+
+class Node(object):
+    """
+    State of a cluster node
+
+    :param name: host name
+    :param cores: number of cores configured for the node
+    :param load: one minute load average, None if the node did not respond
+    """
+
+    def __init__(self, name, cores, load=None):
+        self.name = name
+        self.cores = cores
+        self.load = load
+
+    @property
+    def alive(self):
+        return self.load is not None
+
+    @property
+    def free(self):
+        """Number of idle cores"""
+        if not self.alive:
+            return 0
+        return max(0, min(self.cores, int(self.cores - self.load)))
+
+    def is_healthy(self, max_load=MAX_LOAD):
+        return self.alive and self.free > 0 and self.load <= max_load * self.cores
+
+    def __repr__(self):
+        return '<Node: {}, cores={}, load={}>'.format(self.name, self.cores, self.load)
+
+
+class LocalProber(object):
+    """
+    Probe nodes through ssh, or directly for the local host
+    """
+
+    def __call__(self, name, cores):
+        if name in LOCAL_NAMES or name == socket.gethostname() or name == get_fqdn():
+            return Node(name, cores, os.getloadavg()[0])
+        try:
+            output = subprocess.check_output(
+                ['ssh', '-o', 'BatchMode=yes', '-o', 'ConnectTimeout={}'.format(PROBE_TIMEOUT), name,
+                 'cat /proc/loadavg'],
+                stderr=subprocess.DEVNULL, timeout=PROBE_TIMEOUT * 2
+            )
+            return Node(name, cores, float(output.split()[0]))
+        except (subprocess.SubprocessError, OSError, ValueError, IndexError) as e:
+            logger.debug('Node {} did not respond: {}'.format(name, e))
+            return Node(name, cores)
+
+
+class StaticProber(object):
+    """
+    Stand-in prober reporting fixed loads, for testing and for clusters which should not be probed
+
+    :param loads: dictionary mapping node names to load averages, None for nodes which are down.
+        Nodes which are not listed are idle.
+    """
+
+    def __init__(self, loads=None):
+        self.loads = loads or {}
+
+    def __call__(self, name, cores):
+        return Node(name, cores, self.loads.get(name, 0.0))
+
+
+class NodeRegistry(object):
+    """
+    Registry of cluster nodes which selects the nodes to use for XDS
+
+    :param hosts: dictionary mapping node names to number of cores
+    :param prober: callable taking (name, cores) and returning a Node
+    :param max_load: largest load per core of a node which is selected
+    :param cache_time: seconds for which probe results are reused
+    """
+
+    def __init__(self, hosts, prober=None, max_load=MAX_LOAD, cache_time=PROBE_CACHE_TIME):
+        self.hosts = dict(hosts)
+        self.prober = prober or LocalProber()
+        self.max_load = max_load
+        self.cache_time = cache_time
+        self.nodes = []
+        self.probe_time = 0
+        self.lock = threading.Lock()
+
+    def probe(self):
+        """
+        Probe all nodes concurrently, reusing recent results
+
+        :return: list of Nodes
+        """
+        with self.lock:
+            if time.time() - self.probe_time > self.cache_time:
+                with ThreadPoolExecutor(max_workers=len(self.hosts)) as executor:
+                    futures = [executor.submit(self.prober, name, cores) for name, cores in self.hosts.items()]
+                    self.nodes = [future.result() for future in futures]
+                self.probe_time = time.time()
+                for node in self.nodes:
+                    logger.debug('{}: load {}, {} of {} cores free'.format(node.name, node.load, node.free, node.cores))
+            return list(self.nodes)
+
+    def select(self):
+        """
+        Select the healthy, lightly loaded nodes, with the most free cores first. If no node qualifies,
+        the responding node with the most free cores is used, or the first configured node if none respond.
+
+        :return: list of Nodes
+        """
+        nodes = sorted(self.probe(), key=lambda node: node.free, reverse=True)
+        selected = [node for node in nodes if node.is_healthy(self.max_load)]
+        if not selected:
+            alive = [node for node in nodes if node.alive]
+            selected = [alive[0]] if alive else [Node(name, cores, 0.0) for name, cores in self.hosts.items()][:1]
+            logger.warning('No idle cluster nodes, using {}'.format(selected[0].name))
+        return selected
+
+
+def get_prober():
+    if os.environ.get('DPS_NODE_PROBE', '').lower() == 'off':
+        return StaticProber()
+    return LocalProber()
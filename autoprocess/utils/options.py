@@ -23,9 +23,38 @@ Examples:
     auto.process --screen /foo/bar/test_001.img --dir /foo/screen_output
         Screen dataset and place the output in the given directory
 
+    auto.process --live /foo/bar/test_001.img
+        Start processing as soon as the first frames are on disk, integrating new
+        frames while the dataset is being collected
+
+    auto.process --batch manifest.txt --cores 64 --dir /foo/batch_output
+        Process all datasets listed in manifest.txt, running several at a time
+        without using more than 64 cores in total
+
 """
 
 
+def triage_limit(text):
+    """
+    Parse a TERM=VALUE override of an indexing score term
+
+    :param text: command line argument
+    :return: tuple (term, value)
+    """
+    from autoprocess.utils import xtal
+
+    term, sep, value = text.partition('=')
+    term = term.strip()
+    if term not in xtal.INDEXING_LIMITS:
+        raise argparse.ArgumentTypeError(
+            "unknown term '{}', choose from {}".format(term, ', '.join(xtal.INDEXING_LIMITS))
+        )
+    try:
+        return term, float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid value for '{}': expected TERM=VALUE, got '{}'".format(term, text))
+
+
 def process_parser():
     parser = argparse.ArgumentParser(
         description='Automatically Process a dataset',
@@ -56,10 +85,64 @@ def process_parser():
     parser.add_argument('-x', '--nonchiral', help="Non-chiral spacegroups. Default assumes only chiral molecules",
                         action="store_true")
     group.add_argument('--formula', help="Solve small molecule with provided formula. Eg Mg1O6H12", type=str)
+    parser.add_argument('-j', '--jobs', help=(
+        "Number of datasets to process concurrently in merge and MAD modes, or number of manifest "
+        "entries to process concurrently in batch mode"
+    ), type=int, default=0)
+    parser.add_argument('--linkage', help=(
+        "Linkage used to cluster datasets by correlation in merge mode"
+    ), choices=('single', 'complete', 'average', 'weighted'), default='complete')
+    parser.add_argument('--cluster-cutoff', help=(
+        "Largest distance (1 - CC) between datasets of the same cluster in merge mode"
+    ), type=float, default=0.05)
+    parser.add_argument('--trials', help=(
+        "Number of top space group candidates to refine concurrently. The best is selected by its statistics"
+    ), type=int, default=1)
+    parser.add_argument('--speculative', help=(
+        "When indexing fails, try all remedies concurrently instead of one after another. "
+        "'first' keeps the first solution found, 'best' (default) the solution with the best indexing score"
+    ), nargs='?', const='best', choices=('first', 'best'))
+    parser.add_argument('--triage', help=(
+        "Minimum indexing score (0 to 1) in screening mode. Screening stops after indexing below this score"
+    ), type=float, default=0.0)
+    parser.add_argument('--triage-limit', help=(
+        "Override the midpoint of an indexing score term. Eg. stdev_spot=3.0. "
+        "Terms: indexed_fraction, subtree_fraction, stdev_spot, stdev_spindle, mosaicity, problems"
+    ), type=triage_limit, action='append', default=[], metavar='TERM=VALUE')
+    parser.add_argument('--live', help="Start processing while frames are still being collected",
+                        action="store_true")
+    parser.add_argument('--chunk', help="Degrees of data to integrate at a time in live mode",
+                        type=float, default=10.0)
+    parser.add_argument('--timeout', help=(
+        "Seconds to wait for new frames in live mode before assuming the collection is complete"
+    ), type=float, default=60.0)
+    parser.add_argument('--batch', help=(
+        "Process many independent datasets listed in a manifest file, one set of auto.process arguments per line. "
+        "Logs and a summary of all results are saved in the directory given by --dir"
+    ), type=str, metavar='MANIFEST')
+    parser.add_argument('--cores', help=(
+        "Total number of cores shared by all datasets in batch mode. Default is all cores available"
+    ), type=int, default=0)
 
     return parser
 
 
+def tune_parser():
+    parser = argparse.ArgumentParser(
+        description=(
+            'Benchmark XDS parallelization settings on this host and save the throughput in the profile '
+            'used to choose the settings for later runs'
+        )
+    )
+    parser.add_argument('image', nargs=1, help='Representative diffraction image of the dataset to benchmark')
+    parser.add_argument('-d', '--dir', help="Working directory. Default is tune-<dataset name>", type=str)
+    parser.add_argument('-f', '--frames', help="Number of frames to process in each benchmark", type=int, default=100)
+    parser.add_argument('--cores', help="Total number of cores to use. Default is all cores", type=int, default=0)
+    parser.add_argument('--processors', help="Comma separated list of processors per job to try", type=str)
+    parser.add_argument('--delphi', help="Comma separated list of DELPHI values to try", type=str, default='2,4,8')
+    return parser
+
+
 def analyse_parser():
     parser = argparse.ArgumentParser(description='Analyse a diffraction frame')
     parser.add_argument('image', nargs=1, help='Diffraction image to analyse')
@@ -129,6 +212,9 @@ Examples:
     auto.scale --anom
         scale with Friedel's law False
 
+    auto.scale -r 1.8 --preview
+        show the statistics to 1.8 A calculated from the corrected reflections, without scaling
+
 """
 
 
@@ -144,6 +230,10 @@ def scale_parser():
         '-d', '--dir', help="Directory containing previous processing. Default is current directory.", type=str
     )
     parser.add_argument('-r', '--res', help="Force high resolution limit", type=float)
+    parser.add_argument(
+        '-p', '--preview', action="store_true",
+        help="Only show the statistics at the resolution limit, calculated from the corrected reflections"
+    )
     return parser
 
 
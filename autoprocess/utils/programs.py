@@ -1,10 +1,34 @@
+"""
+Wrappers for external programs.
+
+All programs are run by an executor which limits the number of processors in use by all programs of the
+process, including those started concurrently from several threads. Each command reserves a number of
+slots from a shared pool, one slot per processor, and waits until they are free before starting. Commands
+can be given a timeout and can be cancelled, in which case the program and all its children receive SIGTERM,
+followed by SIGKILL if they have not exited after a few seconds.
+
+"""
+
 import asyncio
+import collections
 import os
+import shutil
+import signal
 import subprocess
+import sys
+import tempfile
+import threading
 import time
 
 from progress.spinner import Spinner
 
+from autoprocess.errors import ProcessError
+from autoprocess.utils import ledger, misc, tuning, xdsio
+from autoprocess.utils.cache import STEP_CACHE
+
+# Spinners are disabled when several datasets are processed concurrently
+SHOW_SPINNER = True
+KILL_DELAY = 5  # seconds between SIGTERM and SIGKILL
 
 
 class BlankSpinner(object):
@@ -23,59 +47,376 @@ class BlankSpinner(object):
         pass
 
 
+class LineSpinner(object):
+    """A spinner which only shows the final line, for commands running alongside others"""
+
+    def __init__(self, message):
+        self.message = message
+        self.text = ''
+
+    def next(self):
+        pass
+
+    def write(self, text):
+        self.text = text
+
+    def finish(self):
+        sys.stderr.write('{}{}\n'.format(self.message, self.text))
+
+
+class SlotPool(object):
+    """
+    A pool of processor slots shared by the event loops of all threads. Requests are granted in order,
+    so that commands needing many slots are not starved by a stream of smaller ones.
+
+    :param size: number of slots
+    """
+
+    def __init__(self, size):
+        self.size = max(1, size)
+        self.free = self.size
+        self.lock = threading.Lock()
+        self.waiters = collections.deque()
+
+    async def acquire(self, count=None):
+        """
+        Wait until the slots are available and reserve them
+
+        :param count: number of slots, all slots if None. Requests larger than the pool are limited to its size.
+        :return: number of slots reserved
+        """
+        count = self.size if count is None else max(1, min(count, self.size))
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if not self.waiters and self.free >= count:
+                self.free -= count
+                return count
+            waiter = {'count': count, 'loop': loop, 'future': loop.create_future(), 'granted': False}
+            self.waiters.append(waiter)
+        try:
+            await waiter['future']
+        except asyncio.CancelledError:
+            with self.lock:
+                granted = waiter['granted']
+                if not granted:
+                    self.waiters.remove(waiter)
+            if granted:
+                self.release(count)
+            raise
+        return count
+
+    def release(self, count):
+        with self.lock:
+            self.free += count
+            while self.waiters and self.waiters[0]['count'] <= self.free:
+                waiter = self.waiters.popleft()
+                self.free -= waiter['count']
+                waiter['granted'] = True
+                waiter['loop'].call_soon_threadsafe(_wake, waiter['future'])
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(True)
+
+
 class Command(object):
-    def __init__(self, *args, outfile="commands.log", label="Processing", spinner=True, final='done'):
-        self.show_spinner = spinner
-        self.outfile = outfile
+    """
+    An external program run through the shell
+
+    :param args: command and arguments
+    :param directory: working directory
+    :param outfile: file in the working directory to which the output is appended
+    :param label: description shown next to the spinner
+    :param spinner: whether to show a spinner
+    :param final: text shown when the command completes
+    :param slots: number of processors used by the program, None to reserve all of them for exclusive use
+    :param timeout: seconds after which the program is terminated, None for no limit
+    :param check: raise a ProcessError if the program exits with a non-zero status
+    """
+
+    def __init__(self, *args, directory='.', outfile="commands.log", label="Processing", spinner=True, final='done',
+                 slots=1, timeout=None, check=True):
+        # spinners from several threads would garble the terminal
+        self.show_spinner = spinner and SHOW_SPINNER and threading.current_thread() is threading.main_thread()
+        self.directory = directory
+        self.outfile = os.path.join(directory, outfile)
         self.args = " ".join(args)
         self.final = final
         self.label = label
+        self.slots = slots
+        self.timeout = timeout
+        self.check = check
         self.proc = None
-        if spinner:
+        self.usage = None
+        self.cancelled = False
+        self.timed_out = False
+        self.shared = False  # whether other commands ran at the same time
+        if self.show_spinner:
             self.spinner = Spinner(f' - {self.label} ... ')
         else:
             self.spinner = BlankSpinner()
 
+    @property
+    def running(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    def signal(self, signum):
+        """Send a signal to the program and all its children"""
+        if self.running:
+            try:
+                os.killpg(self.proc.pid, signum)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+    def cancel(self):
+        """
+        Terminate the program from any thread. It is killed if it has not exited after KILL_DELAY seconds.
+        """
+        self.cancelled = True
+        self.signal(signal.SIGTERM)
+        timer = threading.Timer(KILL_DELAY, self.signal, args=(signal.SIGKILL,))
+        timer.daemon = True
+        timer.start()
+
+    async def spin(self):
+        while True:
+            self.spinner.next()
+            await asyncio.sleep(.1)
+
+    async def stop(self, waiter):
+        """
+        Terminate the program, kill it if it does not exit in time, and return the result of waiter
+        """
+        self.signal(signal.SIGTERM)
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter), KILL_DELAY)
+        except asyncio.TimeoutError:
+            self.signal(signal.SIGKILL)
+            return await waiter
+
     async def run(self):
-        with open(self.outfile, 'a') as stdout:
-            proc = await asyncio.create_subprocess_shell(self.args, stdout=stdout, stderr=stdout)
-            while proc.returncode is None:
-                self.spinner.next()
-                await asyncio.sleep(.1)
-            self.spinner.write(self.final)
+        slots = await EXECUTOR.slots.acquire(self.slots)
+        spinner = asyncio.ensure_future(self.spin())
+        try:
+            if self.cancelled:
+                # cancelled while waiting for processor slots
+                raise ProcessError('{} was cancelled'.format(self.args))
+            start_time = time.time()
+            with open(self.outfile, 'a') as stdout:
+                self.proc = subprocess.Popen(
+                    self.args, shell=True, stdout=stdout, stderr=stdout, cwd=self.directory, start_new_session=True
+                )
+            EXECUTOR.add(self)
+            # reap the process ourselves, in a worker thread, to obtain the resources used by the program and
+            # its children
+            waiter = asyncio.ensure_future(asyncio.to_thread(os.wait4, self.proc.pid, 0))
+            try:
+                pid, status, rusage = await asyncio.wait_for(asyncio.shield(waiter), self.timeout)
+            except asyncio.TimeoutError:
+                self.timed_out = True
+                pid, status, rusage = await self.stop(waiter)
+            except asyncio.CancelledError:
+                self.cancelled = True
+                pid, status, rusage = await self.stop(waiter)
+                self.proc.returncode = os.waitstatus_to_exitcode(status)
+                raise
+            self.proc.returncode = os.waitstatus_to_exitcode(status)
+            self.usage = ledger.record_command(self.args, rusage, time.time() - start_time)
+        finally:
+            spinner.cancel()
+            EXECUTOR.discard(self)
+            EXECUTOR.slots.release(slots)
+
+        if self.timed_out:
+            self.spinner.write('timed out')
+            self.spinner.finish()
+            raise ProcessError('{} timed out after {} seconds'.format(self.args, self.timeout))
+        elif self.cancelled:
+            self.spinner.write('cancelled')
             self.spinner.finish()
+            raise ProcessError('{} was cancelled'.format(self.args))
+        elif self.check and self.proc.returncode != 0:
+            self.spinner.write('failed')
+            self.spinner.finish()
+            raise ProcessError('{} exited with status {}'.format(self.args, self.proc.returncode))
+        self.spinner.write(self.final)
+        self.spinner.finish()
 
     def start(self):
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(self.run())
+        """Run the command and wait for it to finish"""
+        EXECUTOR.run(self)
+
+    def skip(self, final):
+        """Report the command as completed without running it"""
+        self.spinner.next()
+        self.spinner.write(final)
+        self.spinner.finish()
+
+
+class Executor(object):
+    """
+    Runs commands concurrently within the processor slots available to the process
+
+    :param slots: number of processor slots
+    """
+
+    def __init__(self, slots):
+        self.slots = SlotPool(slots)
+        self.commands = set()
+        self.lock = threading.Lock()
+
+    def add(self, command):
+        with self.lock:
+            self.commands.add(command)
+            if len(self.commands) > 1:
+                for other in self.commands:
+                    other.shared = True
+
+    def discard(self, command):
+        with self.lock:
+            self.commands.discard(command)
+
+    def run(self, *commands, return_exceptions=False):
+        """
+        Run commands concurrently and wait for all of them to finish. May be called from any thread, each
+        call uses its own event loop. If a command fails, the others are cancelled unless return_exceptions
+        is True.
+
+        :param commands: Command instances
+        :param return_exceptions: return exceptions as results instead of raising the first one
+        :return: list of results, None or an exception for each command
+        """
+        return self.run_sequences([[command] for command in commands], return_exceptions=return_exceptions)
+
+    def run_sequences(self, sequences, return_exceptions=False):
+        """
+        Run sequences of commands concurrently, the commands of each sequence one after the other.
+
+        :param sequences: list of lists of Command instances
+        :param return_exceptions: return exceptions as results instead of raising the first one
+        :return: list of results, None or an exception for each sequence
+        """
+        if len(sequences) > 1:
+            # spinners running side by side would garble the terminal, show only the final lines
+            for command in [command for sequence in sequences for command in sequence]:
+                if command.show_spinner:
+                    command.spinner = LineSpinner(command.spinner.message)
+
+        async def run_sequence(sequence):
+            for command in sequence:
+                await command.run()
+
+        async def run_all():
+            return await asyncio.gather(
+                *[run_sequence(sequence) for sequence in sequences], return_exceptions=return_exceptions
+            )
+
+        return asyncio.run(run_all())
+
+    def cancel(self):
+        """Cancel all running commands"""
+        with self.lock:
+            commands = list(self.commands)
+        for command in commands:
+            command.cancel()
+
+
+EXECUTOR = Executor(xdsio.get_core_budget() or misc.get_cpu_count())
+
+
+def append_log(scratch, directory='.'):
+    """
+    Append the command log of a scratch directory to that of the working directory
+
+    :param scratch: scratch directory
+    :param directory: working directory
+    """
+    log_file = os.path.join(scratch, 'commands.log')
+    if os.path.exists(log_file):
+        with open(log_file, 'r') as source, open(os.path.join(directory, 'commands.log'), 'a') as target:
+            shutil.copyfileobj(source, target)
+
+
+def run_isolated(jobs, directory='.'):
+    """
+    Run independent jobs concurrently, each in its own scratch directory within the working directory.
+    The input files of each job are linked into its scratch directory so that jobs which write files with
+    the same names do not interfere. The outputs of successful jobs are moved back into the working
+    directory, replacing existing files atomically.
+
+    :param jobs: list of (prepare, inputs, outputs) tuples. prepare(scratch) writes the input files of the
+        job into the scratch directory and returns a list of Commands to run there one after the other.
+        inputs and outputs are lists of file names relative to the working directory.
+    :param directory: working directory
+    :return: list of results, None for each successful job or the exception which made it fail
+    """
+    scratch_dirs = []
+    try:
+        sequences = []
+        for prepare, inputs, outputs in jobs:
+            scratch = tempfile.mkdtemp(prefix='.scratch-', dir=directory)
+            scratch_dirs.append(scratch)
+            misc.link_files(directory, scratch, inputs)
+            sequences.append(prepare(scratch))
+        results = EXECUTOR.run_sequences(sequences, return_exceptions=True)
+
+        for scratch, (prepare, inputs, outputs), result in zip(scratch_dirs, jobs, results):
+            if result is None:
+                misc.move_files(scratch, directory, outputs)
+            append_log(scratch, directory)
+        return results
+    finally:
+        for scratch in scratch_dirs:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+def xds(label='Processing', directory='.'):
+    # XDS reports failures in its LP files, which are checked by the callers
+    command = Command('xds', directory=directory, label=label, check=False)
+    STEP_CACHE.run(command, 'XDS.INP')
+
+
+def input_slots(directory, filename):
+    """
+    Processor slots to reserve for a parallel XDS or XSCALE run, from the limits in its input file
+
+    :param directory: working directory
+    :param filename: input file name
+    :return: number of slots, all slots if the input does not limit the number of processors
+    """
+    return xdsio.get_input_processors(os.path.join(directory, filename)) or EXECUTOR.slots.size
 
 
-def xds(label='Processing'):
-    command = Command('xds', label=label)
-    command.start()
+def xds_par(label='Processing', directory='.'):
+    slots = input_slots(directory, 'XDS.INP')
+    command = Command('xds_par', directory=directory, label=label, slots=slots, check=False)
+    STEP_CACHE.run(command, 'XDS.INP')
+    if command.usage and not command.shared:
+        # only runs which had the processors to themselves are representative of the host
+        tuning.record_run(directory)
 
 
-def xds_par(label='Processing'):
-    command = Command('xds_par', label=label)
-    command.start()
+def xscale(label='Scaling', directory='.'):
+    command = Command('xscale', directory=directory, label=label, check=False)
+    STEP_CACHE.run(command, 'XSCALE.INP')
 
 
-def xscale(label='Scaling'):
-    command = Command('xscale', label=label)
-    command.start()
+def xscale_par(label='Scaling', directory='.'):
+    slots = input_slots(directory, 'XSCALE.INP')
+    command = Command('xscale_par', directory=directory, label=label, slots=slots, check=False)
+    STEP_CACHE.run(command, 'XSCALE.INP')
 
 
-def xscale_par(label='Scaling'):
-    command = Command('xscale_par', label=label)
-    command.start()
+def xdsconv_command(label='Converting', final='done', directory='.'):
+    return Command('xdsconv', directory=directory, label=label, final=final)
 
 
-def xdsconv(label='Converting', final='done'):
-    command = Command('xdsconv', label=label, final=final)
-    command.start()
+def xdsconv(label='Converting', final='done', directory='.'):
+    xdsconv_command(label=label, final=final, directory=directory).start()
 
 
-def f2mtz(filename):
+def f2mtz_command(filename, directory='.'):
     file_text = "#!/bin/csh \n"
     file_text += "f2mtz HKLOUT temp.mtz < F2MTZ.INP\n"
     file_text += "cad HKLIN1 temp.mtz HKLOUT %s <<EOF\n" % filename
@@ -83,23 +424,30 @@ def f2mtz(filename):
     file_text += "END\n"
     file_text += "EOF\n"
     file_text += "/bin/rm temp.mtz\n"
-    with open('f2mtz.com', 'w') as outfile:
+    with open(os.path.join(directory, 'f2mtz.com'), 'w') as outfile:
         outfile.write(file_text)
-    subprocess.check_output(['sh', 'f2mtz.com'])
+    return Command('sh', 'f2mtz.com', directory=directory, spinner=False)
+
+
+def f2mtz(filename, directory='.'):
+    f2mtz_command(filename, directory=directory).start()
 
 
-def xdsstat(filename):
+def xdsstat_command(filename, directory='.'):
     file_text = "#!/bin/csh \n"
     file_text += "xdsstat <<EOF > XDSSTAT.LP\n"
     file_text += "%s\n" % filename
     file_text += "EOF\n"
-    with open('xdsstat.com', 'w') as outfile:
+    with open(os.path.join(directory, 'xdsstat.com'), 'w') as outfile:
         outfile.write(file_text)
-    command = Command('sh', 'xdsstat.com', spinner=False, label='Calculating extra statistics')
-    command.start()
+    return Command('sh', 'xdsstat.com', directory=directory, spinner=False, label='Calculating extra statistics')
+
 
+def xdsstat(filename, directory='.'):
+    xdsstat_command(filename, directory=directory).start()
 
-def pointless(retry=False, chiral=True, filename="INTEGRATE.HKL"):
+
+def pointless(retry=False, chiral=True, filename="INTEGRATE.HKL", directory='.'):
     chiral_setting = {True: "", False: "chirality nonchiral"}
     txt = (
         "pointless << eof\n"
@@ -109,14 +457,14 @@ def pointless(retry=False, chiral=True, filename="INTEGRATE.HKL"):
         "choose solution 1\n"
         "eof\n"
     ).format(chiral_setting[chiral], filename)
-    with open('pointless.com', 'w') as fobj:
+    with open(os.path.join(directory, 'pointless.com'), 'w') as fobj:
         fobj.write(txt)
     label = "Automatically determining Symmetry of {}".format(filename)
-    command = Command('sh', 'pointless.com', label=label, spinner=False)
+    command = Command('sh', 'pointless.com', directory=directory, label=label, spinner=False)
     command.start()
 
 
-def best(data_info, options=None):
+def best(data_info, options=None, directory='.'):
     options = options or {}
     option_flags = {}
     flags = {
@@ -144,50 +492,52 @@ def best(data_info, options=None):
 
     command = "best {}".format(' '.join([f'{key} {value}' for key, value in flags.items()]))
 
-    with open('best.com', 'w') as fobj:
+    with open(os.path.join(directory, 'best.com'), 'w') as fobj:
         fobj.write(command)
 
-    command = Command('sh', 'best.com', outfile="best.log", spinner=False)
+    command = Command('sh', 'best.com', directory=directory, outfile="best.log", spinner=False)
     command.start()
 
 
-def xtriage(filename, label="Checking quality of dataset", options=None):
-    options = options or {}
+def xtriage_command(filename, label="Checking quality of dataset", directory='.'):
     command = "#!/bin/csh \n"
     command += "pointless -c xdsin %s hklout UNMERGED.mtz > unmerged.log \n" % (filename)
     command += "phenix.xtriage UNMERGED.mtz log=xtriage.log loggraphs=True\n"
-    with open('xtriage.com', 'w') as fobj:
+    with open(os.path.join(directory, 'xtriage.com'), 'w') as fobj:
         fobj.write(command)
-    command = Command('sh', 'xtriage.com', outfile='xtriage.log', label=label)
-    command.start()
+    return Command('sh', 'xtriage.com', directory=directory, outfile='xtriage.log', label=label)
+
+
+def xtriage(filename, label="Checking quality of dataset", options=None, directory='.'):
+    xtriage_command(filename, label=label, directory=directory).start()
 
 
-def distl(filename):
-    command = Command('labelit.distl', outfile="distl.log", spinner=False)
+def distl(filename, directory='.'):
+    command = Command('labelit.distl', filename, directory=directory, outfile="distl.log", spinner=False)
     command.start()
 
 
-def shelx_sm(name, unit_cell, formula):
-    if not os.path.exists("shelx-sm"):
-        os.mkdir("shelx-sm")
-    os.chdir("shelx-sm")
-    xprep(name, unit_cell, formula)
+def shelx_sm(name, unit_cell, formula, directory='.'):
+    shelx_dir = os.path.join(directory, "shelx-sm")
+    if not os.path.exists(shelx_dir):
+        os.mkdir(shelx_dir)
+    xprep(name, unit_cell, formula, directory=shelx_dir)
     command = "#!/bin/csh \n"
     command += "shelxd %s \n" % (name)
     command += "/bin/cp -f %s.res %s.ins\n" % (name, name)
     command += "shelxl %s \n" % (name,)
 
-    with open('shelx-sm.com', 'w') as fobj:
+    with open(os.path.join(shelx_dir, 'shelx-sm.com'), 'w') as fobj:
         fobj.write(command)
 
-    command = Command('sh', 'shelx-sm.com', spinner=False)
+    command = Command('sh', 'shelx-sm.com', directory=shelx_dir, spinner=False)
     command.start()
 
 
-def xprep(name, unit_cell, formula):
+def xprep(name, unit_cell, formula, directory='.'):
     import pexpect
     filename = os.path.join('..', '%s-shelx.hkl' % name)
-    client = pexpect.spawn('xprep %s' % filename)
+    client = pexpect.spawn('xprep %s' % filename, cwd=directory)
     log = ""
     commands = [
         ('Enter cell .+:\r\n\s', ' '.join(["%s" % v for v in unit_cell])),
@@ -0,0 +1,189 @@
+"""
+Spot lists in the SPOT.XDS format written by COLSPOT and updated by IDXREF.
+
+Each record holds the detector coordinates x, y (pixels) and z (frame) of the spot centroid and its
+intensity, followed by the Miller indices h, k, l once the spots have been indexed. The file is parsed once
+by NumPy into a structured array which is cached in a binary .npy file next to the spot list, together with
+the size and modification time of the spot list it was created from, so that repeated filtering between
+indexing attempts does not parse the text again. Filters return boolean masks which can be combined, and the
+spot list is only rewritten when a selection actually removes spots.
+
+"""
+
+import mmap
+import os
+
+import numpy
+
+from autoprocess.utils import log, misc
+
+logger = log.get_module_logger(__name__)
+
+# resolution ranges (high, low) of hexagonal ice rings, as recommended for EXCLUDE_RESOLUTION_RANGE in XDS
+ICE_RINGS = (
+    (3.87, 3.93), (3.64, 3.70), (3.41, 3.47), (2.64, 2.70), (2.22, 2.28),
+    (2.042, 2.102), (1.918, 1.978), (1.888, 1.948), (1.853, 1.913), (1.691, 1.751),
+)
+
+SPOT_FORMATS = {
+    4: ('x', 'y', 'z', 'intensity'),
+    7: ('x', 'y', 'z', 'intensity', 'h', 'k', 'l'),
+    8: ('x', 'y', 'z', 'intensity', 'iseg', 'h', 'k', 'l'),
+}
+INTEGER_FIELDS = ('iseg', 'h', 'k', 'l')
+FIELD_FORMATS = {'x': '{:10.2f}', 'y': '{:10.2f}', 'z': '{:10.2f}', 'intensity': '{:9.0f}.'}
+
+
+class SpotList(object):
+    """
+    Spots from a SPOT.XDS file
+
+    :param filename: spot file
+    """
+
+    def __init__(self, filename='SPOT.XDS'):
+        self.filename = filename
+        self.spots = self._load()
+
+    def __len__(self):
+        return len(self.spots)
+
+    @property
+    def indexed(self):
+        return 'h' in self.spots.dtype.names
+
+    def _parse(self):
+        with open(self.filename, 'rb') as handle:
+            if not os.fstat(handle.fileno()).st_size:
+                return numpy.empty(0, dtype=[(name, numpy.float32) for name in SPOT_FORMATS[4]])
+            with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                first = data[:data.find(b'\n')].split()
+                names = SPOT_FORMATS.get(len(first))
+                if names is None:
+                    raise ValueError('Unrecognized spot list format: {}'.format(self.filename))
+                values = numpy.fromstring(data[:], dtype=float, sep=' ')
+        if len(values) % len(names):
+            raise ValueError('Incomplete spot record in {}'.format(self.filename))
+        values = values.reshape(-1, len(names))
+        spots = numpy.empty(len(values), dtype=[
+            (name, numpy.int32 if name in INTEGER_FIELDS else numpy.float32) for name in names
+        ])
+        for i, name in enumerate(names):
+            spots[name] = values[:, i]
+        return spots
+
+    def _load(self):
+        """
+        Read the spots through the binary cache, which is updated if the spot file has changed
+        """
+        spots = misc.load_array_cache('{}.npy'.format(self.filename), self.filename)
+        if spots is None:
+            ident = misc.file_ident(self.filename)
+            spots = self._parse()
+            self._cache(spots, ident)
+        return spots
+
+    def _cache(self, spots, ident):
+        try:
+            misc.save_array_cache('{}.npy'.format(self.filename), spots, ident)
+        except OSError as e:
+            logger.debug('Unable to cache spots: {}'.format(e))
+
+    def strong(self, minimum):
+        """
+        Spots with an intensity above the minimum
+
+        :param minimum: intensity threshold
+        :return: boolean mask
+        """
+        return self.spots['intensity'] > minimum
+
+    def unindexed(self):
+        """
+        Spots not indexed by IDXREF, all spots if the list has not been indexed.
+
+        :return: boolean mask
+        """
+        if not self.indexed:
+            return numpy.ones(len(self), dtype=bool)
+        return (self.spots['h'] == 0) & (self.spots['k'] == 0) & (self.spots['l'] == 0)
+
+    def frames(self, ranges):
+        """
+        Spots within the given frame windows. Frame n covers the z coordinates from n - 1 to n.
+
+        :param ranges: list of (first, last) frame number pairs, inclusive
+        :return: boolean mask
+        """
+        z = self.spots['z']
+        mask = numpy.zeros(len(self), dtype=bool)
+        for first, last in ranges:
+            mask |= (z >= first - 1) & (z <= last)
+        return mask
+
+    def resolution(self, parameters):
+        """
+        Resolution of each spot from the detector geometry
+
+        :param parameters: dictionary with keys 'beam_center', 'pixel_size', 'distance', 'wavelength'
+            and optionally 'two_theta', as used for XDS.INP
+        :return: array of d-spacings in Angstrom
+        """
+        two_theta = numpy.radians(parameters.get('two_theta', 0.0))
+        dx = (self.spots['x'] - parameters['beam_center'][0]) * parameters['pixel_size']
+        dy = (self.spots['y'] - parameters['beam_center'][1]) * parameters['pixel_size']
+
+        # laboratory coordinates, the detector is rotated about the x axis by the two-theta angle
+        lab_y = dy * numpy.cos(two_theta) + parameters['distance'] * numpy.sin(two_theta)
+        lab_z = parameters['distance'] * numpy.cos(two_theta) - dy * numpy.sin(two_theta)
+        angle = numpy.arctan2(numpy.hypot(dx, lab_y), lab_z)
+        with numpy.errstate(divide='ignore'):
+            return parameters['wavelength'] / (2 * numpy.sin(angle / 2))
+
+    def resolution_band(self, parameters, high=0.0, low=numpy.inf):
+        """
+        Spots within a resolution band
+
+        :param parameters: detector geometry, see :meth:`resolution`
+        :param high: high resolution limit
+        :param low: low resolution limit
+        :return: boolean mask
+        """
+        d = self.resolution(parameters)
+        return (d >= high) & (d <= low)
+
+    def ice_free(self, parameters, rings=ICE_RINGS):
+        """
+        Spots outside of the ice rings
+
+        :param parameters: detector geometry, see :meth:`resolution`
+        :param rings: resolution ranges (high, low) to exclude
+        :return: boolean mask
+        """
+        d = self.resolution(parameters)
+        mask = numpy.ones(len(self), dtype=bool)
+        for high, low in rings:
+            mask &= (d < high) | (d > low)
+        return mask
+
+    def save(self, mask):
+        """
+        Keep only the selected spots, rewriting the spot file if any spot is removed.
+
+        :param mask: boolean mask of spots to keep
+        :return: True if the spot file was rewritten
+        """
+        if mask.all():
+            return False
+        self.spots = self.spots[mask]
+        names = self.spots.dtype.names
+        line = ''.join(FIELD_FORMATS.get(name, '{:7d}') for name in names) + '\n'
+        columns = [self.spots[name].tolist() for name in names]
+        # replace the file instead of rewriting it, it may be linked into the scratch directories of other runs
+        temp_file = '{}.tmp'.format(self.filename)
+        with open(temp_file, 'w') as handle:
+            handle.writelines(line.format(*values) for values in zip(*columns))
+        os.replace(temp_file, self.filename)
+        self._cache(self.spots, misc.file_ident(self.filename))
+        return True
+
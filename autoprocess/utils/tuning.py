@@ -0,0 +1,198 @@
+"""
+Parallelization profile of XDS for each host and detector.
+
+The throughput (frames per second) of COLSPOT and INTEGRATE is recorded for each combination of
+MAXIMUM_NUMBER_OF_JOBS, MAXIMUM_NUMBER_OF_PROCESSORS and DELPHI used on a host. The settings with the
+highest throughput are used for later runs on the same host with the same detector. Measurements are
+added whenever XDS runs, and the `auto.tune` command benchmarks a range of settings to fill the profile.
+
+The profile is saved in the file given by the DPS_PROFILE environment variable, or
+`~/.config/autoprocess/profile.json`.
+
+"""
+
+import fcntl
+import os
+import re
+import socket
+import tempfile
+from contextlib import contextmanager
+
+from autoprocess.utils import log, misc
+from autoprocess.utils.misc import json
+
+logger = log.get_module_logger(__name__)
+
+PROFILE_FILE = os.environ.get(
+    'DPS_PROFILE', os.path.join(misc.get_home_dir(), '.config', 'autoprocess', 'profile.json')
+)
+TUNED_JOBS = ('COLSPOT', 'INTEGRATE')
+MIN_FRAMES = 10  # shorter runs are not measured, start-up time dominates
+WALL_TIME_PATTERN = re.compile(r'elapsed wall-clock time\s+([\d.]+)\s+sec')
+SHARED_MARKER = '!- Shared processors:'  # XDS.INP comment of runs limited to a share of the machine
+
+
+def settings_key(jobs, processors, delphi):
+    return '{}:{}:{:g}'.format(jobs, processors, delphi)
+
+
+def detector_key(detector, size):
+    """
+    Profile key of a detector
+
+    :param detector: XDS detector type, eg EIGER
+    :param size: detector size in pixels (NX, NY)
+    """
+    return '{}-{}x{}'.format(detector.upper(), *size)
+
+
+class Profile(object):
+    """
+    Measured XDS throughput for each host, detector, job and parallelization setting
+
+    :param filename: profile file name
+    """
+
+    def __init__(self, filename=PROFILE_FILE):
+        self.filename = filename
+
+    def load(self):
+        try:
+            return misc.load_json(self.filename)
+        except (OSError, ValueError):
+            return {}
+
+    @contextmanager
+    def update(self):
+        """
+        Context manager which yields the profile data for modification and saves it afterwards. Concurrent
+        updates from several processes are serialized with a lock file.
+        """
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        with open('{}.lock'.format(self.filename), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            data = self.load()
+            yield data
+            handle, tmp_name = tempfile.mkstemp(dir=directory, prefix='.profile-')
+            with os.fdopen(handle, 'w') as outfile:
+                json.dump(data, outfile, indent=2)
+            os.replace(tmp_name, self.filename)
+
+    def record(self, detector, job, jobs, processors, delphi, frames, wall, host=None):
+        """
+        Add a throughput measurement to the profile
+
+        :param detector: detector key
+        :param job: XDS job, COLSPOT or INTEGRATE
+        :param jobs: MAXIMUM_NUMBER_OF_JOBS
+        :param processors: MAXIMUM_NUMBER_OF_PROCESSORS
+        :param delphi: DELPHI in degrees
+        :param frames: number of frames processed
+        :param wall: elapsed time in seconds
+        :param host: host name, default is the current host
+        """
+        if frames < MIN_FRAMES or wall <= 0:
+            return
+        host = host or socket.gethostname()
+        with self.update() as data:
+            entries = data.setdefault(host, {}).setdefault(detector, {}).setdefault(job, {})
+            entry = entries.setdefault(settings_key(jobs, processors, delphi), {
+                'jobs': jobs, 'processors': processors, 'delphi': delphi, 'frames': 0, 'wall': 0.0, 'runs': 0,
+            })
+            entry['frames'] += frames
+            entry['wall'] += wall
+            entry['runs'] += 1
+            entry['throughput'] = entry['frames'] / entry['wall']
+
+    def best(self, detector, job='INTEGRATE', cores=0, max_delphi=None, host=None):
+        """
+        Find the settings with the highest measured throughput
+
+        :param detector: detector key
+        :param job: XDS job, COLSPOT or INTEGRATE
+        :param cores: only consider settings using at most this many cores if non-zero
+        :param max_delphi: only consider settings with at most this DELPHI
+        :param host: host name, default is the current host
+        :return: dictionary with 'jobs', 'processors', 'delphi' and 'throughput' keys or None
+        """
+        host = host or socket.gethostname()
+        entries = self.load().get(host, {}).get(detector, {}).get(job, {}).values()
+        candidates = [
+            entry for entry in entries
+            if (not cores or entry['jobs'] * entry['processors'] <= cores)
+            and (max_delphi is None or entry['delphi'] <= max_delphi)
+        ]
+        if candidates:
+            return max(candidates, key=lambda entry: entry['throughput'])
+
+
+def read_settings(directory='.'):
+    """
+    Read the parallelization settings and frame counts from XDS.INP
+
+    :param directory: XDS working directory
+    :return: dictionary
+    """
+    with open(os.path.join(directory, 'XDS.INP'), 'r') as handle:
+        lines = handle.readlines()
+    text = '\n'.join(line.split('!', 1)[0] for line in lines)
+
+    def values(keyword):
+        return re.findall(r'^\s*{}=\s*([^\n]+)'.format(re.escape(keyword)), text, re.MULTILINE)
+
+    def frame_count(ranges):
+        return sum(int(last) - int(first) + 1 for first, last in (r.split()[:2] for r in ranges))
+
+    size = re.search(r'NX=\s*(\d+)\s+NY=\s*(\d+)', text)
+    jobs = values('MAXIMUM_NUMBER_OF_JOBS')
+    processors = values('MAXIMUM_NUMBER_OF_PROCESSORS')
+    return {
+        'jobs': values('JOB')[0].split(),
+        'detector': detector_key(values('DETECTOR')[0].split()[0], size.groups()),
+        'max_jobs': int(jobs[0]) if jobs else 1,
+        'processors': int(processors[0]) if processors else misc.get_cpu_count(),
+        'delphi': float(values('DELPHI')[0].split()[0]),
+        'shared': any(line.startswith(SHARED_MARKER) for line in lines),
+        'frames': {
+            'COLSPOT': frame_count(values('SPOT_RANGE')),
+            'INTEGRATE': frame_count(values('DATA_RANGE')) - frame_count(values('EXCLUDE_DATA_RANGE')),
+        }
+    }
+
+
+def record_run(directory='.', profile=None):
+    """
+    Record the throughput of the COLSPOT and INTEGRATE jobs of the XDS run in a directory. Runs limited to
+    a share of the machine are not recorded, their throughput depends on the load of the other processes.
+
+    :param directory: XDS working directory
+    :param profile: Profile instance, default is the profile of the current user
+    :return: dictionary mapping each measured job to its throughput in frames per second
+    """
+    profile = profile or PROFILE
+    measured = {}
+    try:
+        settings = read_settings(directory)
+        if settings['shared']:
+            logger.debug('Not profiling XDS run limited to a share of the machine')
+            return measured
+        for job in TUNED_JOBS:
+            if job not in settings['jobs']:
+                continue
+            with open(os.path.join(directory, '{}.LP'.format(job)), 'r') as handle:
+                times = WALL_TIME_PATTERN.findall(handle.read())
+            if times and float(times[-1]) > 0:
+                frames, wall = settings['frames'][job], float(times[-1])
+                profile.record(
+                    settings['detector'], job, settings['max_jobs'], settings['processors'], settings['delphi'],
+                    frames, wall
+                )
+                measured[job] = frames / wall
+    except (OSError, ValueError, IndexError, AttributeError) as e:
+        logger.debug('Unable to record XDS throughput: {}'.format(e))
+    return measured
+
+
+PROFILE = Profile()
@@ -4,10 +4,12 @@ Input/Output routines for XDS and file conversion utilities
 """
 
 import os
+import re
 
 import numpy
 import multiprocessing
-from autoprocess.utils import misc
+from autoprocess.utils import misc, nodes, tuning
+from autoprocess.utils.frames import FrameSet
 
 DEFAULT_DELPHI = 8
 if os.environ.get('DPS_NODES'):
@@ -18,6 +20,7 @@ else:
     HOSTS = {
         'localhost': multiprocessing.cpu_count()
     }
+NODES = nodes.NodeRegistry(HOSTS, prober=nodes.get_prober())
 
 
 def closest_factor(val, root):
@@ -32,9 +35,8 @@ def closest_factor(val, root):
     return x
 
 
-def get_job_params(num_frames, delta, delphi=DEFAULT_DELPHI):
-    nodes = len(HOSTS)
-    cores = sum(HOSTS.values())
+def get_job_params(num_frames, delta, delphi=DEFAULT_DELPHI, cores=None):
+    cores = cores or sum(HOSTS.values())
     max_cpus = misc.get_cpu_count()
     raw_batch_size = (delphi / delta)
     batch_size = closest_factor(raw_batch_size, max_cpus)
@@ -44,9 +46,72 @@ def get_job_params(num_frames, delta, delphi=DEFAULT_DELPHI):
     return max(1, max_jobs // 2), batch_size, delphi
 
 
-def write_xds_input(jobs, parameters):
+def get_core_budget():
     """
-    Create XDS.INP file using parameters in the dictionary params
+    Number of cores available to this process. A budget given by the DPS_CORES environment variable,
+    for example by a batch run sharing the machine between several pipelines, limits the cores used.
+
+    :return: number of cores, 0 if not limited
+    """
+    try:
+        return max(0, int(os.environ.get('DPS_CORES', 0)))
+    except ValueError:
+        return 0
+
+
+def get_input_processors(filename):
+    """
+    Number of processors used by XDS or XSCALE according to an input file
+
+    :param filename: XDS.INP or XSCALE.INP
+    :return: MAXIMUM_NUMBER_OF_JOBS times MAXIMUM_NUMBER_OF_PROCESSORS, or None if the number of processors
+        is not limited, in which case the programs use all processors of the host
+    """
+    values = {}
+    try:
+        with open(filename, 'r') as handle:
+            for line in handle:
+                for key, value in re.findall(r'(MAXIMUM_NUMBER_OF_\w+)=\s*(\d+)', line.split('!')[0]):
+                    values[key] = int(value)
+    except OSError:
+        return None
+    if 'MAXIMUM_NUMBER_OF_PROCESSORS' in values:
+        return values.get('MAXIMUM_NUMBER_OF_JOBS', 1) * values['MAXIMUM_NUMBER_OF_PROCESSORS']
+
+
+def get_budget_params(num_jobs, batch_size, budget):
+    """
+    Fit the number of XDS jobs and processors per job within a core budget
+
+    :param num_jobs: number of jobs without a budget
+    :param batch_size: number of frames per job batch
+    :param budget: number of cores available
+    :return: tuple (jobs, processors)
+    """
+    jobs = max(1, min(num_jobs, budget // batch_size))
+    processors = max(1, budget // jobs)
+    return jobs, processors
+
+
+def get_tuned_params(detector, delta, max_delphi=DEFAULT_DELPHI, budget=0):
+    """
+    Parallelization settings with the highest INTEGRATE throughput measured on this host
+
+    :param detector: detector profile key
+    :param delta: oscillation angle per frame
+    :param max_delphi: maximum DELPHI
+    :param budget: number of cores available, 0 if not limited
+    :return: tuple (jobs, processors, batch_size, delphi) or None if the detector has not been profiled
+    """
+    best = tuning.PROFILE.best(detector, 'INTEGRATE', cores=budget, max_delphi=max_delphi)
+    if best:
+        batch_size = max(1, int(round(best['delphi'] / delta)))
+        return best['jobs'], best['processors'], batch_size, batch_size * delta
+
+
+def write_xds_input(jobs, parameters, directory='.'):
+    """
+    Create XDS.INP file in directory using parameters in the dictionary params
     jobs = XYCORR INIT COLSPOT IDXREF DEFPIX INTEGRATE CORRECT
     params = {
         'wavelength': float
@@ -75,6 +140,8 @@ def write_xds_input(jobs, parameters):
         'shells': list of numbers or None
         'anomalous': True or False default False
         'strict_absorption': True or False default False
+        'parallel': tuple of (jobs, processors, delphi) or None
+        'processors': int or None, limits the processors used when the host is shared with concurrent runs
     }
     """
     # defaults
@@ -120,16 +187,35 @@ def write_xds_input(jobs, parameters):
         detector = 'CCDCHESS'
 
     num_frames = params['data_range'][1] - params['data_range'][0] + 1
-    num_jobs, batch_size, delphi = get_job_params(
-        num_frames, params['delta_angle'], min(params.get('max_delphi', 8), DEFAULT_DELPHI)
-    )
+    max_delphi = min(params.get('max_delphi', 8), DEFAULT_DELPHI)
+    cluster = NODES.select()
+    free = sum(node.free for node in cluster)
+    num_jobs, batch_size, delphi = get_job_params(num_frames, params['delta_angle'], max_delphi, cores=free)
+    budget = params.get('processors') or get_core_budget()
+    shared = bool(budget)
+    if params.get('parallel'):
+        # explicit settings, used for benchmarking
+        tuned = tuple(params['parallel'][:2]) + (batch_size, params['parallel'][2])
+    else:
+        tuned = get_tuned_params(
+            tuning.detector_key(detector, params['detector_size']), params['delta_angle'], max_delphi, budget
+        )
+    if tuned:
+        num_jobs, params['num_processors'], batch_size, delphi = tuned
+        if not params.get('parallel') and free and num_jobs * params['num_processors'] > free:
+            # profiled on an idle host, fit within the cores currently free on the selected nodes
+            num_jobs = max(1, min(num_jobs, free // params['num_processors']))
+            params['num_processors'] = max(1, min(params['num_processors'], free // num_jobs))
+            shared = True
+    elif budget:
+        num_jobs, params['num_processors'] = get_budget_params(num_jobs, batch_size, budget)
     params['jobs'] = jobs
     params['detector'] = detector
     params['sensor_thickness'] = params.get('sensor_thickness', 0.0)
     params['num_jobs'] = num_jobs
     params['batch_size'] = batch_size
     params['delphi'] = delphi
-    params['cluster_nodes'] = ' '.join(list(HOSTS.keys()))
+    params['cluster_nodes'] = ' '.join(node.name for node in cluster)
     params['sigma'] = params.get('sigma', 4)
     params['friedel'] = str(not params.get('anomalous', False)).upper()
     params['space_group'] = params.get('reference_spacegroup', params.get('space_group', 0))
@@ -144,6 +230,13 @@ def write_xds_input(jobs, parameters):
         "JOB=   {jobs}\n"
         "CLUSTER_NODES= {cluster_nodes}\n"
     ).format(**params)
+    if shared:
+        # throughput measured while sharing the machine is not added to the parallelization profile
+        job_text += "{} {}\n".format(tuning.SHARED_MARKER, budget or free)
+    if params.get('num_processors') or len(cluster) > 1:
+        job_text += "MAXIMUM_NUMBER_OF_JOBS= {num_jobs}\n".format(**params)
+    if params.get('num_processors'):
+        job_text += "MAXIMUM_NUMBER_OF_PROCESSORS= {num_processors}\n".format(**params)
 
     dataset_text = (
         "!------------------- Dataset parameters\n"
@@ -158,10 +251,11 @@ def write_xds_input(jobs, parameters):
         "DELPHI=    {delphi:4.2f} \n"
     ).format(**params)
 
-    for r_s, r_e in params.get('skip_range', []):
+    # overlapping or adjacent ranges are merged
+    for r_s, r_e in FrameSet(params.get('skip_range', [])).ranges():
         dataset_text += "EXCLUDE_DATA_RANGE=    {} {}\n".format(r_s, r_e)
 
-    for r_s, r_e in params['spot_range']:
+    for r_s, r_e in FrameSet(params['spot_range']).ranges():
         dataset_text += "SPOT_RANGE=    {} {}\n".format(r_s, r_e)
 
     if params.get('background_range'):
@@ -233,16 +327,16 @@ def write_xds_input(jobs, parameters):
         extra_text += 'UNTRUSTED_RECTANGLE= {} {} {} {}\n'.format(*rectangle)
     extra_text = extra_text.format(**params)
 
-    with open('XDS.INP', 'w') as outfile:
+    with open(os.path.join(directory, 'XDS.INP'), 'w') as outfile:
         outfile.write(job_text)
         outfile.write(dataset_text)
         outfile.write(beamline_text)
         outfile.write(extra_text)
 
 
-def write_xscale_input(params):
+def write_xscale_input(params, directory='.'):
     """
-    Create XSCALE.INP file using parameters in the dictionary params
+    Create XSCALE.INP file in directory using parameters in the dictionary params
     
     params = {
         'strict_absorption': True or False default False
@@ -259,7 +353,8 @@ def write_xscale_input(params):
     """
 
     header = "!-XSCALE.INP--------File generated by auto.process \n"
-    header += "MAXIMUM_NUMBER_OF_PROCESSORS=%d \n" % misc.get_cpu_count()
+    processors = min(misc.get_cpu_count(), get_core_budget() or misc.get_cpu_count())
+    header += "MAXIMUM_NUMBER_OF_PROCESSORS=%d \n" % processors
 
     body = ""
     shells = []
@@ -292,15 +387,15 @@ def write_xscale_input(params):
         header += 'RESOLUTION_SHELLS= {}\n'.format(' '.join([f'{x:0.2f}' for x in shells]))
 
     file_text = header + body + "!-------------------File generated by auto.process \n"
-    outfile = open('XSCALE.INP', 'w')
+    outfile = open(os.path.join(directory, 'XSCALE.INP'), 'w')
 
     outfile.write(file_text)
     outfile.close()
 
 
-def write_xdsconv_input(params):
+def write_xdsconv_input(params, directory='.'):
     """
-    Create XDSCONV.INP file using parameters in the dictionary params
+    Create XDSCONV.INP file in directory using parameters in the dictionary params
     
     params = {
         'space_group': int
@@ -324,6 +419,6 @@ def write_xdsconv_input(params):
     if params['freeR_fraction'] > 0.0:
         file_text += "GENERATE_FRACTION_OF_TEST_REFLECTIONS=%0.2f\n" % params['freeR_fraction']
     file_text += "!-------------------File generated by auto.process \n"
-    outfile = open('XDSCONV.INP', 'w')
+    outfile = open(os.path.join(directory, 'XDSCONV.INP'), 'w')
     outfile.write(file_text)
     outfile.close()
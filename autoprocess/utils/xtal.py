@@ -1,8 +1,11 @@
 import bisect
+import functools
 import gzip
 import math
 import os
 import itertools
+import re
+import types
 
 import json
 import numpy
@@ -11,14 +14,35 @@ from autoprocess.utils.misc import Table
 
 DEBUG = False
 XTAL_TABLE_FILE = os.path.join(os.path.dirname(__file__), 'data', 'xtal_tables.jsonz')
-with gzip.open(XTAL_TABLE_FILE, 'rb') as handle:
-    XTAL_TABLES = json.load(handle)
 
-SG_SYMBOLS = {int(k): v['name'] for k, v in list(XTAL_TABLES.items())}
-SG_NAMES = {int(k): v['symbol'] for k, v in list(XTAL_TABLES.items())}
-SG_NUMBERS = {v['name']: int(k) for k, v in list(XTAL_TABLES.items())}
-CHIRAL_SPACE_GROUPS = [int(k) for k, v in list(XTAL_TABLES.items()) if v['chiral']]
-CENTRO_SYMETRIC = {int(k): '-X,-Y,-Z' in v['symmetry'] for k, v in list(XTAL_TABLES.items())}
+# module attributes derived from the crystallographic tables, which are only loaded when first used
+TABLE_NAMES = ('XTAL_TABLES', 'SG_SYMBOLS', 'SG_NAMES', 'SG_NUMBERS', 'CHIRAL_SPACE_GROUPS', 'CENTRO_SYMETRIC')
+
+
+@functools.lru_cache(maxsize=None)
+def load_tables():
+    """
+    Load the crystallographic tables
+
+    :return: namespace with one attribute for each name in TABLE_NAMES
+    """
+    with gzip.open(XTAL_TABLE_FILE, 'rb') as handle:
+        tables = json.load(handle)
+    return types.SimpleNamespace(
+        XTAL_TABLES=tables,
+        SG_SYMBOLS={int(k): v['name'] for k, v in tables.items()},
+        SG_NAMES={int(k): v['symbol'] for k, v in tables.items()},
+        SG_NUMBERS={v['name']: int(k) for k, v in tables.items()},
+        CHIRAL_SPACE_GROUPS=[int(k) for k, v in tables.items() if v['chiral']],
+        CENTRO_SYMETRIC={int(k): '-X,-Y,-Z' in v['symmetry'] for k, v in tables.items()},
+    )
+
+
+def __getattr__(name):
+    if name in TABLE_NAMES:
+        return getattr(load_tables(), name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
 
 # each rule is a list of 9 boolean values representing
 # a=b, a=c, b=c, a=b=c, alpha=90, beta=90, gamma=90, alpha=120, beta=120, gamma=120
@@ -46,11 +70,11 @@ def resolution_shells(resolution, num=12):
 
 
 def get_character(sg_number=1):
-    return XTAL_TABLES[str(sg_number)]['lattice_character']
+    return load_tables().XTAL_TABLES[str(sg_number)]['lattice_character']
 
 
 def get_number(sg_name):
-    return SG_NUMBERS[sg_name]
+    return load_tables().SG_NUMBERS[sg_name]
 
 
 def get_pg_list(lattices, chiral=True):
@@ -59,18 +83,20 @@ def get_pg_list(lattices, chiral=True):
     names of the lowest symmetry pointgroup.
     """
 
+    tables = load_tables()
     pgset = set(
-        [SG_NUMBERS[v['point_group']] for v in list(XTAL_TABLES.values()) if v['lattice_character'] in lattices])
+        [tables.SG_NUMBERS[v['point_group']] for v in list(tables.XTAL_TABLES.values())
+         if v['lattice_character'] in lattices])
     if chiral:
-        pgset = pgset.intersection(set(CHIRAL_SPACE_GROUPS))
+        pgset = pgset.intersection(set(tables.CHIRAL_SPACE_GROUPS))
     pgnums = sorted(pgset)
-    return [SG_SYMBOLS[n] for n in pgnums]
+    return [tables.SG_SYMBOLS[n] for n in pgnums]
 
 
 def get_sg_table(chiral=True):
     """Generate a table of all spacegroups for each given crystal system."""
     tab = defaultdict(list)
-    for k, v in list(XTAL_TABLES.items()):
+    for k, v in list(load_tables().XTAL_TABLES.items()):
         if (chiral and not v['chiral']): continue
         tab[v['lattice_character']].append(f"{v['symbol']}(#{k})")
 
@@ -231,6 +257,33 @@ def score_crystal(resolution, completeness, r_meas, i_sigma, mosaicity, std_spot
     return scores.sum(), list(zip(names, scores / weights, values))
 
 
+# midpoints of the logistic terms used for scoring indexing results
+INDEXING_LIMITS = {
+    'indexed_fraction': 0.5,
+    'subtree_fraction': 0.6,
+    'stdev_spot': 2.0,
+    'stdev_spindle': 1.0,
+    'mosaicity': 0.5,
+    'problems': 1.5,
+}
+
+
+def score_indexing(indexed_fraction, subtree_fraction, stdev_spot, stdev_spindle, mosaicity, problems, limits=None):
+    limits = dict(INDEXING_LIMITS, **(limits or {}))
+    scores = numpy.array([
+        logistic(indexed_fraction, x0=limits['indexed_fraction'], weight=0.25, width=10),
+        logistic(subtree_fraction, x0=limits['subtree_fraction'], weight=0.2, width=10),
+        logistic(stdev_spot, x0=limits['stdev_spot'], weight=0.2, width=2, invert=True),
+        logistic(stdev_spindle, x0=limits['stdev_spindle'], weight=0.1, width=2, invert=True),
+        logistic(mosaicity, x0=limits['mosaicity'], weight=0.15, width=10, invert=True),
+        logistic(problems, x0=limits['problems'], weight=0.1, width=3, invert=True),
+    ])
+    weights = numpy.array([0.25, 0.2, 0.2, 0.1, 0.15, 0.1])
+    names = ['Indexed', 'Subtree', 'Std_spot', 'Std_spindle', 'Mosaicity', 'Problems']
+    values = [indexed_fraction, subtree_fraction, stdev_spot, stdev_spindle, mosaicity, problems]
+    return scores.sum(), list(zip(names, scores / weights, values))
+
+
 def average_cell(cell_and_weights):
     """Average a series of cell parameters together with weights and return the average cell and standard deviations
         input should be of the form [(cell1, weight), (cell2, weight), ...]
@@ -279,3 +332,182 @@ def resol_to_dist(resolution, pixel_size, detector_size, wavelength, two_theta=0
     theta = math.asin(0.5 * wavelength / resolution)
     theta = max(0, (theta - two_theta))
     return 0.5 * pixel_size * detector_size / math.tan(2 * theta)
+
+
+def parse_symop(op):
+    """
+    Parse a symmetry operator such as '1/2-X,Y-X,Z+1/3'
+
+    :param op: operator text
+    :return: tuple (rotation, translation) of a 3x3 integer array and a vector of 3 floats
+    """
+    rotation = numpy.zeros((3, 3), dtype=int)
+    translation = numpy.zeros(3)
+    for i, term in enumerate(op.upper().replace(' ', '').split(',')):
+        for sign, value in re.findall(r'([+-]?)([XYZ]|\d+/\d+|\d+)', term):
+            factor = -1 if sign == '-' else 1
+            if value in 'XYZ':
+                rotation[i, 'XYZ'.index(value)] = factor
+            else:
+                numerator, _, denominator = value.partition('/')
+                translation[i] += factor * float(numerator) / float(denominator or 1)
+    return rotation, translation
+
+
+@functools.lru_cache(maxsize=None)
+def get_rotations(sg_number):
+    """
+    Unique rotation matrices of the symmetry operators of a space group. Centering operators
+    add no rotations.
+
+    :param sg_number: space group number
+    :return: integer array of shape (n, 3, 3)
+    """
+    rotations = []
+    for op in load_tables().XTAL_TABLES[str(sg_number)]['symmetry']:
+        rotation = parse_symop(op)[0]
+        if not any((rotation == existing).all() for existing in rotations):
+            rotations.append(rotation)
+    return numpy.array(rotations)
+
+
+def laue_asu(sg_number):
+    """
+    Name of the reciprocal space asymmetric unit of a space group. The trigonal -3m class is split
+    into -3m1 and -31m according to the orientation of the two-fold axes (or mirrors normal to them).
+    """
+    laue = load_tables().XTAL_TABLES[str(sg_number)]['laue_class']
+    if laue == '-3m':
+        two_fold = numpy.array([[0, 1, 0], [1, 0, 0], [0, 0, -1]])
+        laue = '-3m1' if any(
+            (rotation == two_fold).all() or (rotation == -two_fold).all() for rotation in get_rotations(sg_number)
+        ) else '-31m'
+    return laue
+
+
+# Conditions defining the CCP4 reciprocal space asymmetric units, for arrays of h, k, l
+ASU_CONDITIONS = {
+    '-1': lambda h, k, l: (l > 0) | ((l == 0) & ((h > 0) | ((h == 0) & (k >= 0)))),
+    '2/m': lambda h, k, l: (k >= 0) & ((l > 0) | ((l == 0) & (h >= 0))),
+    'mmm': lambda h, k, l: (h >= 0) & (k >= 0) & (l >= 0),
+    '4/m': lambda h, k, l: (l >= 0) & (((h >= 0) & (k > 0)) | ((h == 0) & (k == 0))),
+    '4/mmm': lambda h, k, l: (h >= k) & (k >= 0) & (l >= 0),
+    '-3': lambda h, k, l: ((h >= 0) & (k > 0)) | ((h == 0) & (k == 0) & (l >= 0)),
+    '-3m1': lambda h, k, l: (h >= k) & (k >= 0) & ((h > k) | (l >= 0)),
+    '-31m': lambda h, k, l: (h >= k) & (k >= 0) & ((k > 0) | (l >= 0)),
+    '6/m': lambda h, k, l: (l >= 0) & (((h >= 0) & (k > 0)) | ((h == 0) & (k == 0))),
+    '6/mmm': lambda h, k, l: (h >= k) & (k >= 0) & (l >= 0),
+    'm-3': lambda h, k, l: (h >= 0) & (((l >= h) & (k > h)) | ((l == h) & (k == h))),
+    'm-3m': lambda h, k, l: (k >= l) & (l >= h) & (h >= 0),
+}
+
+
+def map_to_asu(hkl, sg_number, chunk_size=65536):
+    """
+    Map reflection indices to the reciprocal space asymmetric unit
+
+    :param hkl: integer array of shape (n, 3)
+    :param sg_number: space group number
+    :param chunk_size: number of reflections mapped at a time, limits the memory used
+    :return: tuple (asu_hkl, minus) where minus is True for reflections which are mapped through a Friedel
+        inversion, that is those which contribute to I(-). Centric reflections are never mapped through an inversion.
+    """
+    hkl = numpy.asarray(hkl, dtype=numpy.int32)
+    rotations = get_rotations(sg_number)
+    condition = ASU_CONDITIONS[laue_asu(sg_number)]
+    asu_hkl = numpy.empty_like(hkl)
+    minus = numpy.empty(len(hkl), dtype=bool)
+    for start in range(0, len(hkl), chunk_size):
+        block = hkl[start:start + chunk_size]
+        # all equivalents, the proper ones first, shape (n, 2m, 3)
+        equivalents = numpy.einsum('ni,mij->nmj', block, rotations)
+        equivalents = numpy.concatenate([equivalents, -equivalents], axis=1)
+        inside = condition(equivalents[..., 0], equivalents[..., 1], equivalents[..., 2])
+        first = inside.argmax(axis=1)
+        asu_hkl[start:start + chunk_size] = equivalents[numpy.arange(len(block)), first]
+        minus[start:start + chunk_size] = first >= len(rotations)
+    return asu_hkl, minus
+
+
+def unique_hkl(hkl):
+    """
+    Find the unique reflection indices. Indices are packed into single integers, which is much faster
+    than finding unique rows.
+
+    :param hkl: integer array of shape (n, 3), indices must be in the range -1024 to 1023
+    :return: tuple (unique, inverse) where unique[inverse] reproduces hkl
+    """
+    packed = numpy.asarray(hkl, dtype=numpy.int64) + 1024
+    packed = (packed[:, 0] << 22) | (packed[:, 1] << 11) | packed[:, 2]
+    keys, inverse = numpy.unique(packed, return_inverse=True)
+    unique = numpy.column_stack([keys >> 22, (keys >> 11) & 2047, keys & 2047]).astype(numpy.int32) - 1024
+    return unique, inverse.ravel()
+
+
+def is_centric(hkl, sg_number):
+    """
+    Determine which reflections are centric, that is equivalent to their Friedel mates
+
+    :param hkl: integer array of shape (n, 3)
+    :param sg_number: space group number
+    :return: boolean array
+    """
+    hkl = numpy.asarray(hkl, dtype=numpy.int32)
+    centric = numpy.zeros(len(hkl), dtype=bool)
+    for rotation in get_rotations(sg_number):
+        centric |= (hkl @ rotation == -hkl).all(axis=1)
+    return centric
+
+
+def is_absent(hkl, sg_number):
+    """
+    Determine which reflections are systematically absent, that is invariant under a symmetry operator
+    whose translation gives them a non-integral phase
+
+    :param hkl: integer array of shape (n, 3)
+    :param sg_number: space group number
+    :return: boolean array
+    """
+    hkl = numpy.asarray(hkl, dtype=numpy.int32)
+    absent = numpy.zeros(len(hkl), dtype=bool)
+    for op in load_tables().XTAL_TABLES[str(sg_number)]['symmetry']:
+        rotation, translation = parse_symop(op)
+        phase = hkl @ translation
+        invariant = (hkl @ rotation == hkl).all(axis=1)
+        absent |= invariant & (numpy.abs(phase - numpy.round(phase)) > 1e-3)
+    return absent
+
+
+def epsilon_factor(hkl, sg_number):
+    """
+    Statistical weight of reflections, the number of rotations of the point group which leave the indices
+    unchanged. The expected intensity of a reflection is proportional to it.
+
+    :param hkl: integer array of shape (n, 3)
+    :param sg_number: space group number
+    :return: integer array
+    """
+    hkl = numpy.asarray(hkl, dtype=numpy.int32)
+    epsilon = numpy.zeros(len(hkl), dtype=int)
+    for rotation in get_rotations(sg_number):
+        epsilon += (hkl @ rotation == hkl).all(axis=1)
+    return epsilon
+
+
+def inverse_d_squared(hkl, unit_cell):
+    """
+    Calculate 1/d² of reflections
+
+    :param hkl: integer array of shape (n, 3)
+    :param unit_cell: cell parameters a, b, c, alpha, beta, gamma
+    :return: array of 1/d² values in Å⁻²
+    """
+    a, b, c = unit_cell[:3]
+    alpha, beta, gamma = numpy.radians(unit_cell[3:])
+    metric = numpy.array([
+        [a * a, a * b * numpy.cos(gamma), a * c * numpy.cos(beta)],
+        [a * b * numpy.cos(gamma), b * b, b * c * numpy.cos(alpha)],
+        [a * c * numpy.cos(beta), b * c * numpy.cos(alpha), c * c],
+    ])
+    hkl = numpy.asarray(hkl, dtype=float)
+    return numpy.einsum('ni,ij,nj->n', hkl, numpy.linalg.inv(metric), hkl)
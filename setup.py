@@ -40,6 +40,7 @@ setup(
         'bin/auto.scale',
         'bin/auto.strategy',
         'bin/auto.symmetry',
+        'bin/auto.tune',
         'bin/auto.server',
     ],
     classifiers=[